@@ -0,0 +1,142 @@
+# admission.py
+# Agent 端的准入控制 (Admission Control / Backpressure)
+#
+# 每個 Agent 的 ReAct loop 都會打 LLM 與做 embedding，很吃資源。
+# 多使用者時如果請求全部同時進來，延遲會一起爆掉；這裡限制：
+#   - 最多同時處理 max_in_flight 個請求
+#   - 最多再排隊 max_queue 個，其餘立刻拒絕並附上建議的重試秒數 (retry_after)
+#   - 記錄排隊等待時間等指標，方便觀察負載
+#
+# 用法：
+#   admission = AdmissionController.from_env("comparing")
+#   try:
+#       async with admission.slot():
+#           return await _generate_response(...)
+#   except AdmissionRejected as e:
+#       return e.to_json()
+#
+# 環境變數 (Agent 專屬的設定優先)：
+#   COMPARING_MAX_IN_FLIGHT / AGENT_MAX_IN_FLIGHT   預設 4
+#   COMPARING_MAX_QUEUE     / AGENT_MAX_QUEUE       預設 16
+
+import asyncio
+import json
+import os
+import sys
+import time
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, Dict
+
+DEFAULT_MAX_IN_FLIGHT = 4
+DEFAULT_MAX_QUEUE = 16
+
+
+class AdmissionRejected(Exception):
+    """排隊已滿，請求被拒絕"""
+
+    def __init__(self, agent_name: str, retry_after: float):
+        super().__init__(f"{agent_name} 目前忙碌中，請 {retry_after:.0f} 秒後再試")
+        self.agent_name = agent_name
+        self.retry_after = retry_after
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"error": "agent_busy", "message": str(self), "retry_after": round(self.retry_after, 1)},
+            ensure_ascii=False,
+        )
+
+
+def _env_int(names, default: int) -> int:
+    for name in names:
+        value = os.getenv(name)
+        if value and value.strip():
+            return int(value)
+    return default
+
+
+def _percentile(values, pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+
+class AdmissionController:
+    def __init__(self, name: str, max_in_flight: int = DEFAULT_MAX_IN_FLIGHT, max_queue: int = DEFAULT_MAX_QUEUE):
+        self.name = name
+        self.max_in_flight = max(1, max_in_flight)
+        self.max_queue = max(0, max_queue)
+        self._semaphore = asyncio.Semaphore(self.max_in_flight)
+
+        # --- 指標 ---
+        self.in_flight = 0
+        self.waiting = 0
+        self.admitted = 0
+        self.rejected = 0
+        self._wait_ms = deque(maxlen=500)     # 最近的排隊等待時間
+        self._service_ms = deque(maxlen=500)  # 最近的處理時間 (估算 retry_after 用)
+
+    @classmethod
+    def from_env(cls, name: str) -> "AdmissionController":
+        prefix = name.upper()
+        return cls(
+            name,
+            max_in_flight=_env_int([f"{prefix}_MAX_IN_FLIGHT", "AGENT_MAX_IN_FLIGHT"], DEFAULT_MAX_IN_FLIGHT),
+            max_queue=_env_int([f"{prefix}_MAX_QUEUE", "AGENT_MAX_QUEUE"], DEFAULT_MAX_QUEUE),
+        )
+
+    def _estimate_retry_after(self) -> float:
+        """用最近的平均處理時間估算：排在前面的人都處理完大概要多久"""
+        avg_service_s = (sum(self._service_ms) / len(self._service_ms) / 1000) if self._service_ms else 5.0
+        return max(1.0, avg_service_s * (self.waiting + 1) / self.max_in_flight)
+
+    @asynccontextmanager
+    async def slot(self):
+        """取得一個處理名額；名額滿了就排隊，隊伍也滿了就丟 AdmissionRejected"""
+        if self.in_flight >= self.max_in_flight and self.waiting >= self.max_queue:
+            self.rejected += 1
+            retry_after = self._estimate_retry_after()
+            print(
+                f"🚦 [{self.name}] 拒絕請求 (處理中 {self.in_flight}，排隊 {self.waiting})，建議 {retry_after:.0f}s 後重試",
+                file=sys.stderr,
+            )
+            raise AdmissionRejected(self.name, retry_after)
+
+        queued_at = time.perf_counter()
+        self.waiting += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.waiting -= 1
+
+        wait_ms = (time.perf_counter() - queued_at) * 1000
+        self._wait_ms.append(wait_ms)
+        self.admitted += 1
+        self.in_flight += 1
+        if wait_ms > 100:
+            print(f"🚦 [{self.name}] 排隊 {wait_ms:.0f} ms 後開始處理", file=sys.stderr)
+
+        started_at = time.perf_counter()
+        try:
+            yield
+        finally:
+            self._service_ms.append((time.perf_counter() - started_at) * 1000)
+            self.in_flight -= 1
+            self._semaphore.release()
+
+    def snapshot(self) -> Dict[str, Any]:
+        """目前的負載與排隊指標"""
+        waits = list(self._wait_ms)
+        return {
+            "agent": self.name,
+            "max_in_flight": self.max_in_flight,
+            "max_queue": self.max_queue,
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+            "queue_wait_ms_mean": round(sum(waits) / len(waits), 1) if waits else 0.0,
+            "queue_wait_ms_p95": round(_percentile(waits, 95), 1),
+            "queue_wait_ms_max": round(max(waits), 1) if waits else 0.0,
+        }
@@ -3,8 +3,9 @@ import asyncio
 import json
 import os
 import sys
+import uuid
 from contextlib import AsyncExitStack
-from typing import Any, Dict, List, Optional
+from typing import Any, Callable, Dict, List, Optional
 
 from dotenv import load_dotenv
 from openai import OpenAI  # 改用 OpenAI client
@@ -13,6 +14,11 @@ from mcp.client.stdio import stdio_client, StdioServerParameters
 from mcp import ClientSession
 from pathlib import Path
 
+from agent_pool import ReplicaPool
+from card_catalog import mentioned_cards
+from segment_table import SegmentTable
+from tool_cache import ToolResultCache, _is_error_result
+
 # ==========================================
 # 1. 環境設定與初始化
 # ==========================================
@@ -179,6 +185,8 @@ STEP 2: (收到 demand_agent 回覆後) -> **立刻停止思考背景**，轉而
    - 參數 `user_query`: 使用者的原始問題
    - 參數 `user_profile`: 剛剛 `demand_agent` 回傳的 JSON 字串
 STEP 3: (收到 comparing_agent 回覆後) -> 整合資訊，回答使用者。
+   - ⚡ 系統可能已經**預先並行**執行了 STEP 1、STEP 2：若這一輪的歷史中已經有 `demand_agent` 與 `comparing_agent` 的結果，
+     請**直接跳到 STEP 3** 整合回答，不要再呼叫它們。
 ## 情境 B：使用者問申辦資格（例如：「我月薪 4 萬能辦 CUBE 嗎？」）
 STEP 1：呼叫 `eligibility_agent`
   - user_query = 使用者原始問題
@@ -190,7 +198,397 @@ STEP 2：整合 eligibility_agent 回覆，回答「能不能辦 / 可能卡點
 """
 
 # ==========================================
-# 5. 主程式：聊天迴圈與連線管理
+# 5. Agent 連線與派單邏輯 (CLI 與 dispatcher_server.py 共用)
+# ==========================================
+
+# Router 看到的工具名稱 -> (連線參數, Agent 實際提供的 MCP tool 名稱)
+AGENT_REGISTRY = {
+    "product_agent": (PRODUCT_SERVER_PARAMS, "product_agent"),
+    "comparing_agent": (ADVISOR_SERVER_PARAMS, "comparing_agent"),
+    "demand_agent": (DEMAND_SERVER_PARAMS, "analyze_user_needs"),
+    "eligibility_agent": (ELIGIBILITY_SERVER_PARAMS, "eligibility_agent"),
+}
+
+
+def _replica_urls(name: str) -> List[str]:
+    """讀取 <NAME>_URLS，例如 COMPARING_AGENT_URLS="http://h1:8102/mcp,http://h2:8102/mcp" """
+    raw = os.getenv(f"{name.upper()}_URLS", "")
+    return [url.strip() for url in raw.split(",") if url.strip()]
+
+
+async def connect_agents(stack: AsyncExitStack) -> Dict[str, Any]:
+    """
+    連接所有 Agent，回傳 {router 工具名稱: session}；連線生命週期交給 stack 管理。
+    - 有設定 <NAME>_URLS：連到遠端 streamable-HTTP 副本，用 ReplicaPool 做負載平衡與健康檢查
+    - 沒有設定：照舊以 stdio 啟動本機子程序
+    """
+    session_map: Dict[str, Any] = {}
+    for name, (params, _remote_tool) in AGENT_REGISTRY.items():
+        urls = _replica_urls(name)
+        if urls:
+            pool = ReplicaPool(name, urls)
+            await pool.start()
+            stack.push_async_callback(pool.close)
+            session_map[name] = pool
+            print(f"✅ [System] {name} 已連線 ({len(urls)} 個 HTTP 副本)")
+            continue
+
+        read, write = await stack.enter_async_context(stdio_client(params))
+        session = await stack.enter_async_context(ClientSession(read, write))
+        await session.initialize()
+        session_map[name] = session
+        print(f"✅ [System] {name} 已連線")
+    return session_map
+
+
+# ==========================================
+# 6. 推薦情境的預先並行執行 (Speculative Recommend Plan)
+# ==========================================
+# 原本情境 A 是序列的：Router -> demand_agent -> Router -> comparing_agent -> Router。
+# 判斷為「求推薦」時，這裡直接同時啟動
+#   (1) demand_agent 背景分析
+#   (2) comparing agent 的卡片資料檢索 (comparing_prefetch)
+# demand 結果一回來就帶著 profile + 預先檢索的資料呼叫 comparing_agent，
+# 最後只需要一次 Router 呼叫來整合回答，省下中間兩次 Router 來回，也讓最慢的兩段重疊。
+
+SPECULATIVE_RECOMMEND = os.getenv("SPECULATIVE_RECOMMEND", "1") != "0"
+# 每一句使用者輸入最多讓 Router 跑幾輪 (呼叫工具 -> 看結果 算一輪)，避免無窮迴圈
+MAX_ROUTER_ITERATIONS = int(os.getenv("MAX_ROUTER_ITERATIONS", "6"))
+
+RECOMMEND_KEYWORDS = ("推薦", "適合", "想辦卡", "辦什麼卡", "辦哪張", "哪張卡", "哪一張", "第一張卡", "該辦")
+# 這些是情境 B (申辦資格) 的問法，交給 Router 走 eligibility_agent
+ELIGIBILITY_KEYWORDS = ("能不能辦", "可不可以辦", "能辦嗎", "可以辦嗎", "過件", "資格", "門檻")
+
+
+def is_recommend_intent(user_input: str) -> bool:
+    """
+    輕量的關鍵字判斷：是否為「求推薦」的問題。
+    有點名特定卡片的 (例如「CUBE卡適合網購嗎」) 是產品問題，交給 Router 走 product_agent / comparing_agent。
+    """
+    text = user_input.replace(" ", "")
+    if any(k in text for k in ELIGIBILITY_KEYWORDS):
+        return False
+    if not any(k in text for k in RECOMMEND_KEYWORDS):
+        return False
+    return not mentioned_cards(text)
+
+
+# 預先算好的客群推薦表 (segment_table.py build 產生)：profile 落在表內就不呼叫 comparing_agent
+SEGMENT_TABLE = SegmentTable() if os.getenv("SEGMENT_TABLE", "1") != "0" else None
+
+
+def segment_answer(args: Dict[str, Any]) -> Optional[str]:
+    """
+    comparing_agent 的參數 -> 查表結果 (JSON 字串)。表只回答「依 profile 推薦」：
+    不是求推薦、問題有點名特定卡片 (例如「CUBE卡跟亞洲萬里通卡哪張適合出國」)、或 profile 不在表內時回傳 None
+    """
+    user_query = str(args.get("user_query", ""))
+    if SEGMENT_TABLE is None or not is_recommend_intent(user_query):  # is_recommend_intent 已排除點名特定卡片的問題
+        return None
+    return SEGMENT_TABLE.answer(args.get("user_profile"))
+
+
+def _is_tool_error(mcp_res: Any) -> bool:
+    """MCP 結果標記為 isError (工具丟出例外) 時視為失敗，不快取"""
+    return bool(getattr(mcp_res, "isError", False))
+
+
+def _tool_result_text(mcp_res: Any) -> str:
+    """兼容 TextContent 或直接字串"""
+    if hasattr(mcp_res, 'content') and mcp_res.content and hasattr(mcp_res.content[0], 'text'):
+        return mcp_res.content[0].text
+    return str(mcp_res)
+
+
+async def run_recommend_plan(
+    messages: List[ChatCompletionMessageParam],
+    session_map: Dict[str, Any],
+    user_input: str,
+    emit: Callable[[str, Dict[str, Any]], None],
+    tool_cache: Optional[ToolResultCache] = None,
+) -> bool:
+    """
+    對「求推薦」的問題預先並行執行 demand_agent 與 comparing_agent，
+    並把結果寫成 Router 的 tool call 紀錄放進 messages。回傳是否有執行。
+    有 tool_cache 時，同樣的問題會沿用之前的結果，跑完的結果也會存進去給 Router 之後重複呼叫時使用。
+    """
+    sess_demand = session_map.get("demand_agent")
+    sess_comparing = session_map.get("comparing_agent")
+    if not (SPECULATIVE_RECOMMEND and sess_demand and sess_comparing and is_recommend_intent(user_input)):
+        return False
+
+    emit("dispatch", {"tools": ["demand_agent", "comparing_prefetch"], "plan": "recommend"})
+
+    demand_args = {"user_input": user_input}
+    demand_key = ToolResultCache.make_key("demand_agent", demand_args)
+    cached_profile = tool_cache.get(demand_key) if tool_cache else None
+
+    # 1. 同時啟動：需求分析 + 卡片資料檢索 (同一個問題已經分析過就直接沿用)
+    demand_task = None
+    if cached_profile is None:
+        demand_task = asyncio.create_task(
+            sess_demand.call_tool(AGENT_REGISTRY["demand_agent"][1], arguments=demand_args)
+        )
+    prefetch_task = asyncio.create_task(
+        sess_comparing.call_tool("comparing_prefetch", arguments={"user_query": user_input})
+    )
+
+    # 2. demand 一回來就準備呼叫 comparing_agent
+    if demand_task is None:
+        profile = cached_profile
+        tool_cache.log_suppressed("demand_agent", "planner")
+        emit("tool_result", {"tool": "demand_agent", "ok": True, "cached": True})
+    else:
+        try:
+            demand_res = await demand_task
+            profile = _tool_result_text(demand_res)
+            # isError、agent_busy、解析失敗的 {"error": ...} profile 都不能拿去推薦，也不能寫成成功的歷史
+            if _is_tool_error(demand_res) or _is_error_result(profile):
+                raise RuntimeError(profile)
+            emit("tool_result", {"tool": "demand_agent", "ok": True})
+        except Exception as e:
+            prefetch_task.cancel()
+            emit("tool_result", {"tool": "demand_agent", "ok": False, "error": str(e)})
+            return False  # 交回 Router 走原本的流程
+        if tool_cache:
+            tool_cache.put(demand_key, profile)
+
+    comparing_args = {"user_query": user_input, "user_profile": profile}
+    comparing_key = ToolResultCache.make_key("comparing_agent", comparing_args)
+    comparing_text = tool_cache.get(comparing_key) if tool_cache else None
+    table_text = segment_answer(comparing_args) if comparing_text is None else None
+
+    if table_text is not None:
+        prefetch_task.cancel()
+        comparing_text = table_text
+        emit("tool_result", {"tool": "comparing_agent", "ok": True, "source": "segment_table"})
+    elif comparing_text is not None:
+        prefetch_task.cancel()
+        tool_cache.log_suppressed("comparing_agent", "planner")
+        emit("tool_result", {"tool": "comparing_agent", "ok": True, "cached": True})
+    else:
+        try:
+            prefetched = _tool_result_text(await prefetch_task)
+        except Exception as e:
+            print(f"⚠️ [Planner] comparing_prefetch 失敗，改由 comparing_agent 自行檢索: {e}", file=sys.stderr)
+            prefetched = ""
+
+        try:
+            comparing_res = await sess_comparing.call_tool(
+                AGENT_REGISTRY["comparing_agent"][1],
+                arguments={**comparing_args, "prefetched_context": prefetched},
+            )
+            comparing_text = _tool_result_text(comparing_res)
+            if _is_tool_error(comparing_res):
+                emit("tool_result", {"tool": "comparing_agent", "ok": False, "error": comparing_text})
+            else:
+                emit("tool_result", {"tool": "comparing_agent", "ok": True})
+                if tool_cache:
+                    tool_cache.put(comparing_key, comparing_text)
+        except Exception as e:
+            comparing_text = json.dumps({"error": str(e)})
+            emit("tool_result", {"tool": "comparing_agent", "ok": False, "error": str(e)})
+
+    # 3. 寫成「Router 已經呼叫過這兩個工具」的歷史，Router 下一步就會直接整合回答
+    plan_id = uuid.uuid4().hex[:8]
+    demand_call_id, comparing_call_id = f"plan_{plan_id}_demand", f"plan_{plan_id}_comparing"
+    messages.append({
+        "role": "assistant",
+        "content": None,
+        "tool_calls": [
+            {
+                "id": demand_call_id,
+                "type": "function",
+                "function": {"name": "demand_agent", "arguments": json.dumps({"user_input": user_input}, ensure_ascii=False)},
+            },
+            {
+                "id": comparing_call_id,
+                "type": "function",
+                "function": {"name": "comparing_agent", "arguments": json.dumps(comparing_args, ensure_ascii=False)},
+            },
+        ],
+    })
+    messages.append({"role": "tool", "tool_call_id": demand_call_id, "name": "demand_agent", "content": profile})
+    messages.append({"role": "tool", "tool_call_id": comparing_call_id, "name": "comparing_agent", "content": comparing_text})
+    return True
+
+
+def _print_event(event: str, data: Dict[str, Any]) -> None:
+    """CLI 模式的事件輸出 (server 模式會改成推 SSE)"""
+    if event == "thinking":
+        print("🤔 [Router] 思考下一步...", end="\r")
+    elif event == "dispatch":
+        print(f"\n⚡ [Router] 偵測到 {len(data['tools'])} 個分派任務：")
+        for name in data["tools"]:
+            print(f"   -> 派單給: {name}")
+        print("⏳ [System] 等待 Agents 回覆中...")
+    elif event == "tool_result":
+        if data["ok"]:
+            if data.get("source") == "segment_table":
+                status = "查表回覆 (客群推薦表)"
+            else:
+                status = "沿用先前結果" if data.get("cached") else "回覆完成"
+            print(f"   ✅ {data['tool']} {status}")
+        else:
+            print(f"   ❌ {data['tool']} 執行失敗: {data['error']}")
+    elif event == "answer":
+        print(f"\n💬 (總管): {data['content']}")
+    elif event == "error":
+        print(f"\n❌ {data['message']}")
+
+
+async def run_dispatch_turn(
+    messages: List[ChatCompletionMessageParam],
+    session_map: Dict[str, Any],
+    emit: Callable[[str, Dict[str, Any]], None] = _print_event,
+    tool_cache: Optional[ToolResultCache] = None,
+) -> str:
+    """
+    跑一輪「使用者一句話」的派單迴圈：Router 可以連續呼叫多次工具，直到產生文字回覆為止。
+    messages 會被就地更新 (加入 Router 決策與工具結果)，回傳最後的回覆文字 (失敗時為空字串)。
+
+    Router 的 LLM 呼叫是同步 API，這裡丟到 thread 執行，避免多使用者時卡住 event loop。
+
+    tool_cache 是這個對話的工具結果快取 (跨輪保留)；同樣的工具 + 參數不會再派單第二次。
+    沒有傳入時只在這一輪內去重複。Router 最多跑 MAX_ROUTER_ITERATIONS 輪，
+    超過就不再給它工具，強制用目前拿到的結果回答。
+    """
+    if tool_cache is None:
+        tool_cache = ToolResultCache()
+
+    # 求推薦的問題：先預先並行跑 demand + comparing，Router 只需要整合回答
+    last = messages[-1] if messages else None
+    if isinstance(last, dict) and last.get("role") == "user":
+        await run_recommend_plan(messages, session_map, str(last.get("content", "")), emit, tool_cache)
+
+    iteration = 0
+    while True:
+        iteration += 1
+        emit("thinking", {})
+
+        # 超過上限：不再允許呼叫工具，逼 Router 直接回答
+        force_answer = iteration > MAX_ROUTER_ITERATIONS
+        if force_answer:
+            print(f"🛑 [Dispatcher] Router 已跑 {MAX_ROUTER_ITERATIONS} 輪，停止派單並要求直接回答", file=sys.stderr)
+
+        try:
+            response = await asyncio.to_thread(
+                client.chat.completions.create,
+                model=GEMINI_MODEL,
+                messages=messages,
+                tools=tool_schemas,
+                tool_choice="none" if force_answer else "auto",
+            )
+        except Exception as e:
+            emit("error", {"message": f"LLM 呼叫錯誤: {e}"})
+            return ""
+
+        msg = response.choices[0].message
+        messages.append(msg) # 將模型的決策加入歷史紀錄
+
+        # 1. 如果模型回傳了文字 (Content)，代表它想說話了 -> 結束這一輪
+        if msg.content:
+            emit("answer", {"content": msg.content})
+            return msg.content
+
+        if force_answer:
+            messages.pop()  # 這個決策沒有對應的工具結果，不能留在歷史裡
+            emit("error", {"message": f"Router 超過 {MAX_ROUTER_ITERATIONS} 輪仍未產生回覆"})
+            return ""
+
+        if not msg.tool_calls:
+            emit("error", {"message": "Router 沒有回覆也沒有呼叫工具"})
+            return ""
+
+        # 2. 如果模型想呼叫工具 (Tool Calls)
+        tasks = []
+        tool_outputs = []
+        pending: Dict[str, Any] = {}  # 這一批裡相同呼叫只派一次：cache key -> 第一個 tool_call
+
+        for tool_call in msg.tool_calls:
+            name = tool_call.function.name
+            try:
+                args = json.loads(tool_call.function.arguments or "{}")
+            except json.JSONDecodeError:
+                args = {}
+
+            target_sess = session_map.get(name)
+
+            if target_sess:
+                key = ToolResultCache.make_key(name, args)
+                cached = tool_cache.get(key)
+                table_text = segment_answer(args) if name == "comparing_agent" and cached is None else None
+                if table_text is not None:
+                    emit("tool_result", {"tool": name, "ok": True, "source": "segment_table"})
+                    tool_outputs.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "name": name,
+                        "content": table_text
+                    })
+                elif cached is not None:
+                    tool_cache.log_suppressed(name, "同一對話已呼叫過")
+                    emit("tool_result", {"tool": name, "ok": True, "cached": True})
+                    tool_outputs.append({
+                        "role": "tool",
+                        "tool_call_id": tool_call.id,
+                        "name": name,
+                        "content": cached
+                    })
+                elif key in pending:
+                    tool_cache.log_suppressed(name, "同一批重複")
+                    tasks.append((tool_call, key, None))
+                else:
+                    # 呼叫 MCP Agent (Router 工具名稱不一定等於 Agent 的 MCP tool 名稱)
+                    remote_tool = AGENT_REGISTRY.get(name, (None, name))[1]
+                    pending[key] = tool_call
+                    tasks.append((tool_call, key, target_sess.call_tool(remote_tool, arguments=args)))
+            else:
+                emit("tool_result", {"tool": name, "ok": False, "error": "找不到對應的連線"})
+                tool_outputs.append({
+                    "role": "tool",
+                    "tool_call_id": tool_call.id,
+                    "name": name,
+                    "content": json.dumps({"error": "Agent connection not found"})
+                })
+
+        # 並行執行所有任務
+        if tasks:
+            calls = [t for t in tasks if t[2] is not None]
+            emit("dispatch", {"tools": [t[0].function.name for t in calls]})
+            mcp_results = await asyncio.gather(*[t[2] for t in calls], return_exceptions=True)
+            results_by_key = {key: res for (_call, key, _coro), res in zip(calls, mcp_results)}
+
+            for original_tool_call, key, coro in tasks:
+                tool_name = original_tool_call.function.name
+                mcp_res = results_by_key[key]
+
+                if isinstance(mcp_res, Exception):
+                    content_str = json.dumps({"error": str(mcp_res)})
+                    emit("tool_result", {"tool": tool_name, "ok": False, "error": str(mcp_res)})
+                elif _is_tool_error(mcp_res):
+                    content_str = _tool_result_text(mcp_res)
+                    emit("tool_result", {"tool": tool_name, "ok": False, "error": content_str})
+                else:
+                    content_str = _tool_result_text(mcp_res)
+                    emit("tool_result", {"tool": tool_name, "ok": True, "cached": coro is None})
+                    if coro is not None:
+                        tool_cache.put(key, content_str)
+
+                # 將結果存入列表
+                tool_outputs.append({
+                    "role": "tool",
+                    "tool_call_id": original_tool_call.id,
+                    "name": tool_name,
+                    "content": content_str
+                })
+
+        # 將 Tool Outputs 塞回 messages，讓迴圈跑下一輪，模型會看到結果並決定下一步
+        messages.extend(tool_outputs)
+
+
+# ==========================================
+# 7. 主程式：聊天迴圈 (單一使用者 CLI)
 # ==========================================
 
 async def chat() -> None:
@@ -204,41 +602,12 @@ async def chat() -> None:
 
     async with AsyncExitStack() as stack:
         try:
-            # --- A. 建立多重連線 ---
-            
-            # 1. Product Agent
-            r_prod, w_prod = await stack.enter_async_context(stdio_client(PRODUCT_SERVER_PARAMS))
-            sess_prod = await stack.enter_async_context(ClientSession(r_prod, w_prod))
-            await sess_prod.initialize()
-            print("✅ [System] Product Agent 已連線")
-
-            # 2. Comparing Agent
-            r_adv, w_adv = await stack.enter_async_context(stdio_client(ADVISOR_SERVER_PARAMS))
-            sess_adv = await stack.enter_async_context(ClientSession(r_adv, w_adv))
-            await sess_adv.initialize()
-            print("✅ [System] Comparing Agent 已連線")
-            
-            # 3. Demand Agent
-            r_dem, w_dem = await stack.enter_async_context(stdio_client(DEMAND_SERVER_PARAMS))
-            sess_dem = await stack.enter_async_context(ClientSession(r_dem, w_dem))
-            await sess_dem.initialize()
-            print("✅ [System] Demand Agent 已連線")
-             # 4. Eligibility Agent
-            r_eli, w_eli = await stack.enter_async_context(stdio_client(ELIGIBILITY_SERVER_PARAMS))
-            sess_eli = await stack.enter_async_context(ClientSession(r_eli, w_eli))
-            await sess_eli.initialize()
-            print("✅ [System] Eligibility Agent 已連線")
+            # --- A. 建立多重連線 + 路由對照表 ---
+            session_map = await connect_agents(stack)
+            tool_cache = ToolResultCache()  # 這個對話的工具結果快取
             print("🚀 系統準備就緒！(輸入 'q' 離開)")
 
-            # --- B. 建立路由對照表 ---
-            SESSION_MAP = {
-                "product_agent": sess_prod,
-                "comparing_agent": sess_adv,
-                "demand_agent": sess_dem,
-                "eligibility_agent": sess_eli
-            }
-
-            # --- C. 對話主迴圈 (User Loop) ---
+            # --- B. 對話主迴圈 (User Loop) ---
             while True:
                 user_input = input("\n👤 (你): ").strip()
                 if user_input.lower() in ['quit', 'exit', 'q']:
@@ -249,88 +618,8 @@ async def chat() -> None:
 
                 messages.append({"role": "user", "content": user_input})
 
-                # === D. 內部派單迴圈 (Agent Loop) ===
-                # 這裡使用了 while True，讓 Router 可以連續呼叫多次工具
-                while True:
-                    print("🤔 [Router] 思考下一步...", end="\r")
-                    
-                    try:
-                        response = client.chat.completions.create(
-                            model=GEMINI_MODEL,
-                            messages=messages,
-                            tools=tool_schemas,
-                            tool_choice="auto",
-                        )
-                    except Exception as e:
-                        print(f"\n❌ LLM 呼叫錯誤: {e}")
-                        break
-
-                    msg = response.choices[0].message
-                    messages.append(msg) # 將模型的決策加入歷史紀錄
-
-                    # 1. 如果模型回傳了文字 (Content)，代表它想說話了 -> 顯示並跳出內部迴圈
-                    if msg.content:
-                        print(f"\n💬 (總管): {msg.content}")
-                        break 
-
-                    # 2. 如果模型想呼叫工具 (Tool Calls)
-                    if msg.tool_calls:
-                        print(f"\n⚡ [Router] 偵測到 {len(msg.tool_calls)} 個分派任務：")
-                        
-                        tasks = []       
-                        tool_outputs = []
-
-                        for tool_call in msg.tool_calls:
-                            name = tool_call.function.name
-                            args = json.loads(tool_call.function.arguments)
-                            
-                            target_sess = SESSION_MAP.get(name)
-                            
-                            if target_sess:
-                                print(f"   -> 派單給: {name}")
-                                # 呼叫 MCP Agent
-                                task = target_sess.call_tool(name, arguments=args)
-                                tasks.append((tool_call, task))
-                            else:
-                                print(f"   ❌ 錯誤: 找不到 {name} 對應的連線")
-                                tool_outputs.append({
-                                    "role": "tool",
-                                    "tool_call_id": tool_call.id,
-                                    "name": name,
-                                    "content": json.dumps({"error": "Agent connection not found"})
-                                })
-
-                        # 並行執行所有任務
-                        if tasks:
-                            print("⏳ [System] 等待 Agents 回覆中...")
-                            mcp_results = await asyncio.gather(*[t[1] for t in tasks], return_exceptions=True)
-                            
-                            for i, mcp_res in enumerate(mcp_results):
-                                original_tool_call = tasks[i][0]
-                                tool_name = original_tool_call.function.name
-                                
-                                content_str = ""
-                                if isinstance(mcp_res, Exception):
-                                    content_str = json.dumps({"error": str(mcp_res)})
-                                    print(f"   ❌ {tool_name} 執行失敗: {mcp_res}")
-                                else:
-                                    # 兼容 TextContent 或直接字串
-                                    if hasattr(mcp_res, 'content') and mcp_res.content and hasattr(mcp_res.content[0], 'text'):
-                                        content_str = mcp_res.content[0].text
-                                    else:
-                                        content_str = str(mcp_res)
-                                    print(f"   ✅ {tool_name} 回覆完成")
-
-                                # 將結果存入列表
-                                tool_outputs.append({
-                                    "role": "tool",
-                                    "tool_call_id": original_tool_call.id,
-                                    "name": tool_name,
-                                    "content": content_str
-                                })
-
-                        # 將 Tool Outputs 塞回 messages，讓迴圈跑下一輪，模型會看到結果並決定下一步
-                        messages.extend(tool_outputs)
+                # === C. 內部派單迴圈 (Agent Loop) ===
+                await run_dispatch_turn(messages, session_map, tool_cache=tool_cache)
 
         except Exception as e:
             print(f"❌ [System] 連線建立失敗: {e}")
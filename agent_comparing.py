@@ -3,8 +3,13 @@ import os
 import sys
 import json
 import asyncio
+import uuid
 from pathlib import Path
 
+from startup_profile import StartupClock
+
+startup = StartupClock("comparing")  # 冷啟動各階段耗時 (comparing_agent_stats 的 "startup")
+
 # 3rd party imports
 from mcp.server.fastmcp import FastMCP
 from dotenv import load_dotenv
@@ -13,7 +18,9 @@ from openai import OpenAI
 # === [重要] 導入你的 RAG 搜尋工具 ===
 # 確保 rag_search.py, llm_utils.py 和 cards_rag_embedded.jsonl 在同一目錄下
 try:
-    from rag_search import search_chunks, load_index
+    from rag_search import cache_stats, end_session, search_chunks_async, warm_up
+    from admission import AdmissionController, AdmissionRejected
+    import single_flight
 except ImportError:
     print("❌ 找不到 rag_search.py，請確認檔案位置。", file=sys.stderr)
     sys.exit(1)
@@ -43,26 +50,29 @@ except Exception as e:
     print(f"❌ Gemini Client 初始化失敗: {e}", file=sys.stderr)
     llm_client = None
 
-# [重要] 預先載入 RAG 資料庫
-# 這會觸發 llm_utils 載入 Embedding 模型 (BGE-M3)，確保後續搜尋速度
-print("📚 正在初始化 RAG 知識庫...", file=sys.stderr)
-try:
-    load_index()
-    print("✅ RAG 知識庫載入完成！", file=sys.stderr)
-except Exception as e:
-    print(f"❌ RAG 載入失敗: {e}", file=sys.stderr)
+# [重要] RAG 資料庫 (BGE-M3 模型 + 索引) 在服務啟動後由 warm_up() 背景載入：
+# 以前在這裡同步載入，MCP 的 initialize 要等好幾秒才回應
 
 # 建立 MCP Server
-mcp = FastMCP("comparing-expert-agent")
+# --http 模式 (streamable-HTTP) 的位址；stdio 模式不會用到
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("COMPARING_AGENT_PORT", "8102"))
+
+mcp = FastMCP("comparing-expert-agent", host=MCP_HOST, port=MCP_PORT)
+
+# 准入控制：限制同時處理的請求數，排隊滿了就快速拒絕
+admission = AdmissionController.from_env("comparing")
+startup.mark("module_loaded")
 
 # ==========================================
 # 2. 定義真實工具 (Real Tools)
 # ==========================================
 
-async def tool_search_bank_info(query: str, card_filter: str = None) -> str:
+async def tool_search_bank_info(query: str, card_filter: str = None, session_id: str = None) -> str:
     """
     搜尋銀行產品、權益或信用卡相關資訊。
     這是 Agent 唯一獲取外部知識的管道。
+    session_id 是這次 ReAct loop 的識別碼，同一輪已經查到過的 chunk 只會回傳引用。
     """
     print(f"    🔎 [RAG Search] 搜尋: {query} | 過濾卡片: {card_filter}", file=sys.stderr)
     metadata = {
@@ -70,28 +80,22 @@ async def tool_search_bank_info(query: str, card_filter: str = None) -> str:
     }
    
     # [關鍵優化]
-    # search_chunks 內部會執行 Embedding 運算 (CPU/GPU 密集)
-    # 必須使用 asyncio.to_thread 放到背景執行，否則會卡死整個 Agent
+    # 檢索內部會執行 Embedding 運算 (CPU/GPU 密集)
+    # search_chunks_async 會把它放到背景 thread，資料庫查詢 (pgvector) 走 asyncpg，否則會卡死整個 Agent
     try:
-        results = search_chunks(
+        results = await search_chunks_async(
             query=query, 
             top_k=5,  # 取前 5 筆最相關
-            metadata_filter = metadata
+            metadata_filter = metadata,
+            session_id=session_id,
+            mmr=True,  # 比較多張卡時，避免 5 筆都是同一個方案的重複段落
         )
         
         if not results:
             return json.dumps({"result": "查無相關資料，請嘗試更換關鍵字。"})
 
-        # 整理回傳結果 (精簡化以節省 Token)
-        simplified_results = []
-        for r in results:
-            simplified_results.append({
-                "card": r.get("card_name", "未知卡片"),
-                "type": r.get("doc_type", "一般資訊"),
-                "content": r.get("text", "")
-            })
-            
-        return json.dumps(simplified_results, ensure_ascii=False)
+        # 整理回傳結果 (精簡 JSON 以節省 Token：id / card / type / content)
+        return results.to_json()
 
     except Exception as e:
         error_msg = f"搜尋執行錯誤: {str(e)}"
@@ -144,14 +148,17 @@ COMPARING_SYSTEM_PROMPT = """
 # 4. REACT LOOP (核心邏輯)
 # ==========================================
 
-async def _generate_response(user_query: str, user_profile: str = "") -> str:
+async def _generate_response(user_query: str, user_profile: str = "", prefetched_context: str = "") -> str:
     if not llm_client:
-        return "❌ 系統錯誤：LLM client 未初始化"
+        return json.dumps({"error": "llm_unavailable", "message": "系統錯誤：LLM client 未初始化"}, ensure_ascii=False)
 
     # 建構對話歷史
     full_query = user_query
     if user_profile:
         full_query = f"使用者背景：{user_profile}\n使用者問題：{user_query}"
+    if prefetched_context:
+        # Dispatcher 預先並行檢索的資料；足夠的話可以省下第一輪搜尋
+        full_query += f"\n\n以下是系統預先檢索的卡片資料（可直接引用，不足時再用工具搜尋）：\n{prefetched_context}"
 
     messages = [
         {"role": "system", "content": COMPARING_SYSTEM_PROMPT},
@@ -160,13 +167,17 @@ async def _generate_response(user_query: str, user_profile: str = "") -> str:
 
     MAX_TURNS = 5
     turn = 0
+    search_session = uuid.uuid4().hex  # 這次 ReAct loop 的 RAG session (重複的 chunk 只引用)
 
     try:
         while turn < MAX_TURNS:
             turn += 1
 
             # 1. 呼叫 LLM
-            response = llm_client.chat.completions.create(
+            # 其他 session 同時送出一模一樣的請求時只呼叫一次 (single_flight)
+            response = await asyncio.to_thread(
+                single_flight.coalesced_completion,
+                llm_client,
                 model=GEMINI_MODEL,
                 messages=messages,
                 tools=INTERNAL_TOOLS_SCHEMA,
@@ -187,7 +198,7 @@ async def _generate_response(user_query: str, user_profile: str = "") -> str:
                 
                 tool_result = ""
                 if fname == "tool_search_bank_info":
-                    tool_result = await tool_search_bank_info(**args)
+                    tool_result = await tool_search_bank_info(**args, session_id=search_session)
                 else:
                     tool_result = json.dumps({"error": "Unknown tool"})
 
@@ -199,20 +210,56 @@ async def _generate_response(user_query: str, user_profile: str = "") -> str:
                     "content": tool_result
                 })
 
-        return "⚠️ 抱歉，我思考太久了，無法提供完整答案。"
+        return json.dumps({"error": "max_turns", "message": "思考太久了，無法提供完整答案"}, ensure_ascii=False)
 
     except Exception as e:
-        return f"❌ Agent 執行發生錯誤: {e}"
+        # 失敗一律回傳錯誤 JSON：dispatcher 不會把它快取成這個問題的答案
+        return json.dumps({"error": "agent_error", "message": f"Agent 執行發生錯誤: {e}"}, ensure_ascii=False)
+    finally:
+        end_session(search_session)
 
 # ==========================================
 # 5. MCP Tool Entry & Local Test
 # ==========================================
 
 @mcp.tool()
-async def comparing_agent(user_query: str, user_profile: str = "") -> str:
+async def comparing_agent(user_query: str, user_profile: str = "", prefetched_context: str = "") -> str:
     """主要進入點：接收使用者問題，回傳比較或推薦結果"""
     print(f"⚖️ [Comparing Agent] 收到請求 | Query={user_query}", file=sys.stderr)
-    return await _generate_response(user_query, user_profile)
+    try:
+        async with admission.slot():
+            return await _generate_response(user_query, user_profile, prefetched_context)
+    except AdmissionRejected as e:
+        return e.to_json()
+
+
+PREFETCH_TOP_K = 8
+
+
+@mcp.tool()
+async def comparing_prefetch(user_query: str) -> str:
+    """
+    預先檢索：Dispatcher 在等 demand_agent 分析背景的同時呼叫，
+    先把推薦可能用到的卡片資料查好，之後再當 prefetched_context 傳回 comparing_agent。
+    只做檢索、不呼叫 LLM，所以不佔用 admission 名額。
+    """
+    print(f"⚖️ [Comparing Agent] 預先檢索 | Query={user_query}", file=sys.stderr)
+    results = await search_chunks_async(query=user_query, top_k=PREFETCH_TOP_K, mmr=True)
+    return results.to_markdown() if results else ""
+
+
+@mcp.tool()
+async def comparing_agent_stats() -> str:
+    """回傳比較推薦 Agent 目前的負載與排隊指標，以及 RAG 快取命中狀況 (JSON)"""
+    return json.dumps(
+        {
+            **admission.snapshot(),
+            "rag_cache": cache_stats(),
+            "startup": startup.snapshot(),
+            "single_flight": single_flight.stats(),
+        },
+        ensure_ascii=False,
+    )
 
 async def local_chat_loop():
     print("\n⚖️ --- Comparing Agent Local Mode (RAG Enabled) ---")
@@ -240,6 +287,14 @@ if __name__ == "__main__":
 
     if "--local" in sys.argv:
         asyncio.run(local_chat_loop())
+    elif "--http" in sys.argv:
+        # 長駐的 streamable-HTTP 服務，可以開多個副本給 dispatcher 做負載平衡
+        warm_up()  # 背景載入 embedding 模型與索引，不擋住服務啟動
+        startup.mark("serving")
+        print(f"⚖️ Comparing Agent Server starting (streamable-http) on http://{MCP_HOST}:{MCP_PORT}/mcp", file=sys.stderr)
+        mcp.run(transport="streamable-http")
     else:
         print("⚖️ Comparing Agent Server starting...", file=sys.stderr)
+        warm_up()
+        startup.mark("serving")
         mcp.run()
\ No newline at end of file
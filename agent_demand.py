@@ -4,13 +4,20 @@ import logging
 import sys
 import os
 
+from startup_profile import StartupClock
+
+startup = StartupClock("demand")  # 冷啟動各階段耗時 (demand_agent_stats 的 "startup")
+
 # 引入 MCP 相關套件
 from mcp.server import Server
 from mcp.server.stdio import stdio_server
 from mcp.types import Tool, TextContent, ImageContent, EmbeddedResource
 
 # 引入寫好的 LLM 工具 (確保 llm_utils.py 在同一個資料夾)
+# llm_utils 的 BGE-M3 模型是第一次呼叫 query_ai_embedding 才載入，這裡只用聊天，不會載入 torch
 from llm_utils import chat_with_aoai_gpt
+import single_flight
+from admission import AdmissionController, AdmissionRejected
 
 # 設定 Log (輸出到 stderr 以免干擾 MCP 通訊)
 logging.basicConfig(level=logging.INFO, stream=sys.stderr)
@@ -19,6 +26,10 @@ logger = logging.getLogger("agent_demand")
 # 建立 MCP Server
 app = Server("agent_demand")
 
+# 准入控制：限制同時處理的請求數，排隊滿了就快速拒絕
+admission = AdmissionController.from_env("demand")
+startup.mark("module_loaded")
+
 @app.list_tools()
 async def list_tools() -> list[Tool]:
     """定義這個 Agent 能做什麼"""
@@ -36,6 +47,11 @@ async def list_tools() -> list[Tool]:
                 },
                 "required": ["user_input"]
             }
+        ),
+        Tool(
+            name="demand_agent_stats",
+            description="回傳需求分析 Agent 目前的負載與排隊指標 (JSON)。",
+            inputSchema={"type": "object", "properties": {}}
         )
     ]
 
@@ -46,11 +62,19 @@ async def call_tool(name: str, arguments: dict) -> list[TextContent | ImageConte
         user_input = arguments.get("user_input", "")
         logger.info(f"收到分析請求: {user_input}")
         
-        # 執行分析邏輯
-        result_json = await analyze_logic(user_input)
+        # 執行分析邏輯 (超過同時處理上限且排隊已滿時，直接回傳 busy + retry_after)
+        try:
+            async with admission.slot():
+                result_json = await analyze_logic(user_input)
+        except AdmissionRejected as e:
+            return [TextContent(type="text", text=e.to_json())]
         
         # 回傳 JSON 字串給 Router
         return [TextContent(type="text", text=json.dumps(result_json, ensure_ascii=False))]
+
+    if name == "demand_agent_stats":
+        stats = {**admission.snapshot(), "startup": startup.snapshot(), "single_flight": single_flight.stats()}
+        return [TextContent(type="text", text=json.dumps(stats, ensure_ascii=False))]
     
     raise ValueError(f"Unknown tool: {name}")
 
@@ -83,7 +107,8 @@ async def analyze_logic(user_input: str) -> dict:
 
     # 呼叫 Gemini (使用 llm_utils)
     try:
-        response_text = chat_with_aoai_gpt(messages, use_json_format=True)
+        # chat_with_aoai_gpt 是同步呼叫，丟到 thread 才不會擋住其他請求
+        response_text = await asyncio.to_thread(chat_with_aoai_gpt, messages, use_json_format=True)
         profile = json.loads(response_text)
     except Exception as e:
         logger.error(f"LLM 解析失敗: {e}")
@@ -159,15 +184,43 @@ async def analyze_logic(user_input: str) -> dict:
 async def main():
     # 啟動 MCP Server (標準輸入輸出模式)
     async with stdio_server() as (read_stream, write_stream):
+        startup.mark("serving")
         await app.run(
             read_stream,
             write_stream,
             app.create_initialization_options()
         )
 
+def run_http():
+    """以長駐的 streamable-HTTP 服務啟動 (http://MCP_HOST:DEMAND_AGENT_PORT/mcp)，可開多個副本"""
+    import uvicorn
+    from contextlib import asynccontextmanager
+    from mcp.server.streamable_http_manager import StreamableHTTPSessionManager
+    from starlette.applications import Starlette
+    from starlette.routing import Mount
+
+    host = os.getenv("MCP_HOST", "0.0.0.0")
+    port = int(os.getenv("DEMAND_AGENT_PORT", "8103"))
+    session_manager = StreamableHTTPSessionManager(app=app)
+
+    async def handle_mcp(scope, receive, send):
+        await session_manager.handle_request(scope, receive, send)
+
+    @asynccontextmanager
+    async def lifespan(_app):
+        async with session_manager.run():
+            startup.mark("serving")  # 與 stdio 模式一樣記錄開始服務的時間
+            yield
+
+    print(f"正在啟動 Demand Agent (streamable-http) on http://{host}:{port}/mcp", file=sys.stderr)
+    uvicorn.run(Starlette(routes=[Mount("/mcp", app=handle_mcp)], lifespan=lifespan), host=host, port=port)
+
 if __name__ == "__main__":
-    print("正在啟動 Demand Agent...", file=sys.stderr)
-    try:
-        asyncio.run(main())
-    except KeyboardInterrupt:
-        pass
\ No newline at end of file
+    if "--http" in sys.argv:
+        run_http()
+    else:
+        print("正在啟動 Demand Agent...", file=sys.stderr)
+        try:
+            asyncio.run(main())
+        except KeyboardInterrupt:
+            pass
\ No newline at end of file
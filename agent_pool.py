@@ -0,0 +1,158 @@
+# agent_pool.py
+# Dispatcher 端的 Agent 副本池 (Replica Pool)
+#
+# Agent 以 `python agent_xxx.py --http` 跑成長駐的 streamable-HTTP MCP 服務後，
+# 同一種 Agent 可以在多台機器上開多個副本。ReplicaPool 對每個副本各維持一條 MCP 連線，並且：
+#   - 負載平衡：每次呼叫挑「目前未完成請求數最少」的健康副本 (least outstanding requests)
+#   - 健康檢查：定期 ping，失敗就標記為不健康、斷線後自動重連
+#   - 失敗轉移：呼叫中連線出錯時，換另一個健康副本重試一次
+#
+# ReplicaPool.call_tool() 與 mcp.ClientSession.call_tool() 介面相同，
+# 所以 agent_client.run_dispatch_turn 不需要知道背後是 stdio 子程序還是 HTTP 副本池。
+#
+# 設定方式 (agent_client.connect_agents 會讀)：
+#   COMPARING_AGENT_URLS="http://10.0.0.11:8102/mcp,http://10.0.0.12:8102/mcp"
+
+import asyncio
+import sys
+from typing import Any, Dict, List, Optional
+
+from mcp import ClientSession
+from mcp.client.streamable_http import streamablehttp_client
+from mcp.shared.exceptions import McpError
+
+HEALTH_CHECK_INTERVAL = 10.0  # 秒
+HEALTH_CHECK_TIMEOUT = 5.0
+RECONNECT_DELAY = 3.0
+
+
+class Replica:
+    """單一副本的連線狀態"""
+
+    def __init__(self, url: str):
+        self.url = url
+        self.session: Optional[ClientSession] = None
+        self.healthy = False
+        self.outstanding = 0   # 目前送出但還沒回來的請求數
+        self.served = 0
+        self.failures = 0
+        self._broken = asyncio.Event()
+
+    def mark_broken(self) -> None:
+        self.healthy = False
+        self._broken.set()
+
+
+class ReplicaPool:
+    def __init__(self, name: str, urls: List[str]):
+        self.name = name
+        self.replicas = [Replica(url) for url in urls]
+        self._tasks: List[asyncio.Task] = []
+        self._rr = 0  # 同分時輪流挑，避免永遠打同一台
+
+    # ---------- 連線管理 ----------
+    async def _run_replica(self, replica: Replica) -> None:
+        """
+        每個副本一個長駐 task：建立連線 -> 定期 ping -> 出錯就斷線重連。
+        連線的開啟與關閉都在同一個 task 內完成 (anyio 的 cancel scope 要求如此)。
+        """
+        while True:
+            try:
+                async with streamablehttp_client(replica.url) as (read, write, _get_session_id):
+                    async with ClientSession(read, write) as session:
+                        await session.initialize()
+                        replica.session = session
+                        replica.healthy = True
+                        replica._broken.clear()
+                        print(f"✅ [Pool] {self.name} 副本已連線: {replica.url}", file=sys.stderr)
+
+                        while not replica._broken.is_set():
+                            try:
+                                await asyncio.wait_for(replica._broken.wait(), timeout=HEALTH_CHECK_INTERVAL)
+                            except asyncio.TimeoutError:
+                                pass
+                            if replica._broken.is_set():
+                                break
+                            try:
+                                await asyncio.wait_for(session.send_ping(), timeout=HEALTH_CHECK_TIMEOUT)
+                                replica.healthy = True
+                            except Exception as e:
+                                print(f"⚠️ [Pool] {self.name} 健康檢查失敗 {replica.url}: {e}", file=sys.stderr)
+                                replica.mark_broken()
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                print(f"❌ [Pool] {self.name} 副本連線失敗 {replica.url}: {e}", file=sys.stderr)
+            finally:
+                replica.session = None
+                replica.healthy = False
+
+            await asyncio.sleep(RECONNECT_DELAY)
+
+    async def start(self, ready_timeout: float = 30.0) -> None:
+        """啟動所有副本的連線 task，等到至少一個副本可用 (或逾時) 才回傳"""
+        self._tasks = [asyncio.create_task(self._run_replica(r)) for r in self.replicas]
+
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + ready_timeout
+        while not any(r.healthy for r in self.replicas):
+            if loop.time() > deadline:
+                print(f"⚠️ [Pool] {self.name} 在 {ready_timeout:.0f}s 內沒有任何可用副本，將持續重試", file=sys.stderr)
+                return
+            await asyncio.sleep(0.2)
+
+    async def close(self) -> None:
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    # ---------- 負載平衡 ----------
+    def _pick(self, exclude: Optional[Replica] = None) -> Optional[Replica]:
+        candidates = [r for r in self.replicas if r.healthy and r.session is not None and r is not exclude]
+        if not candidates:
+            return None
+        self._rr = (self._rr + 1) % len(candidates)
+        rotated = candidates[self._rr:] + candidates[:self._rr]
+        return min(rotated, key=lambda r: r.outstanding)
+
+    async def call_tool(self, name: str, arguments: Dict[str, Any] | None = None):
+        """介面同 ClientSession.call_tool；挑負載最低的副本，連線出錯時換一台重試一次"""
+        replica = self._pick()
+        if replica is None:
+            raise RuntimeError(f"{self.name} 目前沒有可用的副本")
+
+        for attempt in range(2):
+            current = replica
+            current.outstanding += 1
+            try:
+                result = await current.session.call_tool(name, arguments=arguments)
+                current.served += 1
+                return result
+            except McpError:
+                # Agent 有回應、只是回了錯誤 (例如參數錯) -> 連線本身沒問題，不用換副本
+                raise
+            except Exception as e:
+                current.failures += 1
+                current.mark_broken()
+                replica = self._pick(exclude=current)
+                if attempt == 1 or replica is None:
+                    raise
+                print(f"⚠️ [Pool] {self.name} {current.url} 呼叫失敗 ({e})，改用 {replica.url}", file=sys.stderr)
+            finally:
+                current.outstanding -= 1
+
+    def stats(self) -> Dict[str, Any]:
+        return {
+            "agent": self.name,
+            "replicas": [
+                {
+                    "url": r.url,
+                    "healthy": r.healthy,
+                    "outstanding": r.outstanding,
+                    "served": r.served,
+                    "failures": r.failures,
+                }
+                for r in self.replicas
+            ],
+        }
@@ -2,8 +2,15 @@ import os
 import sys
 import json
 import asyncio
+import uuid
 
-from rag_search import search_chunks
+from startup_profile import StartupClock
+
+startup = StartupClock("product")  # 冷啟動各階段耗時 (product_agent_stats 的 "startup")
+
+from rag_search import cache_stats, end_session, search_chunks_async, warm_up
+from admission import AdmissionController, AdmissionRejected
+import single_flight
 from mcp.server.fastmcp import FastMCP
 from dotenv import load_dotenv
 from openai import OpenAI  # ✅ 改成使用 OpenAI client（指向 Gemini 相容端點）
@@ -33,7 +40,15 @@ except Exception as e:
     print(f"❌ Gemini Client 初始化失敗: {e}", file=sys.stderr)
     llm_client = None
 
-mcp = FastMCP("product-expert-agent")
+# --http 模式 (streamable-HTTP) 的位址；stdio 模式不會用到
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("PRODUCT_AGENT_PORT", "8101"))
+
+mcp = FastMCP("product-expert-agent", host=MCP_HOST, port=MCP_PORT)
+
+# 准入控制：限制同時處理的請求數，排隊滿了就快速拒絕
+admission = AdmissionController.from_env("product")
+startup.mark("module_loaded")
 
 # ==========================================
 # 2. 定義內部工具 (Internal Tools)
@@ -41,10 +56,12 @@ mcp = FastMCP("product-expert-agent")
 async def tool_rag_search_product(
     user_query: str,
     card_name: str | None = None,
-    top_k: int = 5
+    top_k: int = 5,
+    session_id: str | None = None,
 ) -> str:
     """
     用 RAG 查詢信用卡產品資訊，回傳相關 chunks。
+    session_id 是這次 ReAct loop 的識別碼，同一輪已經查到過的 chunk 只會回傳引用。
     """
     print(
         f"   ⚙️ [Internal Tool] RAG search | q={user_query}, card={card_name}",
@@ -52,19 +69,20 @@ async def tool_rag_search_product(
     )
 
     my_metadata = {
-    "card_name": card_name,
-    "doc_type": doc_type
-}
-     # 確保用的是你現在有 card_filter 的版本
+        "card_name": card_name,
+    }
 
-    results = search_chunks(
+    # embedding (CPU 密集) 在 thread 裡做；pgvector 後端的資料庫查詢走 asyncpg，不會卡住其他請求
+    results = await search_chunks_async(
         query=user_query,
-        top_k=effective_top_k,
-        metadata_filter=my_metadata
+        top_k=top_k,
+        metadata_filter=my_metadata,
+        session_id=session_id,
     )
 
-    print(results)
-    return results 
+    if not results:
+        return json.dumps({"result": "查無相關資料，請嘗試更換關鍵字或卡片名稱。"}, ensure_ascii=False)
+    return results.to_markdown()
 
 
 async def tool_calculate_installment(amount: int, months: int) -> str:
@@ -156,7 +174,7 @@ PRODUCT_SYSTEM_PROMPT = """
 # ==========================================
 async def _generate_response(user_query: str) -> str:
     if not llm_client:
-        return "❌ 系統錯誤：LLM client 未初始化。"
+        return json.dumps({"error": "llm_unavailable", "message": "系統錯誤：LLM client 未初始化"}, ensure_ascii=False)
 
     messages = [
         {"role": "system", "content": PRODUCT_SYSTEM_PROMPT},
@@ -165,13 +183,17 @@ async def _generate_response(user_query: str) -> str:
 
     MAX_TURNS = 5
     current_turn = 0
+    search_session = uuid.uuid4().hex  # 這次 ReAct loop 的 RAG session (重複的 chunk 只引用)
 
     try:
         while current_turn < MAX_TURNS:
             current_turn += 1
             
             # 1. 呼叫 LLM（Gemini OpenAI-compatible）
-            response = llm_client.chat.completions.create(
+            # 其他 session 同時送出一模一樣的請求 (例如同一個熱門問題的第一輪) 時只呼叫一次
+            response = await asyncio.to_thread(
+                single_flight.coalesced_completion,
+                llm_client,
                 model=GEMINI_MODEL,
                 messages=messages,
                 tools=INTERNAL_TOOLS_SCHEMA,
@@ -192,7 +214,7 @@ async def _generate_response(user_query: str) -> str:
                 result_content = ""
                 
                 if func_name == "tool_rag_search_product":
-                    result_content = await tool_rag_search_product(**args)
+                    result_content = await tool_rag_search_product(**args, session_id=search_session)
                 elif func_name == "tool_calculate_installment":
                     result_content = await tool_calculate_installment(**args)
                 else:
@@ -206,10 +228,13 @@ async def _generate_response(user_query: str) -> str:
                     "content": str(result_content)
                 })
             
-        return "思考次數過多，無法產生完整回答。"
+        return json.dumps({"error": "max_turns", "message": "思考次數過多，無法產生完整回答"}, ensure_ascii=False)
 
     except Exception as e:
-        return f"Agent 執行發生錯誤: {str(e)}"
+        # 失敗一律回傳錯誤 JSON：dispatcher 不會把它快取成這個問題的答案
+        return json.dumps({"error": "agent_error", "message": f"Agent 執行發生錯誤: {e}"}, ensure_ascii=False)
+    finally:
+        end_session(search_session)
 
 # ==========================================
 # MCP 介面層
@@ -218,7 +243,25 @@ async def _generate_response(user_query: str) -> str:
 async def product_agent(user_query: str) -> str:
     """【產品專家入口】接收使用者的問題，透過 LLM 與內部工具生成產品資訊。"""
     print(f"💳 [Product Agent] 收到請求 (MCP) | Query: {user_query}", file=sys.stderr)
-    return await _generate_response(user_query)
+    try:
+        async with admission.slot():
+            return await _generate_response(user_query)
+    except AdmissionRejected as e:
+        return e.to_json()
+
+
+@mcp.tool()
+async def product_agent_stats() -> str:
+    """回傳產品專家 Agent 目前的負載與排隊指標，以及 RAG 快取命中狀況 (JSON)"""
+    return json.dumps(
+        {
+            **admission.snapshot(),
+            "rag_cache": cache_stats(),
+            "startup": startup.snapshot(),
+            "single_flight": single_flight.stats(),
+        },
+        ensure_ascii=False,
+    )
 
 # ==========================================
 # Local 測試層
@@ -252,6 +295,14 @@ if __name__ == "__main__":
         if sys.platform.startswith('win'):
              asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
         asyncio.run(local_chat_loop())
+    elif "--http" in sys.argv:
+        # 長駐的 streamable-HTTP 服務，可以開多個副本給 dispatcher 做負載平衡
+        warm_up()  # 背景載入 embedding 模型與索引，不擋住服務啟動
+        startup.mark("serving")
+        print(f"💳 Product Agent Server starting (streamable-http) on http://{MCP_HOST}:{MCP_PORT}/mcp", file=sys.stderr)
+        mcp.run(transport="streamable-http")
     else:
         print("💳 Product Agent Server starting...", file=sys.stderr)
+        warm_up()
+        startup.mark("serving")
         mcp.run()
\ No newline at end of file
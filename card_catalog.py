@@ -0,0 +1,151 @@
+# card_catalog.py
+# 從 RAG 語料 (cards_rag.jsonl) 整理出每張卡的結構化申辦條件與適合族群
+#
+# credit_card_profile chunk 的 metadata.raw 保留了原始 JSON，裡面有年收入門檻、年齡、現職年資、附加條件等欄位，
+# 只是各卡的欄位名稱不一致 (income_requirement / eligibility.income_requirement ...)。
+# 這裡統一解析成固定欄位，給不需要 LLM 的推薦表 (segment_table.py) 與規則判斷使用：
+#
+#   catalog = load_catalog("cards_rag.jsonl")
+#   catalog["國泰CUBE卡"]["min_income"]        # 200000
+#   card_chunks(records, "國泰亞洲萬里通聯名卡白金卡")   # 白金卡自己的 chunk + 整個亞洲萬里通系列共用的 chunk
+#   mentioned_cards("CUBE卡適合網購嗎")                 # ["國泰CUBE卡"]：問題裡有點名特定卡片
+
+import json
+import re
+from typing import Any, Dict, Iterator, List, Optional, Set
+
+DEFAULT_JSONL = "cards_rag.jsonl"
+ADULT_AGE = 18
+
+_AMOUNT_RE = re.compile(r"NT\$\s*([\d,]+)")
+_WAN_RE = re.compile(r"(\d+(?:\.\d+)?)\s*萬")
+_AGE_RE = re.compile(r"年滿\s*(\d+)\s*歲")
+_ISSUER_PREFIXES = ("國泰世華", "國泰")
+
+_aliases: Optional[Dict[str, Set[str]]] = None
+
+
+def iter_records(jsonl_path: str = DEFAULT_JSONL) -> Iterator[Dict[str, Any]]:
+    with open(jsonl_path, "r", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def parse_amount(text: Optional[str]) -> Optional[int]:
+    """'年收入達 NT$2,000,000' / '年收入 200 萬' -> 2000000；找不到金額回傳 None"""
+    if not text:
+        return None
+    match = _AMOUNT_RE.search(text)
+    if match:
+        return int(match.group(1).replace(",", ""))
+    match = _WAN_RE.search(text)
+    if match:
+        return int(float(match.group(1)) * 10000)
+    return None
+
+
+def _as_list(value: Any) -> List[str]:
+    if not value:
+        return []
+    return [str(v) for v in value] if isinstance(value, list) else [str(value)]
+
+
+def parse_profile(record: Dict[str, Any]) -> Dict[str, Any]:
+    """credit_card_profile record -> 結構化的卡片資料"""
+    raw = (record.get("metadata") or {}).get("raw") or {}
+    eligibility = raw.get("eligibility") or {}
+    requirement_texts = [
+        t for t in (
+            raw.get("income_requirement"),
+            eligibility.get("income_requirement"),
+            eligibility.get("age"),
+            eligibility.get("employment"),
+        ) if t
+    ]
+    requirements = "；".join(requirement_texts)
+
+    age_match = _AGE_RE.search(requirements)
+    min_age = int(age_match.group(1)) if age_match else (ADULT_AGE if "成年" in requirements else None)
+
+    annual_fee = raw.get("annual_fee")
+    if isinstance(annual_fee, dict):
+        annual_fee = annual_fee.get("primary")
+
+    return {
+        "card_name": record["card_name"],
+        "profile_id": str(record["id"]),
+        "issuer": record.get("issuer"),
+        "min_income": parse_amount(raw.get("income_requirement") or eligibility.get("income_requirement")),
+        "min_age": min_age,
+        "needs_employment": bool(re.search(r"現職(需)?滿", requirements)),
+        "requirements": requirements,
+        "extra_requirements": _as_list(raw.get("extra_requirements")),
+        "annual_fee": annual_fee,
+        "annual_fee_amount": parse_amount(annual_fee),
+        "apply_difficulty": raw.get("apply_difficulty"),
+        # 比對消費習慣用的文字：適合族群、最適合的用途、定位
+        "fit_text": " ".join(
+            _as_list(raw.get("target_users")) + _as_list(raw.get("best_for"))
+            + _as_list(raw.get("user_segments")) + _as_list(raw.get("positioning"))
+        ),
+    }
+
+
+def load_catalog(jsonl_path: str = DEFAULT_JSONL) -> Dict[str, Dict[str, Any]]:
+    """{卡名: 結構化卡片資料}，依語料中出現的順序"""
+    return {
+        record["card_name"]: parse_profile(record)
+        for record in iter_records(jsonl_path)
+        if record.get("doc_type") == "credit_card_profile"
+    }
+
+
+def card_chunks(records: List[Dict[str, Any]], card_name: str) -> List[Dict[str, Any]]:
+    """
+    某張卡相關的 chunk：卡名相同，或 chunk 的卡名是它的系列名稱
+    (例如「國泰亞洲萬里通聯名卡」的權益方案適用於白金卡 / 世界卡 ... 各等級)
+    """
+    return [r for r in records if r.get("card_name") and card_name.startswith(r["card_name"])]
+
+
+def card_aliases(card_name: str) -> Set[str]:
+    """
+    使用者提到這張卡時可能的說法 (小寫、不含空白)：全名、去掉銀行名、「系列名 + 卡」、等級名，以及英文卡名本身。
+    「蝦皮」這種同時也是消費習慣的字不算 (別名都要帶「卡」，或是夠長的系列名)。
+    """
+    core = card_name
+    for prefix in _ISSUER_PREFIXES:
+        if core.startswith(prefix):
+            core = core[len(prefix):]
+            break
+    aliases = {card_name, core}
+    if "聯名卡" in core:
+        series, tier = core.split("聯名卡", 1)
+        series = series.removesuffix("購物")
+        aliases.update({series + "卡", series + "聯名卡"})
+        if len(series) >= 4:
+            aliases.add(series)  # 亞洲萬里通
+        if tier:
+            aliases.add(tier)  # 白金卡 / 世界卡 / 鈦金商務卡
+    else:
+        base = core.removesuffix("卡")
+        if base.isascii() and len(base) >= 3:
+            aliases.add(base)  # CUBE
+    return {a.lower().replace(" ", "") for a in aliases if len(a) >= 3}
+
+
+def mentioned_cards(text: str, catalog: Optional[Dict[str, Dict[str, Any]]] = None) -> List[str]:
+    """問題裡點名的卡片 (依語料順序)；沒有語料檔時回傳空 list"""
+    global _aliases
+    if catalog is not None:
+        aliases = {name: card_aliases(name) for name in catalog}
+    else:
+        if _aliases is None:
+            try:
+                _aliases = {name: card_aliases(name) for name in load_catalog()}
+            except OSError:
+                _aliases = {}
+        aliases = _aliases
+    normalized = text.lower().replace(" ", "")
+    return [name for name, words in aliases.items() if any(w in normalized for w in words)]
@@ -1,136 +1,255 @@
-import psycopg2
+# connect_database.py
+# PostgreSQL 非同步存取層 (asyncpg)
+#
+# 原本的 _connect_db 每次查詢都用 psycopg2 重新連線、把向量用字串拼進 SQL，而且是同步呼叫；
+# 放在 Agent 的 async handler 裡會卡住整個 event loop。這裡改成：
+#   - asyncpg 連線池 (每個 event loop 一個)，連線建立時註冊 pgvector / jsonb 型別
+#   - 相似度查詢用 $n 參數，filter 條件依 key 排序產生固定的 SQL 文字，
+#     asyncpg 會在每條連線上快取 prepared statement (常用的無 filter 查詢在連線建立時就先 prepare)
+#   - 批次寫入用 COPY 到暫存表，再 INSERT ... ON CONFLICT 一次 upsert (內容沒變的列不更新，HNSW 不用重排)
+#
+# 資料表結構與 pgvector_store.py 相同 (schema_statements)。
+#
+# 用法：
+#   store = await get_store()                              # 依 RAG_PG_DSN / DB_CONNECTION_STRING 建立 (只建一次)
+#   rows = await store.search(query_vector, k=5, metadata_filter={"card_name": "國泰CUBE卡"})
+#   await store.copy_upsert(documents, vectors, replace=True)   # ingest.py --pg-dsn 會呼叫
+#   await store.version()                                  # 資料版本 (rag_search 的結果快取 key 用)
 
-def _connect_db(connection_string):
-    """連接到 PostgreSQL 數據庫，失敗時自動重試直到成功"""
+import asyncio
+import json
+import sys
+import time
+from typing import Any, Dict, List, Optional, Sequence, Tuple
+
+import asyncpg
+import numpy as np
+from pgvector.asyncpg import register_vector
+
+from pgvector_store import (
+    COLUMN_KEYS,
+    EMBEDDING_DIM,
+    PG_DSN,
+    PG_EF_SEARCH,
+    PG_POOL_MAX,
+    PG_POOL_MIN,
+    PG_TABLE,
+    PG_VERSION_SECONDS,
+    VERSION_SQL,
+    schema_statements,
+    table_version,
+)
+
+DB_CONNECTION_STRING = PG_DSN
+COPY_BATCH_SIZE = 5000
+
+_stores: Dict[int, "AsyncChunkStore"] = {}   # event loop id -> store (asyncpg pool 不能跨 event loop 使用)
+_store_locks: Dict[int, asyncio.Lock] = {}
+
+
+def build_where(metadata_filter: Optional[Dict[str, Any]], first_param: int) -> Tuple[str, List[Any]]:
+    """
+    metadata filter -> (WHERE 子句, 參數)，語意同 pgvector_store.build_where (也就是 rag_search._matches_filter)。
+    key 依字母排序，同樣形狀的 filter 產生同樣的 SQL 文字，才會命中 prepared statement 快取。
+    """
+    if not metadata_filter:
+        return "", []
+
+    clauses: List[str] = []
+    params: List[Any] = []
+
+    def param(value: Any) -> str:
+        params.append(value)
+        return f"${first_param + len(params) - 1}"
+
+    for key in sorted(metadata_filter):
+        expected = metadata_filter[key]
+        if key in COLUMN_KEYS:
+            if isinstance(expected, list):
+                clauses.append(f"{key} = ANY({param([str(v) for v in expected])}::text[])")
+            else:
+                clauses.append(f"{key} = {param(str(expected))}::text")
+        elif isinstance(expected, list):
+            values, k = param(expected), param(key)
+            clauses.append(
+                f"EXISTS (SELECT 1 FROM jsonb_array_elements({values}::jsonb) AS w(v) "
+                f"WHERE metadata -> {k}::text = w.v OR metadata -> {k}::text @> jsonb_build_array(w.v))"
+            )
+        else:
+            k, value, wrapped = param(key), param(expected), param([expected])
+            clauses.append(f"(metadata -> {k}::text = {value}::jsonb OR metadata -> {k}::text @> {wrapped}::jsonb)")
+    return " WHERE " + " AND ".join(clauses), params
+
+
+async def _prepare_database(dsn: str, ef_search: int) -> Dict[str, str]:
+    """
+    建連線池之前先用一條一般連線：
+      1. CREATE EXTENSION vector：pool 的 init 會 register_vector，全新的資料庫沒有 vector 型別時每條連線都會失敗，
+         ingest.py --pg-dsn 就走不到 ensure_schema
+      2. 決定 HNSW 查詢參數，回傳給連線池的 server_settings (連線啟動時就帶入的 session 預設值)。
+         不能在 init 裡 SET：pool 每次歸還連線都會 RESET ALL，SET 的值只撐到第一次查詢；server_settings 在 RESET 後仍然有效。
+         iterative_scan 只有 pgvector 0.8+ 認得，先試過再決定要不要帶 (帶了不認得的參數會連不上)。
+    """
+    settings = {"hnsw.ef_search": str(int(ef_search))}
+    conn = await asyncpg.connect(dsn)
     try:
-        conn = psycopg2.connect(connection_string)
-        return conn
-    except Exception as e:
-        print(f"資料庫連接失敗: {e}")
-        return None
-
-# 查詢 新聞資料表 (ntn001rtnews)
-# def query_news(connection_string, company_id, company_name, embedded_query):
-    # search_count=15     # 取出的資料數
-    # days=30             # 最早的資料時間
-    # max_retries = 3     # 最大重試次數
-    
-    # for attempt in range(max_retries):
-    #     conn = None
-    #     cursor = None
-    #     try:
-    #         # 嘗試建立資料庫連線
-    #         conn = _connect_db(connection_string)
-    #         if conn is None:
-    #             continue  # 如果連線失敗，進入下一次重試
-
-    #         # 創建 cursor
-    #         cursor = conn.cursor()
-
-    #         # 根據條件生成 SQL 查詢語句
-    #         and_date = f" AND datetime >= NOW() - INTERVAL '{days} DAYS' "
-    #         embedded_query_pg = "[" + ",".join(map(str, embedded_query)) + "]"
-    #         query_sql = ""
-
-    #         if (
-    #         company_id
-    #         and company_name
-    #         and len(company_id) > 0
-    #         and len(company_name) > 0
-    #         ):
-    #         # 簡化一下 只拿 Story 讓學生自己拿 個股
-    #             query_sql = f"""
-    #                 SELECT headline, story
-    #                 FROM ntn001rtnews
-    #                 WHERE stock_code LIKE '%{company_id}%' {and_date}
-    #                 ORDER BY story_vector <-> '{embedded_query_pg}'::VECTOR(1536)
-    #                 LIMIT {search_count};
-    #             """
-    #         else:
-    #             query_sql = f"""
-    #                 SELECT headline, story                    
-    #                 FROM ntn001rtnews
-    #                 WHERE datetime >= NOW() - INTERVAL '{days} DAYS'
-    #                 ORDER BY story_vector <-> '{embedded_query_pg}'::VECTOR(1536)
-    #                 LIMIT {search_count};
-    #             """
-    #         # 如果查詢語句為空，返回空列表
-    #         if len(query_sql) == 0:
-    #             return []
-    #         else:
-    #             # 執行查詢
-    #             cursor.execute(query_sql)
-    #             data = cursor.fetchall()
-    #             column_names = [desc[0] for desc in cursor.description]
-    #             final_rows = [dict(zip(column_names, row)) for row in data]
-    #             return final_rows  # 成功查詢，返回結果
-    #     except (psycopg2.OperationalError, psycopg2.errors.QueryCanceled) as e:
-
-    #         # 捕獲 timeout 相關異常，記錄日誌
-    #         print(f"Timeout error on attempt {attempt + 1}: {e}")
-    #         if attempt == max_retries - 1:  # 如果是最後一次重試，拋出異常
-    #             raise
-    #         # 否則繼續下一次重試
-    #     finally:
-    #         # 確保資源被釋放
-    #         if cursor:
-    #             cursor.close()
-    #         if conn:
-    #             conn.close()
-
-
-    # max_retries = 3  # 最大重試次數
-    # for attempt in range(max_retries):
-    #     conn = None
-    #     cursor = None
-    #     try:
-    #         # 嘗試建立資料庫連線
-    #         conn = _connect_db(connection_string)
-    #         if conn is None:
-    #             continue  # 如果連線失敗，進入下一次重試
-
-    #         # 創建 cursor
-    #         cursor = conn.cursor()
-
-    #         # 根據條件生成 SQL 查詢語句
-    #         embedded_query_pg = "[" + ",".join(map(str, embedded_query)) + "]"
-    #         query_sql = ""
-
-    #         if (
-    #             company_id
-    #             and company_name
-    #             and len(company_id) > 0
-    #             and len(company_name) > 0
-    #         ):
-    #         # 簡化一下 只拿 Story 讓學生自己拿 個股
-    #             query_sql = f"""
-    #                 SELECT key1, pagehtml, l2_distance(pagehtml_vector,'{embedded_query_pg}'::VECTOR(1536)) AS similarity, updat
-    #                 FROM atimwjsonx
-    #                 WHERE key1 = '{company_id}' AND pagehtml LIKE '%{company_name}%' AND latest = 1
-    #                 ORDER BY pagehtml_vector <-> '{embedded_query_pg}'::VECTOR(1536)
-    #                 LIMIT 1;
-    #             """
-    #         # 如果查詢語句為空，返回空列表
-    #         if len(query_sql) == 0:
-    #             return []
-    #         else:
-    #             # 執行查詢
-    #             cursor.execute(query_sql)
-    #             data = cursor.fetchall()
-    #             column_names = [desc[0] for desc in cursor.description]
-    #             final_rows = [dict(zip(column_names, row)) for row in data]
-    #             return final_rows  # 成功查詢，返回結果
-
-    #     except (psycopg2.OperationalError, psycopg2.errors.QueryCanceled) as e:
-    #         # 捕獲 timeout 相關異常，記錄日誌
-    #         print(f"Timeout error on attempt {attempt + 1}: {e}")
-    #         if attempt == max_retries - 1:  # 如果是最後一次重試，拋出異常
-    #             raise
-    #         # 否則繼續下一次重試
-
-    #     finally:
-    #         # 確保資源被釋放
-    #         if cursor:
-    #             cursor.close()
-    #         if conn:
-    #             conn.close()
\ No newline at end of file
+        try:
+            await conn.execute("CREATE EXTENSION IF NOT EXISTS vector")
+        except asyncpg.PostgresError as e:
+            print(f"⚠️ 無法建立 pgvector extension (需要資料庫管理權限): {e}", file=sys.stderr)
+        try:
+            await conn.execute("SELECT '[1]'::vector")  # 先載入 pgvector，SET 才會檢查參數名稱 (否則只是 placeholder)
+            await conn.execute("SET hnsw.iterative_scan = relaxed_order")
+            settings["hnsw.iterative_scan"] = "relaxed_order"
+        except asyncpg.PostgresError:
+            pass  # pgvector 太舊
+    finally:
+        await conn.close()
+    return settings
+
+
+class AsyncChunkStore:
+    """pgvector chunk 表的非同步存取 (查詢 / 批次 upsert)"""
+
+    def __init__(self, pool: asyncpg.Pool, table: str = PG_TABLE):
+        self.pool = pool
+        self.table = table
+        self._version: Optional[str] = None
+        self._version_checked = 0.0
+
+    @classmethod
+    async def create(
+        cls,
+        dsn: str,
+        table: str = PG_TABLE,
+        min_size: int = PG_POOL_MIN,
+        max_size: int = PG_POOL_MAX,
+        ef_search: int = PG_EF_SEARCH,
+    ) -> "AsyncChunkStore":
+        if not table.replace("_", "").isalnum():
+            raise ValueError(f"不合法的資料表名稱: {table}")
+
+        async def init(conn: asyncpg.Connection) -> None:
+            await register_vector(conn)
+            await conn.set_type_codec(
+                "jsonb", schema="pg_catalog",
+                encoder=lambda v: json.dumps(v, ensure_ascii=False), decoder=json.loads,
+            )
+            try:
+                # 先跑一次 (LIMIT 0) 最常用的無 filter 查詢，讓它進到這條連線的 prepared statement 快取
+                await conn.fetch(cls._search_sql(table, "", with_vectors=False), np.zeros(EMBEDDING_DIM, dtype="float32"), 0)
+            except asyncpg.UndefinedTableError:
+                pass  # 還沒建表 (第一次 ingest)
+
+        pool = await asyncpg.create_pool(
+            dsn, min_size=min_size, max_size=max_size, init=init,
+            server_settings=await _prepare_database(dsn, ef_search),
+        )
+        return cls(pool, table)
+
+    @staticmethod
+    def _search_sql(table: str, where: str, with_vectors: bool) -> str:
+        columns = "id, content, metadata, -(embedding <#> $1) AS score" + (", embedding" if with_vectors else "")
+        return f"SELECT {columns} FROM {table}{where} ORDER BY embedding <#> $1 LIMIT $2"
+
+    async def ensure_schema(self, dim: int = EMBEDDING_DIM) -> None:
+        async with self.pool.acquire() as conn:
+            for statement in schema_statements(self.table, dim):
+                await conn.execute(statement)
+
+    async def search(
+        self,
+        query_vector: Sequence[float],
+        k: int,
+        metadata_filter: Optional[Dict[str, Any]] = None,
+        with_vectors: bool = False,
+    ) -> List[asyncpg.Record]:
+        """回傳依內積排序的 rows (id, content, metadata, score[, embedding])"""
+        where, params = build_where(metadata_filter, first_param=3)
+        sql = self._search_sql(self.table, where, with_vectors)
+        async with self.pool.acquire() as conn:
+            return await conn.fetch(sql, np.asarray(query_vector, dtype="float32"), int(k), *params)
+
+    async def copy_upsert(self, documents: List[Any], vectors: np.ndarray, replace: bool = False) -> Dict[str, Any]:
+        """
+        COPY 到暫存表再一次 upsert (id 相同且內容有變才更新)。
+        replace=True 時，同一個 transaction 內刪掉這次沒有出現的 id (整份索引重新發佈用)。
+        """
+        started = time.perf_counter()
+        records = [
+            (
+                str(doc.metadata.get("id") or f"row_{i}"),
+                doc.page_content,
+                doc.metadata.get("card_name"),
+                doc.metadata.get("issuer"),
+                doc.metadata.get("doc_type"),
+                json.dumps(doc.metadata, ensure_ascii=False, default=str),
+                np.asarray(vec, dtype="float32"),
+            )
+            for i, (doc, vec) in enumerate(zip(documents, vectors))
+        ]
+        t = self.table
+        async with self.pool.acquire() as conn, conn.transaction():
+            await conn.execute(
+                f"CREATE TEMP TABLE _stage_{t} (id text, content text, card_name text, issuer text, doc_type text, "
+                f"metadata text, embedding vector({vectors.shape[1] if len(records) else EMBEDDING_DIM})) ON COMMIT DROP"
+            )
+            for start in range(0, len(records), COPY_BATCH_SIZE):
+                await conn.copy_records_to_table(f"_stage_{t}", records=records[start:start + COPY_BATCH_SIZE])
+
+            status = await conn.execute(f"""
+                INSERT INTO {t} (id, content, card_name, issuer, doc_type, metadata, embedding)
+                SELECT DISTINCT ON (id) id, content, card_name, issuer, doc_type, metadata::jsonb, embedding FROM _stage_{t}
+                ON CONFLICT (id) DO UPDATE SET
+                    content = EXCLUDED.content, card_name = EXCLUDED.card_name, issuer = EXCLUDED.issuer,
+                    doc_type = EXCLUDED.doc_type, metadata = EXCLUDED.metadata, embedding = EXCLUDED.embedding,
+                    updated_at = now()
+                WHERE {t}.content IS DISTINCT FROM EXCLUDED.content
+                   OR {t}.metadata IS DISTINCT FROM EXCLUDED.metadata
+                   OR {t}.embedding IS DISTINCT FROM EXCLUDED.embedding
+            """)
+            deleted = "DELETE 0"
+            if replace:
+                deleted = await conn.execute(f"DELETE FROM {t} WHERE id NOT IN (SELECT id FROM _stage_{t})")
+
+        seconds = time.perf_counter() - started
+        return {
+            "rows": len(records),
+            "upserted": int(status.split()[-1]),
+            "deleted": int(deleted.split()[-1]),
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(len(records) / seconds, 1) if seconds > 0 else None,
+        }
+
+    async def version(self) -> str:
+        """資料表目前的資料版本 (同 PgVectorIndex.version)，最多每 PG_VERSION_SECONDS 秒查一次"""
+        now = time.monotonic()
+        if self._version is None or now - self._version_checked >= PG_VERSION_SECONDS:
+            async with self.pool.acquire() as conn:
+                count, updated_at = await conn.fetchrow(VERSION_SQL.format(table=self.table))
+            self._version = table_version(self.table, count, updated_at)
+            self._version_checked = now
+        return self._version
+
+    async def count(self) -> int:
+        async with self.pool.acquire() as conn:
+            return await conn.fetchval(f"SELECT count(*) FROM {self.table}")
+
+    async def close(self) -> None:
+        await self.pool.close()
+
+
+async def get_store(dsn: Optional[str] = None) -> AsyncChunkStore:
+    """目前 event loop 共用的 AsyncChunkStore (第一次呼叫時建立連線池)"""
+    loop_id = id(asyncio.get_running_loop())
+    store = _stores.get(loop_id)
+    if store is not None:
+        return store
+    async with _store_locks.setdefault(loop_id, asyncio.Lock()):
+        store = _stores.get(loop_id)
+        if store is None:
+            dsn = dsn or DB_CONNECTION_STRING
+            if not dsn:
+                raise ValueError("請設定 RAG_PG_DSN (或 DB_CONNECTION_STRING)")
+            store = _stores[loop_id] = await AsyncChunkStore.create(dsn)
+    return store
\ No newline at end of file
@@ -0,0 +1,185 @@
+# context_packer.py
+# 檢索結果的 Context Packing：在 token 預算內，把最相關的 chunk 塞進 prompt
+#
+# 原本 search_chunks 把每一筆結果的 markdown 全部接起來，長長的 channels_flat 通路清單也照塞，
+# top_k 一大 prompt 就爆長、LLM 變慢。這裡做四件事：
+#   1. 建索引時 (transfer.py) 先算好每個 chunk 的 markdown 本文與 token 數，存在 metadata，查詢時不用重算
+#   2. 內容幾乎一樣的 chunk (同一段文字出現在不同 doc_type) 只留分數最高的那筆
+#   3. 通路清單太長時，優先保留 query 有提到的通路，其餘只列前幾個並註明總數
+#   4. 依相關度排序往預算裡塞，塞不下的整筆跳過 (第一筆一定保留，避免最重要的證據被砍掉)
+#
+# token 數用估算 (中文字 1 字約 1 token、英數約 4 字元 1 token)，不需要載入 tokenizer。
+
+import ast
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional, Sequence, Set, Tuple
+
+RENDERED_KEY = "rendered_text"   # metadata 裡預先算好的 markdown 本文
+TOKENS_KEY = "token_count"       # metadata 裡預先算好的本文 token 數
+
+DEFAULT_TOKEN_BUDGET = int(os.getenv("RAG_TOKEN_BUDGET", "2000"))
+MAX_CHANNELS = 12                # 通路清單最多列幾個
+NEAR_DUP_THRESHOLD = 0.9         # 字元 shingle 的 Jaccard 相似度超過就視為重複
+SHINGLE_SIZE = 4
+
+_CJK_RE = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """粗估 token 數：CJK 字元各算 1，其餘字元每 4 個算 1"""
+    if not text:
+        return 0
+    cjk = len(_CJK_RE.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def chunk_title(meta: Dict[str, Any]) -> str:
+    """讓 LLM 一眼知道這段是在講什麼：卡名 - 方案 (文件類型)"""
+    card_name = meta.get("card_name") or "未知卡片"
+    scheme_name = meta.get("scheme_name")
+    doc_type = meta.get("doc_type") or "一般資訊"
+    if scheme_name:
+        return f"{card_name} - {scheme_name} ({doc_type})"
+    return f"{card_name} ({doc_type})"
+
+
+def render_body(meta: Dict[str, Any], content: str) -> str:
+    """chunk 的 markdown 本文 (不含「資料來源 i」標題與通路清單，這兩者查詢時才決定)"""
+    valid_period = meta.get("valid_period") or "未指定"
+    return (
+        f"- **適用期間**: {valid_period}\n"
+        f"- **內容詳情**: {content}"
+    )
+
+
+def precompute(meta: Dict[str, Any], content: str) -> None:
+    """建索引時呼叫：把本文與 token 數寫進 metadata"""
+    body = render_body(meta, content)
+    meta[RENDERED_KEY] = body
+    meta[TOKENS_KEY] = estimate_tokens(body)
+
+
+def channel_list(meta: Dict[str, Any]) -> List[str]:
+    """取出 channels_flat；CSV 來源會是字串化的 list，一併處理"""
+    channels = meta.get("channels_flat")
+    if isinstance(channels, str) and channels.strip().startswith("["):
+        try:
+            channels = ast.literal_eval(channels)
+        except (ValueError, SyntaxError):
+            return []
+    if not isinstance(channels, (list, tuple)):
+        return []
+    return [str(c) for c in channels if c]
+
+
+def truncate_channels(channels: Sequence[str], query: str, max_items: int = MAX_CHANNELS) -> str:
+    """
+    通路清單超過 max_items 時：query 有提到的通路排最前面 (回答「麥當勞有沒有回饋」靠的就是它)，
+    剩下的依原順序補滿，最後註明總共幾個。
+    """
+    if len(channels) <= max_items:
+        return ", ".join(channels)
+
+    q = (query or "").lower()
+    mentioned = [c for c in channels if c.lower() in q]
+    rest = [c for c in channels if c not in mentioned]
+    kept = (mentioned + rest)[:max(max_items, len(mentioned))]
+    return f"{', '.join(kept)} …等共 {len(channels)} 個通路"
+
+
+def _shingles(text: str) -> Set[str]:
+    text = re.sub(r"\s+", "", text)
+    if len(text) <= SHINGLE_SIZE:
+        return {text}
+    return {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+
+
+def _is_near_duplicate(shingles: Set[str], kept: List[Set[str]], threshold: float) -> bool:
+    for other in kept:
+        union = len(shingles | other)
+        if union and len(shingles & other) / union >= threshold:
+            return True
+    return False
+
+
+def pack(
+    items: Sequence[Tuple[Dict[str, Any], str]],
+    query: str,
+    token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET,
+    already_sent: Optional[Set[str]] = None,
+    near_dup_threshold: float = NEAR_DUP_THRESHOLD,
+    fmt: str = "markdown",
+) -> Tuple[List[Any], List[str]]:
+    """
+    items 為依相關度排好序的 (metadata, page_content)。
+    回傳 (要放進 prompt 的各 chunk, 這次真的送出全文的 chunk id)。
+    fmt="markdown" 時每個 chunk 是 markdown 字串；fmt="json" 時是精簡的 dict (給 json.dumps 用)。
+
+    Args:
+        token_budget: 全部 chunk 加起來的 token 上限；None 代表不限制
+        already_sent: 這個 session 已經送過的 chunk id (只輸出引用)；None 代表沒有 session，
+                      markdown 也不會標 chunk id
+    """
+    show_ids = already_sent is not None
+    already_sent = already_sent or set()
+    packed: List[Any] = []
+    sent_ids: List[str] = []
+    kept_shingles: List[Set[str]] = []
+    used = 0
+
+    for meta, content in items:
+        chunk_id = str(meta["id"]) if meta.get("id") else None
+
+        # 同一個 session 已經送過的 chunk：只引用，不重複塞全文
+        is_reference = bool(chunk_id and chunk_id in already_sent)
+        if not is_reference:
+            shingles = _shingles(content)
+            if _is_near_duplicate(shingles, kept_shingles, near_dup_threshold):
+                continue
+
+        if fmt == "json":
+            item, cost = _json_item(meta, content, chunk_id, query, is_reference)
+        else:
+            item, cost = _markdown_item(meta, content, chunk_id, query, is_reference, len(packed) + 1, show_ids)
+
+        if token_budget is not None and packed and used + cost > token_budget:
+            continue  # 這筆塞不下，後面較短的可能還塞得下
+
+        if not is_reference:
+            kept_shingles.append(shingles)
+            if chunk_id:
+                sent_ids.append(chunk_id)
+        packed.append(item)
+        used += cost
+
+    return packed, sent_ids
+
+
+def _markdown_item(meta, content, chunk_id, query, is_reference, index, show_ids) -> Tuple[str, int]:
+    header = f"### 資料來源 {index}: {chunk_title(meta)}\n"
+    if is_reference:
+        text = header + f"- (chunk `{chunk_id}` 已在先前的查詢結果中提供，內容相同，請直接參考)"
+        return text, estimate_tokens(text)
+
+    body = meta.get(RENDERED_KEY) or render_body(meta, content)
+    body_tokens = meta.get(TOKENS_KEY) or estimate_tokens(body)
+
+    id_line = f"- **chunk id**: {chunk_id}\n" if show_ids and chunk_id else ""
+    channels = channel_list(meta)
+    channels_str = f"\n- **包含通路關鍵字**: {truncate_channels(channels, query)}" if channels else ""
+    extra = header + id_line + channels_str
+    return header + id_line + body + channels_str, int(body_tokens) + estimate_tokens(extra)
+
+
+def _json_item(meta, content, chunk_id, query, is_reference) -> Tuple[Dict[str, Any], int]:
+    item: Dict[str, Any] = {"id": chunk_id, "card": meta.get("card_name") or "未知卡片", "type": meta.get("doc_type") or "一般資訊"}
+    if is_reference:
+        item["ref"] = "已在先前的查詢結果中提供"
+    else:
+        item["content"] = content
+        channels = channel_list(meta)
+        if channels:
+            item["channels"] = truncate_channels(channels, query)
+    return item, estimate_tokens(json.dumps(item, ensure_ascii=False, separators=(",", ":")))
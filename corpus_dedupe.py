@@ -0,0 +1,201 @@
+# corpus_dedupe.py
+# 建索引前的語料清理：去除樣板文字、合併重複 / 近似重複的 chunk
+#
+# transfer.py 在 embedding 之前呼叫 dedupe_documents()，目的：
+#   - 少 embed 幾筆 (encode 時間) 、少存幾個向量 (索引大小)
+#   - 查詢時不會 top-k 全是同一段文字
+#
+# 三個步驟：
+#   1. 正規化 + 去樣板：合併空白、重複標點 (。。)、重複詞 (附卡附卡)，
+#      以及每張卡 profile 開頭「國泰世華銀行發行的「…」基本資料：」這類固定句型 (卡名保留)
+#   2. 完全重複：正規化後文字相同
+#   3. 近似重複：字元 shingle 的 MinHash + LSH 找候選，估計 Jaccard >= threshold 才算
+#
+# 重複的處理方式：
+#   - 同一張卡 (card_name 相同)：合併，只留第一筆，被合併的 id 記在 metadata["merged_ids"]
+#   - 不同卡 (例如亞洲萬里通的各子卡)：不能合併 (查詢會用 card_name 過濾)，
+#     只在 metadata["near_duplicate_of"] 記下連結；文字完全相同時 transfer.build_vectorstore 會共用同一個向量
+#
+# 用法：
+#   documents, report = dedupe_documents(documents, threshold=0.85)
+#   print_report(report)
+#
+#   # 串流：邊讀邊去重複
+#   deduper = Deduper(threshold=0.85)
+#   for doc in deduper.filter(iter_documents()):
+#       ...
+#   print_report(deduper.report())
+
+import hashlib
+import re
+from typing import Any, Dict, Iterable, Iterator, List, Tuple
+
+DEFAULT_THRESHOLD = 0.85
+NUM_PERM = 64
+NUM_BANDS = 16          # 16 band × 4 row：Jaccard 0.85 的配對幾乎一定會成為候選
+SHINGLE_SIZE = 5
+_MERSENNE_PRIME = (1 << 61) - 1
+
+# (pattern, replacement)：建索引前移除的樣板句型
+BOILERPLATE_PATTERNS: List[Tuple[str, str]] = [
+    (r"^國泰世華銀行發行的「(.+?)」基本資料：", r"「\1」基本資料："),
+    (r"附卡附卡", "附卡"),
+    (r"([。；，])\1+", r"\1"),
+    (r"[ \t　]+", " "),
+]
+_BOILERPLATE_RE = [(re.compile(p), r) for p, r in BOILERPLATE_PATTERNS]
+
+# 固定的 hash 參數 (a, b)，讓每次建索引的 MinHash 結果一致
+_PERMUTATIONS = [
+    (
+        int.from_bytes(hashlib.blake2b(f"a{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME or 1,
+        int.from_bytes(hashlib.blake2b(f"b{i}".encode(), digest_size=8).digest(), "big") % _MERSENNE_PRIME,
+    )
+    for i in range(NUM_PERM)
+]
+
+
+def strip_boilerplate(text: str) -> str:
+    text = (text or "").strip()
+    for pattern, replacement in _BOILERPLATE_RE:
+        text = pattern.sub(replacement, text)
+    return text.strip()
+
+
+def _shingle_hashes(text: str) -> List[int]:
+    text = re.sub(r"\s+", "", text)
+    if len(text) <= SHINGLE_SIZE:
+        grams = {text}
+    else:
+        grams = {text[i:i + SHINGLE_SIZE] for i in range(len(text) - SHINGLE_SIZE + 1)}
+    return [int.from_bytes(hashlib.blake2b(g.encode(), digest_size=8).digest(), "big") for g in grams]
+
+
+def minhash_signature(text: str) -> List[int]:
+    hashes = _shingle_hashes(text)
+    return [min((a * h + b) % _MERSENNE_PRIME for h in hashes) for a, b in _PERMUTATIONS]
+
+
+def _estimated_jaccard(sig_a: List[int], sig_b: List[int]) -> float:
+    return sum(1 for x, y in zip(sig_a, sig_b) if x == y) / len(sig_a)
+
+
+class Deduper:
+    """
+    逐筆處理的去重複器 (串流建索引用)：add(doc) 回傳 True 代表要保留。
+    只需記住已保留文件的 MinHash 簽章與 LSH bucket，不需要先讀完整份語料。
+    """
+
+    def __init__(self, threshold: float = DEFAULT_THRESHOLD):
+        self.threshold = threshold
+        self._kept: List[Any] = []
+        self._by_text: Dict[str, Any] = {}
+        self._signatures: List[List[int]] = []
+        self._buckets: Dict[Tuple[int, int], List[int]] = {}
+        self._report: Dict[str, Any] = {
+            "input_docs": 0,
+            "output_docs": 0,
+            "bytes_before": 0,
+            "bytes_after_boilerplate": 0,
+            "bytes_after": 0,
+            "exact_merged": 0,
+            "near_merged": 0,
+            "cross_card_links": 0,
+            "merged": [],
+        }
+
+    def add(self, doc: Any) -> bool:
+        """去樣板 (就地修改 page_content) 並判斷是否重複；重複的會合併進先前保留的文件"""
+        report = self._report
+        report["input_docs"] += 1
+        report["bytes_before"] += len(doc.page_content.encode("utf-8"))
+
+        # 1. 去樣板
+        doc.page_content = strip_boilerplate(doc.page_content)
+        size = len(doc.page_content.encode("utf-8"))
+        report["bytes_after_boilerplate"] += size
+        card = doc.metadata.get("card_name")
+
+        # 2. 完全重複
+        first = self._by_text.get(doc.page_content)
+        if first is not None and first.metadata.get("card_name") == card:
+            _merge(first, doc, "exact", report)
+            return False
+
+        # 3. 近似重複 (LSH 候選 -> 估計 Jaccard)
+        rows = NUM_PERM // NUM_BANDS
+        sig = minhash_signature(doc.page_content)
+        band_keys = [(b, hash(tuple(sig[b * rows:(b + 1) * rows]))) for b in range(NUM_BANDS)]
+        candidates = sorted({i for key in band_keys for i in self._buckets.get(key, [])})
+
+        best, best_sim = None, 0.0
+        for i in candidates:
+            sim = _estimated_jaccard(sig, self._signatures[i])
+            if sim >= self.threshold and sim > best_sim:
+                best, best_sim = self._kept[i], sim
+
+        if best is not None and best.metadata.get("card_name") == card:
+            _merge(best, doc, "near", report, best_sim)
+            return False
+
+        if best is not None or first is not None:
+            # 不同卡的重複內容：保留 (card_name 過濾需要)，只記連結
+            target = first if first is not None else best
+            doc.metadata["near_duplicate_of"] = target.metadata.get("id")
+            report["cross_card_links"] += 1
+
+        self._by_text.setdefault(doc.page_content, doc)
+        for key in band_keys:
+            self._buckets.setdefault(key, []).append(len(self._kept))
+        self._signatures.append(sig)
+        self._kept.append(doc)
+        report["output_docs"] += 1
+        report["bytes_after"] += size
+        return True
+
+    def filter(self, documents: Iterable[Any]) -> Iterator[Any]:
+        """串流版本：只 yield 要保留的文件"""
+        for doc in documents:
+            if self.add(doc):
+                yield doc
+
+    def report(self) -> Dict[str, Any]:
+        report = dict(self._report)
+        report["unique_texts"] = len(self._by_text)
+        report["vectors_saved"] = report["input_docs"] - report["output_docs"]   # 索引少存的向量
+        report["encodes_saved"] = report["input_docs"] - report["unique_texts"]  # 少做的 embedding
+        return report
+
+
+def dedupe_documents(documents: List[Any], threshold: float = DEFAULT_THRESHOLD) -> Tuple[List[Any], Dict[str, Any]]:
+    """
+    documents 為 LangChain Document (會就地修改 page_content / metadata)。
+    回傳 (保留下來的 Documents, 報告)。
+    """
+    deduper = Deduper(threshold)
+    kept = list(deduper.filter(documents))
+    return kept, deduper.report()
+
+
+def _merge(target: Any, dup: Any, kind: str, report: Dict[str, Any], similarity: float = 1.0) -> None:
+    merged_ids = target.metadata.setdefault("merged_ids", [])
+    dup_id = dup.metadata.get("id")
+    for chunk_id in [dup_id, *dup.metadata.get("merged_ids", [])]:
+        if chunk_id and chunk_id != target.metadata.get("id") and chunk_id not in merged_ids:
+            merged_ids.append(chunk_id)
+    report[f"{kind}_merged"] += 1
+    report["merged"].append({"kept": target.metadata.get("id"), "dropped": dup_id, "kind": kind, "similarity": round(similarity, 3)})
+
+
+def print_report(report: Dict[str, Any], dim: int | None = None) -> None:
+    saved_bytes = report["bytes_before"] - report["bytes_after"]
+    boilerplate_bytes = report["bytes_before"] - report["bytes_after_boilerplate"]
+    print("🧹 語料清理報告")
+    print(f"   文件數: {report['input_docs']} -> {report['output_docs']} "
+          f"(完全重複 {report['exact_merged']}、近似重複 {report['near_merged']}、跨卡連結 {report['cross_card_links']})")
+    print(f"   文字量: {report['bytes_before']:,} -> {report['bytes_after']:,} bytes "
+          f"(省 {saved_bytes:,}，其中樣板 {boilerplate_bytes:,})")
+    vector_line = f"   向量: 少存 {report['vectors_saved']} 個"
+    if dim:
+        vector_line += f" (約 {report['vectors_saved'] * dim * 4:,} bytes)"
+    print(vector_line + f"，embed {report['unique_texts']} 次 (少 {report['encodes_saved']} 次 encode)")
@@ -0,0 +1,224 @@
+# dispatcher_server.py
+# 多使用者版的 Dispatcher：HTTP + SSE 入口
+#
+# agent_client.py 是單一使用者的 input() 迴圈；這裡改成一個 async HTTP server，
+# 所有使用者共用同一組 Agent 連線 (connect_agents 只做一次)，每個對話各自保存 messages。
+#
+# API：
+#   POST   /sessions                       -> 建立對話，回傳 {"session_id": ...}
+#   POST   /sessions/{session_id}/messages -> body {"message": "..."}，以 SSE 串流回傳事件
+#   GET    /sessions/{session_id}          -> 對話摘要 (訊息數、最後活動時間)
+#   DELETE /sessions/{session_id}          -> 結束對話
+#   GET    /health                         -> 健康檢查
+#
+# 啟動：
+#   python dispatcher_server.py            (預設 0.0.0.0:8000，可用 DISPATCHER_HOST / DISPATCHER_PORT 調整)
+#
+# 測試：
+#   curl -X POST localhost:8000/sessions
+#   curl -N -X POST localhost:8000/sessions/<id>/messages -d '{"message": "我是學生，想辦卡"}'
+
+import asyncio
+import json
+import os
+import sys
+import time
+import uuid
+from contextlib import AsyncExitStack, asynccontextmanager
+from typing import Any, Dict, List, Set
+
+import uvicorn
+from starlette.applications import Starlette
+from starlette.requests import Request
+from starlette.responses import JSONResponse, StreamingResponse
+from starlette.routing import Route
+
+from agent_client import SEGMENT_TABLE, SYSTEM_PROMPT, connect_agents, run_dispatch_turn
+from tool_cache import ToolResultCache
+
+# ==========================================
+# 1. 設定
+# ==========================================
+DISPATCHER_HOST = os.getenv("DISPATCHER_HOST", "0.0.0.0")
+DISPATCHER_PORT = int(os.getenv("DISPATCHER_PORT", "8000"))
+SESSION_IDLE_TTL = int(os.getenv("DISPATCHER_SESSION_TTL", "1800"))  # 閒置多久 (秒) 就回收對話
+MAX_SESSIONS = int(os.getenv("DISPATCHER_MAX_SESSIONS", "500"))
+
+
+# ==========================================
+# 2. 對話狀態
+# ==========================================
+class ChatSession:
+    """一個使用者對話：自己的 messages 歷史 + 工具結果快取 + 一把鎖 (同一對話一次只跑一輪)"""
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+        self.messages: List[Any] = [{"role": "system", "content": SYSTEM_PROMPT}]
+        self.tool_cache = ToolResultCache()
+        self.lock = asyncio.Lock()
+        self.last_active = time.monotonic()
+
+    def touch(self) -> None:
+        self.last_active = time.monotonic()
+
+
+_sessions: Dict[str, ChatSession] = {}
+_agent_sessions: Dict[str, Any] = {}  # 所有使用者共用的 Agent 連線 (router 工具名稱 -> ClientSession)
+# 進行中的派單工作；event loop 只保留 task 的弱參照，沒人持有的 task 可能在跑到一半時被回收
+_turn_tasks: Set[asyncio.Task] = set()
+
+
+async def _evict_idle_sessions() -> None:
+    """背景工作：定期回收閒置太久的對話"""
+    while True:
+        await asyncio.sleep(60)
+        now = time.monotonic()
+        expired = [
+            sid for sid, sess in _sessions.items()
+            if now - sess.last_active > SESSION_IDLE_TTL and not sess.lock.locked()
+        ]
+        for sid in expired:
+            _sessions.pop(sid, None)
+        if expired:
+            print(f"🧹 [Server] 回收 {len(expired)} 個閒置對話，目前 {len(_sessions)} 個", file=sys.stderr)
+
+
+@asynccontextmanager
+async def lifespan(app: Starlette):
+    """Server 啟動時連接所有 Agent 一次，關閉時一起釋放"""
+    async with AsyncExitStack() as stack:
+        print("正在啟動並連接所有 Agent，請稍候...", file=sys.stderr)
+        _agent_sessions.update(await connect_agents(stack))
+        evictor = asyncio.create_task(_evict_idle_sessions())
+        print(f"🚀 Dispatcher server 準備就緒：http://{DISPATCHER_HOST}:{DISPATCHER_PORT}", file=sys.stderr)
+        try:
+            yield
+        finally:
+            evictor.cancel()
+            _agent_sessions.clear()
+
+
+# ==========================================
+# 3. HTTP Handlers
+# ==========================================
+def _sse(event: str, data: Dict[str, Any]) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, ensure_ascii=False)}\n\n"
+
+
+async def create_session(request: Request) -> JSONResponse:
+    if len(_sessions) >= MAX_SESSIONS:
+        return JSONResponse({"error": "對話數已達上限，請稍後再試"}, status_code=503)
+
+    session_id = uuid.uuid4().hex
+    _sessions[session_id] = ChatSession(session_id)
+    return JSONResponse({"session_id": session_id}, status_code=201)
+
+
+async def get_session(request: Request) -> JSONResponse:
+    sess = _sessions.get(request.path_params["session_id"])
+    if sess is None:
+        return JSONResponse({"error": "session not found"}, status_code=404)
+
+    return JSONResponse({
+        "session_id": sess.session_id,
+        "messages": len(sess.messages),
+        "busy": sess.lock.locked(),
+        "tool_cache": sess.tool_cache.stats(),
+        "idle_seconds": round(time.monotonic() - sess.last_active, 1),
+    })
+
+
+async def delete_session(request: Request) -> JSONResponse:
+    sess = _sessions.pop(request.path_params["session_id"], None)
+    if sess is None:
+        return JSONResponse({"error": "session not found"}, status_code=404)
+    return JSONResponse({"deleted": sess.session_id})
+
+
+async def post_message(request: Request):
+    sess = _sessions.get(request.path_params["session_id"])
+    if sess is None:
+        return JSONResponse({"error": "session not found"}, status_code=404)
+
+    try:
+        body = await request.json()
+    except json.JSONDecodeError:
+        return JSONResponse({"error": "body 必須是 JSON"}, status_code=400)
+    if not isinstance(body, dict):
+        return JSONResponse({"error": "body 必須是 JSON 物件，例如 {\"message\": \"...\"}"}, status_code=400)
+
+    user_input = str(body.get("message", "")).strip()
+    if not user_input:
+        return JSONResponse({"error": "message 不可為空"}, status_code=400)
+
+    queue: asyncio.Queue = asyncio.Queue()
+
+    def emit(event: str, data: Dict[str, Any]) -> None:
+        queue.put_nowait((event, data))
+
+    async def run_turn() -> None:
+        # 同一個對話的訊息依序處理；不同對話之間完全並行
+        async with sess.lock:
+            sess.touch()
+            sess.messages.append({"role": "user", "content": user_input})
+            try:
+                await run_dispatch_turn(sess.messages, _agent_sessions, emit=emit, tool_cache=sess.tool_cache)
+            except Exception as e:
+                emit("error", {"message": f"派單失敗: {e}"})
+            finally:
+                sess.touch()
+                queue.put_nowait(None)
+
+    # 即使使用者中途斷線，這一輪仍會跑完，對話歷史才會一致
+    task = asyncio.create_task(run_turn())
+    _turn_tasks.add(task)
+    task.add_done_callback(_turn_tasks.discard)
+
+    async def event_stream():
+        while True:
+            item = await queue.get()
+            if item is None:
+                yield _sse("done", {"session_id": sess.session_id})
+                break
+            event, data = item
+            yield _sse(event, data)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
+async def health(request: Request) -> JSONResponse:
+    return JSONResponse({
+        "status": "ok" if _agent_sessions else "starting",
+        "agents": sorted(_agent_sessions),
+        "sessions": len(_sessions),
+        # 有用 HTTP 副本池的 Agent，列出各副本的健康狀態與負載
+        "replicas": {
+            name: sess.stats()["replicas"]
+            for name, sess in _agent_sessions.items()
+            if hasattr(sess, "stats")
+        },
+        # 客群推薦表的命中 / 未命中次數 (未命中會改呼叫 comparing_agent)
+        "segment_table": dict(SEGMENT_TABLE.stats) if SEGMENT_TABLE else None,
+    })
+
+
+app = Starlette(
+    routes=[
+        Route("/health", health, methods=["GET"]),
+        Route("/sessions", create_session, methods=["POST"]),
+        Route("/sessions/{session_id}", get_session, methods=["GET"]),
+        Route("/sessions/{session_id}", delete_session, methods=["DELETE"]),
+        Route("/sessions/{session_id}/messages", post_message, methods=["POST"]),
+    ],
+    lifespan=lifespan,
+)
+
+
+if __name__ == "__main__":
+    if sys.platform.startswith("win"):
+        asyncio.set_event_loop_policy(asyncio.WindowsSelectorEventLoopPolicy())
+    uvicorn.run(app, host=DISPATCHER_HOST, port=DISPATCHER_PORT)
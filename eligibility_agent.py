@@ -2,12 +2,20 @@
 import os
 import sys
 import json
+import time
 import asyncio
 from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from startup_profile import StartupClock
+
+startup = StartupClock("eligibility")  # 冷啟動各階段耗時 (eligibility_agent_stats 的 "startup")
 
 from mcp.server.fastmcp import FastMCP
 from openai import OpenAI
-from rag_search import search_chunks
+from card_catalog import ADULT_AGE, DEFAULT_JSONL, load_catalog, mentioned_cards
+from admission import AdmissionController, AdmissionRejected
+import single_flight
 import logging   
 from dotenv import load_dotenv
 
@@ -36,63 +44,175 @@ except Exception as e:
     print(f"❌ Gemini Client 初始化失敗: {e}", file=sys.stderr)
     llm_client = None
     
-mcp = FastMCP("eligibility-agent")
+# --http 模式 (streamable-HTTP) 的位址；stdio 模式不會用到
+MCP_HOST = os.getenv("MCP_HOST", "0.0.0.0")
+MCP_PORT = int(os.getenv("ELIGIBILITY_AGENT_PORT", "8104"))
 
+mcp = FastMCP("eligibility-agent", host=MCP_HOST, port=MCP_PORT)
+
+# 准入控制：限制同時處理的請求數，排隊滿了就快速拒絕
+admission = AdmissionController.from_env("eligibility")
+startup.mark("module_loaded")
 
 # ==========================================
-# 2. 輕量版：五張卡的申辦規則表
-#   
+# 2. 逐卡並行的資格判斷
 # ==========================================
+# 以前是把 top 20 的 profile chunk 全部塞進一個 prompt，等 LLM 一次寫完所有卡的分析 (卡越多越慢)。
+# 現在每張卡各自判斷、全部並行：
+#   - 年齡 / 年收入 / 現職年資：card_catalog 已解析成結構化門檻，直接比對，不呼叫 LLM
+#   - 附加條件 (例如「須為蝦皮購物會員」) 或解析不出門檻的卡：只帶這張卡的申辦條件，呼叫一次簡短的 LLM
+# 最後合併成一份結構化報告 (JSON)，延遲取決於最慢的一張卡，而不是卡片數量。
 
-async def tool_check_eligibility(user_profile_json: str) -> dict:
-    """
-    使用 LLM + RAG 內容判斷 eligibility。
-    ✅ 不再強制 LLM 輸出 JSON，因此不會再出現「無法解析」。
-    """
-    user = json.loads(user_profile_json)
-    
-    metadata = {
-         "doc_type": "credit_card_profile"
-    }
-    
-    # 1) 從 RAG 搜尋該卡片相關內容
-    try:
-        rag_results = search_chunks(
-            query="信用卡申辦資格條件",
-            metadata_filter=metadata,
-            top_k=20
-        )
-    except Exception as e:
-        rag_results = []
-    print(rag_results)
-    # 2) 讓 LLM 根據 RAG 內容做 eligibility 推論（用自然語言即可）
-    prompt = f"""
-你是一位信用卡申辦資格分析專家。請你根據數張信用卡的申辦資訊判斷使用
+ELIGIBILITY_CATALOG_JSONL = os.getenv("ELIGIBILITY_CATALOG_JSONL", DEFAULT_JSONL)
+# 同時進行的逐卡 LLM 呼叫上限
+ELIGIBILITY_LLM_CONCURRENCY = int(os.getenv("ELIGIBILITY_LLM_CONCURRENCY", "4"))
 
-使用者資料（JSON）：
-{json.dumps(user, ensure_ascii=False)}
+VERDICTS = {"fail": "❌ 不建議", "unknown": "⚠️ 資訊不足", "pass": "✅ 建議申辦"}
+NO_EMPLOYMENT_IDENTITIES = ("學生", "家管", "退休")
 
+_catalog: Optional[Dict[str, Dict[str, Any]]] = None
+_llm_semaphore: Optional[asyncio.Semaphore] = None
+check_stats = {"reports": 0, "rule_checks": 0, "llm_checks": 0, "llm_errors": 0}
 
-以下是從 RAG 搜尋到的卡片內容（可能包含回饋、優惠、條款、資格等）：
-{json.dumps(rag_results, ensure_ascii=False)}
 
-請用繁體中文回答每張卡片：
-1) 申請人的年齡/收入/學生身分是否有達到明確門檻？（若沒有寫就說「資料不足」）
-2) 以此使用者條件，給與每張卡「建議申辦 / 不建議 / 資訊不足」其一
-3) 2～4 點條列理由
+def _get_catalog() -> Dict[str, Dict[str, Any]]:
+    global _catalog
+    if _catalog is None:
+        _catalog = load_catalog(ELIGIBILITY_CATALOG_JSONL)
+    return _catalog
 
-直接輸出文字，不要 JSON。
-"""
 
-    resp = llm_client.chat.completions.create(
-        model=GEMINI_MODEL,
-        messages=[{"role": "user", "content": prompt}],
+def _check(item: str, status: str, detail: str) -> Dict[str, str]:
+    return {"item": item, "status": status, "detail": detail}
+
+
+def _rule_checks(card: Dict[str, Any], user: Dict[str, Any]) -> List[Dict[str, str]]:
+    """結構化門檻 (年齡、年收入、現職年資) 的機械式比對"""
+    checks = []
+    age = user.get("age")
+    min_age = card.get("min_age") or ADULT_AGE
+    if not isinstance(age, (int, float)):
+        checks.append(_check("年齡", "unknown", f"需年滿 {min_age} 歲，未提供年齡"))
+    elif age >= min_age:
+        checks.append(_check("年齡", "pass", f"{age} 歲，達 {min_age} 歲門檻"))
+    else:
+        checks.append(_check("年齡", "fail", f"{age} 歲，未滿 {min_age} 歲 (僅能申辦附卡或需法定代理人同意)"))
+
+    min_income = card.get("min_income")
+    income = user.get("annual_income")
+    if min_income:
+        if not isinstance(income, (int, float)):
+            checks.append(_check("年收入", "unknown", f"需年收入 NT${min_income:,}，未提供年收入"))
+        elif income >= min_income:
+            checks.append(_check("年收入", "pass", f"年收入 NT${int(income):,}，達 NT${min_income:,} 門檻"))
+        else:
+            checks.append(_check("年收入", "fail", f"年收入 NT${int(income):,}，未達 NT${min_income:,} 門檻"))
+
+    if card.get("needs_employment"):
+        identity = user.get("identity_type") or "未知"
+        if user.get("is_student") or identity in NO_EMPLOYMENT_IDENTITIES:
+            checks.append(_check("現職年資", "fail", f"需現職滿一年，{'學生' if user.get('is_student') else identity}不符合"))
+        elif identity == "上班族":
+            checks.append(_check("現職年資", "pass", "需現職滿一年 (以銀行審核的在職證明為準)"))
+        else:
+            checks.append(_check("現職年資", "unknown", "需現職滿一年，無法確認目前年資"))
+    return checks
+
+
+async def _llm_check(card: Dict[str, Any], user: Dict[str, Any], conditions: List[str]) -> Dict[str, str]:
+    """規則表達不了的條件：只帶這張卡的條件，請 LLM 回一行判斷"""
+    global _llm_semaphore
+    if _llm_semaphore is None:
+        _llm_semaphore = asyncio.Semaphore(ELIGIBILITY_LLM_CONCURRENCY)
+
+    prompt = (
+        f"信用卡「{card['card_name']}」的申辦條件：\n"
+        + "\n".join(f"- {c}" for c in conditions)
+        + f"\n\n使用者資料：{json.dumps(user, ensure_ascii=False)}\n\n"
+        "只判斷上面列出的條件，使用者是否符合？沒有資料可判斷就回 unknown。"
+        '只輸出一行 JSON：{"status": "pass" | "fail" | "unknown", "detail": "20 字以內的理由"}'
     )
+    check_stats["llm_checks"] += 1
+    try:
+        async with _llm_semaphore:
+            resp = await asyncio.to_thread(
+                single_flight.coalesced_completion,
+                llm_client,
+                model=GEMINI_MODEL,
+                messages=[{"role": "user", "content": prompt}],
+            )
+        text = (resp.choices[0].message.content or "").strip()
+        result = json.loads(text[text.index("{"): text.rindex("}") + 1])
+        status = result.get("status") if result.get("status") in VERDICTS else "unknown"
+        return _check("其他條件", status, str(result.get("detail") or "；".join(conditions)))
+    except Exception as e:
+        check_stats["llm_errors"] += 1
+        print(f"⚠️ [Eligibility] {card['card_name']} 附加條件判斷失敗: {e}", file=sys.stderr)
+        return _check("其他條件", "unknown", "；".join(conditions))
+
+
+async def _evaluate_card(card: Dict[str, Any], user: Dict[str, Any]) -> Dict[str, Any]:
+    checks = _rule_checks(card, user)
+    check_stats["rule_checks"] += 1
+
+    conditions = list(card.get("extra_requirements") or [])
+    if card.get("requirements") and not card.get("min_income") and not card.get("min_age"):
+        conditions.append(card["requirements"])  # 門檻解析不出來，整段交給 LLM
+    if conditions:
+        checks.append(await _llm_check(card, user, conditions))
+
+    statuses = {c["status"] for c in checks}
+    verdict = "fail" if "fail" in statuses else "unknown" if "unknown" in statuses else "pass"
+    return {
+        "card_name": card["card_name"],
+        "verdict": VERDICTS[verdict],
+        "checks": checks,
+        "annual_fee": card.get("annual_fee"),
+        "apply_difficulty": card.get("apply_difficulty"),
+        "evidence_id": card["profile_id"],
+    }
 
-    explanation = (resp.choices[0].message.content or "").strip()
 
-    # 3) 我們自己包成 dict 回去（避免解析）
-    return explanation 
+async def tool_check_eligibility(user_profile_json: str, card_names: Optional[List[str]] = None) -> str:
+    """
+    逐卡並行判斷申辦資格，回傳結構化報告 (JSON 字串)：
+    {"cards": [{card_name, verdict, checks: [{item, status, detail}], ...}], "summary": {verdict: [卡名]}}
+    card_names 可只檢查部分卡片 (名稱部分相符或常見簡稱，例如「亞洲萬里通卡」)，不給就檢查全部；
+    對不到任何卡的名稱列在 "unknown_cards"，不會改成檢查全部卡片。
+    """
+    try:
+        user = json.loads(user_profile_json) if user_profile_json else {}
+    except json.JSONDecodeError:
+        user = {}
+    if not isinstance(user, dict):
+        user = {}
+
+    catalog = _get_catalog()
+    requested = [n.strip() for n in card_names or [] if n and n.strip()]
+    matched: List[str] = []
+    unknown_cards: List[str] = []
+    for n in requested:
+        names = [name for name in catalog if n in name or name in n] or mentioned_cards(n, catalog)
+        if not names:
+            unknown_cards.append(n)
+        matched.extend(name for name in names if name not in matched)
+    cards = [catalog[name] for name in matched] if requested else list(catalog.values())
+
+    started = time.perf_counter()
+    results = await asyncio.gather(*[_evaluate_card(card, user) for card in cards])
+    check_stats["reports"] += 1
+
+    summary: Dict[str, List[str]] = {label: [] for label in VERDICTS.values()}
+    for result in results:
+        summary[result["verdict"]].append(result["card_name"])
+    return json.dumps({
+        "user_profile": user,
+        "cards": results,
+        "summary": {label: names for label, names in reversed(list(summary.items())) if names},
+        "unknown_cards": unknown_cards,
+        "elapsed_ms": round((time.perf_counter() - started) * 1000, 1),
+        "note": "年齡、年收入、現職年資為規則比對；實際核卡仍以銀行審核為準",
+    }, ensure_ascii=False)
 
 
 # ==========================================
@@ -104,13 +224,18 @@ INTERNAL_TOOLS_SCHEMA = [
         "type": "function",
         "function": {
             "name": "tool_check_eligibility",
-            "description": "根據使用者條件，檢查指定信用卡是否符合申辦門檻。",
+            "description": "根據使用者條件，逐卡檢查是否符合申辦門檻，回傳每張卡的判斷與原因。",
             "parameters": {
                 "type": "object",
                 "properties": {
                     "user_profile_json": {
                         "type": "string",
                         "description": "使用者資料的 JSON 字串，例如 {\"age\":23,\"annual_income\":450000,\"is_student\":false}"
+                    },
+                    "card_names": {
+                        "type": "array",
+                        "items": {"type": "string"},
+                        "description": "只檢查這些卡 (可省略，省略時檢查全部卡片)"
                     }
                 },
                 "required": ["user_profile_json"]
@@ -128,14 +253,16 @@ ELIGIBILITY_SYSTEM_PROMPT = """
 
 ### 回答原則
 1. **先看結構化結果，再補充說明**：
-   - 先依照工具回傳的 status（✅/❌）做整理。
+   - 先依照工具回傳每張卡的 verdict（✅/⚠️/❌）與 summary 做整理。
    - 再用條列式說明理由，例如年齡、年收、學生身分等。
-2. **不要亂猜銀行內規**：
+2. **資料庫沒有的卡**：
+   - 工具回傳的 `unknown_cards` 是資料庫裡找不到的卡名，直接告訴使用者目前沒有這張卡的資料，不要自行判斷。
+3. **不要亂猜銀行內規**：
    - 工具沒有提供的資料，就說「此部分仍以銀行實際審核為準」。
-3. **輸出格式建議**：
+4. **輸出格式建議**：
    - 先給一個總結：比如「整體來說，你最適合 A、B 卡」。
    - 再列出每張卡：卡名 / 建議 / 原因（條列）。
-4. **user_profile 來源**：
+5. **user_profile 來源**：
    - 你會收到一個 `user_profile` 字串參數，可直接當作 JSON，
      也可以依使用者在對話中補充的資訊做口頭解釋。
 
@@ -166,7 +293,9 @@ async def _generate_response(user_query: str, user_profile: str = "") -> str:
         while turn < MAX_TURNS:
             turn += 1
 
-            resp = llm_client.chat.completions.create(
+            resp = await asyncio.to_thread(
+                single_flight.coalesced_completion,
+                llm_client,
                 model=GEMINI_MODEL,
                 messages=messages,
                 tools=INTERNAL_TOOLS_SCHEMA,
@@ -200,10 +329,11 @@ async def _generate_response(user_query: str, user_profile: str = "") -> str:
                     "content": tool_result,
                 })
 
-        return "⚠️ 超過思考次數上限，無法取得完整資訊。"
+        return json.dumps({"error": "max_turns", "message": "超過思考次數上限，無法取得完整資訊"}, ensure_ascii=False)
 
     except Exception as e:
-        return f"❌ Agent 執行發生錯誤: {e}"
+        # 失敗一律回傳錯誤 JSON：dispatcher 不會把它快取成這個問題的答案
+        return json.dumps({"error": "agent_error", "message": f"Agent 執行發生錯誤: {e}"}, ensure_ascii=False)
 
 # ==========================================
 # 5. MCP Tool Entry
@@ -217,7 +347,25 @@ async def eligibility_agent(user_query: str, user_profile: str = "") -> str:
     - user_profile: 建議傳 JSON 字串，例如 {"age":23,"annual_income":450000,"is_student":false}
     """
     print(f"🪪 [Eligibility Agent] 收到請求 | Query={user_query}", file=sys.stderr)
-    return await _generate_response(user_query, user_profile)
+    try:
+        async with admission.slot():
+            return await _generate_response(user_query, user_profile)
+    except AdmissionRejected as e:
+        return e.to_json()
+
+
+@mcp.tool()
+async def eligibility_agent_stats() -> str:
+    """回傳申辦資格 Agent 目前的負載與排隊指標 (JSON)"""
+    return json.dumps(
+        {
+            **admission.snapshot(),
+            "startup": startup.snapshot(),
+            "checks": check_stats,
+            "single_flight": single_flight.stats(),
+        },
+        ensure_ascii=False,
+    )
 
 
 # ==========================================
@@ -254,6 +402,12 @@ if __name__ == "__main__":
                 asyncio.WindowsSelectorEventLoopPolicy()
             )
         asyncio.run(local_chat_loop())
+    elif "--http" in sys.argv:
+        # 長駐的 streamable-HTTP 服務，可以開多個副本給 dispatcher 做負載平衡
+        startup.mark("serving")
+        print(f"🪪 Eligibility Agent Server starting (streamable-http) on http://{MCP_HOST}:{MCP_PORT}/mcp", file=sys.stderr)
+        mcp.run(transport="streamable-http")
     else:
         print("🪪 Eligibility Agent Server starting...", file=sys.stderr)
+        startup.mark("serving")
         mcp.run()
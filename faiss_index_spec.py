@@ -0,0 +1,328 @@
+# faiss_index_spec.py
+# FAISS 索引類型設定 (Index Spec)
+# transfer.py 依照 spec 建索引、把 spec 存在索引資料夾裡；
+# rag_search.load_index 讀回同一份 spec，套用相同的距離與搜尋參數。
+#
+# spec 字串格式：<type>[:key=value,key=value...]
+#   flat                                   -> 精確搜尋 (IndexFlatIP)
+#   hnsw:M=32,efConstruction=80,efSearch=64 -> 圖索引 (IndexHNSWFlat)
+#   ivfpq:nlist=256,m=16,nbits=8,nprobe=16  -> 倒排 + 乘積量化 (IndexIVFPQ，需要訓練)
+#
+# 任何類型都可以再加上壓縮參數 (語料變大時讓索引放得進 CPU cache)：
+#   dim=256                 -> 降到 256 維 (預設 reduce=truncate：取前 256 維再 normalize，Matryoshka 式截斷)
+#   reduce=pca              -> 改用 PCA 降維 (用語料訓練，BGE-M3 不是 Matryoshka 訓練的，通常 recall 掉得比截斷少)
+#   quant=sq8               -> 每維 int8 純量量化 (flat / hnsw)
+#   quant=binary            -> 每維 1 bit (正負號)，Hamming 距離粗排 (只支援 flat，一定要 rescore)
+#   rescore=4               -> 粗排取 k*4 個候選，再用原始 float32 向量算內積重排 (設了 quant 時預設 4；0 = 不重排)
+# 例如 flat:dim=256,reduce=pca,quant=sq8,rescore=4、hnsw:M=32,quant=sq8、flat:quant=binary,rescore=8
+# 查詢向量一樣是 1024 維，降維 / normalize 包在索引裡 (IndexPreTransform)，rag_search 不用改。
+# 建索引時會比較壓縮索引與精確搜尋，把大小、延遲與 recall@10 寫進 index_spec.json 的 "report"。
+#
+# BGE-M3 的向量都有做 normalize，所以一律使用內積 (inner product) = cosine 相似度。
+
+import json
+import os
+import re
+import time
+from typing import Any, Dict
+
+import numpy as np
+
+SPEC_FILENAME = "index_spec.json"
+
+# 各類型的預設參數
+DEFAULT_PARAMS: Dict[str, Dict[str, int]] = {
+    "flat": {},
+    "hnsw": {"M": 32, "efConstruction": 80, "efSearch": 64},
+    "ivfpq": {"nlist": 256, "m": 16, "nbits": 8, "nprobe": 16},
+}
+
+# 查詢時才生效、載入後要重新套用的參數
+SEARCH_PARAMS = ("efSearch", "nprobe")
+
+# 所有類型共用的壓縮參數 (有設定才會出現在 spec["compress"])
+COMPRESS_KEYS = ("dim", "reduce", "quant", "rescore")
+REDUCE_METHODS = ("truncate", "pca")
+QUANT_TYPES = ("none", "sq8", "binary")
+DEFAULT_RESCORE = 4
+REPORT_K = 10
+REPORT_MAX_QUERIES = 200
+
+
+def parse_index_spec(spec_str: str) -> Dict[str, Any]:
+    """
+    把 "hnsw:M=32,efSearch=64" 轉成 {"type": "hnsw", "metric": "ip", "params": {...}}
+    沒寫到的參數會補上 DEFAULT_PARAMS 的預設值。
+    """
+    spec_str = (spec_str or "flat").strip()
+    index_type, _, param_str = spec_str.partition(":")
+    index_type = index_type.strip().lower()
+
+    if index_type not in DEFAULT_PARAMS:
+        raise ValueError(f"不支援的索引類型: {index_type} (可用: {', '.join(DEFAULT_PARAMS)})")
+
+    params = dict(DEFAULT_PARAMS[index_type])
+    compress: Dict[str, Any] = {}
+    for item in filter(None, (p.strip() for p in param_str.split(","))):
+        key, sep, value = item.partition("=")
+        if not sep:
+            raise ValueError(f"參數格式錯誤: {item} (應為 key=value)")
+        key, value = key.strip(), value.strip()
+        if key in COMPRESS_KEYS:
+            compress[key] = value.lower() if key in ("reduce", "quant") else int(value)
+            continue
+        if key not in params:
+            available = ", ".join([*params, *COMPRESS_KEYS])
+            raise ValueError(f"{index_type} 不支援參數 {key} (可用: {available})")
+        params[key] = int(value)
+
+    spec: Dict[str, Any] = {"type": index_type, "metric": "ip", "params": params}
+    if compress:
+        spec["compress"] = _normalize_compress(index_type, compress)
+    return spec
+
+
+def _normalize_compress(index_type: str, compress: Dict[str, Any]) -> Dict[str, Any]:
+    """補上預設值並檢查組合是否可行"""
+    reduce = compress.get("reduce", "truncate" if "dim" in compress else None)
+    quant = compress.get("quant", "none")
+    rescore = compress.get("rescore", DEFAULT_RESCORE if quant != "none" else 0)
+
+    if reduce is not None and reduce not in REDUCE_METHODS:
+        raise ValueError(f"不支援的降維方式: {reduce} (可用: {', '.join(REDUCE_METHODS)})")
+    if reduce is not None and "dim" not in compress:
+        raise ValueError("reduce 需要搭配 dim=<維度>")
+    if quant not in QUANT_TYPES:
+        raise ValueError(f"不支援的量化方式: {quant} (可用: {', '.join(QUANT_TYPES)})")
+    if quant != "none" and index_type == "ivfpq":
+        raise ValueError("ivfpq 本身就是量化索引，不能再加 quant")
+    if quant == "binary" and index_type != "flat":
+        raise ValueError("quant=binary 只支援 flat")
+    if quant == "binary" and rescore <= 0:
+        raise ValueError("quant=binary 的 Hamming 距離不是相似度分數，必須設定 rescore")
+    if rescore < 0:
+        raise ValueError("rescore 不能是負數")
+
+    return {"dim": compress.get("dim"), "reduce": reduce, "quant": quant, "rescore": rescore}
+
+
+def build_faiss_index(spec: Dict[str, Any], vectors: np.ndarray):
+    """
+    依 spec 建立 FAISS index，需要訓練的類型 (IVF-PQ、PCA、SQ8) 會先用 vectors 訓練，最後把 vectors 加進去。
+    資料量太少時會自動縮小 nlist / nbits，並把實際使用的值寫回 spec["params"]。
+    有 spec["compress"] 時，降維包成 IndexPreTransform、重排包成 IndexRefine，對外仍然是 1024 維、內積分數。
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    compress = spec.get("compress")
+    if not compress:
+        index = _base_index(spec, n, dim, quant="none")
+        if not index.is_trained:
+            index.train(vectors)
+        index.add(vectors)
+        apply_search_params(index, spec)
+        return index
+
+    reduced_dim = compress["dim"] or dim
+    if reduced_dim > dim:
+        raise ValueError(f"dim={reduced_dim} 比原本的向量維度 {dim} 還大")
+    index = _base_index(spec, n, reduced_dim, quant=compress["quant"])
+
+    if reduced_dim < dim:
+        index = faiss.IndexPreTransform(index)
+        # prepend：先降維，再 normalize (截斷 / 投影後長度不再是 1，內積要重新變回 cosine)
+        index.prepend_transform(faiss.NormalizationTransform(reduced_dim, 2.0))
+        index.prepend_transform(_reduce_transform(compress["reduce"], dim, reduced_dim))
+
+    if compress["rescore"] > 0:
+        # 重排用原始 float32 向量算內積 (base index 的 metric 都是內積，IndexRefine 會檢查兩者一致)
+        index = faiss.IndexRefine(index, faiss.IndexFlatIP(dim))
+        index.k_factor = compress["rescore"]
+
+    if not index.is_trained:
+        print(f"🏋️ 訓練壓縮索引 ({compress}) ...")
+        index.train(vectors)
+    index.add(vectors)
+    apply_search_params(index, spec)
+    return index
+
+
+def _reduce_transform(method: str, dim: int, reduced_dim: int):
+    """dim -> reduced_dim 的 VectorTransform：truncate 取前 reduced_dim 維 (不需訓練)，pca 用語料訓練"""
+    import faiss
+
+    if method == "pca":
+        return faiss.PCAMatrix(dim, reduced_dim)
+
+    transform = faiss.LinearTransform(dim, reduced_dim, False)
+    faiss.copy_array_to_vector(np.eye(reduced_dim, dim, dtype="float32").ravel(), transform.A)
+    transform.set_is_orthonormal()  # MMR 用 reconstruct 取回向量時需要反向轉換
+    transform.is_trained = True
+    return transform
+
+
+def _base_index(spec: Dict[str, Any], n: int, dim: int, quant: str):
+    """實際存向量 (或壓縮碼) 的 index；需要訓練的在 build_faiss_index 統一 train"""
+    import faiss
+
+    index_type = spec["type"]
+    params = spec["params"]
+
+    if index_type == "flat":
+        if quant == "sq8":
+            index = faiss.IndexScalarQuantizer(dim, faiss.ScalarQuantizer.QT_8bit, faiss.METRIC_INNER_PRODUCT)
+        elif quant == "binary":
+            # 不旋轉、不訓練門檻 = 每維取正負號，查詢用 Hamming 距離
+            index = faiss.IndexLSH(dim, dim, False, False)
+            # IndexLSH 預設標成 L2，IndexRefine 要求粗排與重排的 metric 相同；
+            # Hamming 粗排只提供候選 id，分數一律由 IndexFlatIP 重算，所以標成內積
+            index.metric_type = faiss.METRIC_INNER_PRODUCT
+        else:
+            index = faiss.IndexFlatIP(dim)
+
+    elif index_type == "hnsw":
+        if quant == "sq8":
+            index = faiss.IndexHNSWSQ(dim, faiss.ScalarQuantizer.QT_8bit, params["M"], faiss.METRIC_INNER_PRODUCT)
+        else:
+            index = faiss.IndexHNSWFlat(dim, params["M"], faiss.METRIC_INNER_PRODUCT)
+        index.hnsw.efConstruction = params["efConstruction"]
+
+    elif index_type == "ivfpq":
+        if dim % params["m"] != 0:
+            raise ValueError(f"IVF-PQ 的 m={params['m']} 必須能整除向量維度 {dim}")
+
+        # k-means 每個中心至少要有約 39 筆訓練資料，PQ 每個子空間至少要 2^nbits 筆
+        nlist = max(1, min(params["nlist"], n // 39))
+        nbits = params["nbits"]
+        while nbits > 1 and (1 << nbits) > n:
+            nbits -= 1
+        if nlist != params["nlist"] or nbits != params["nbits"]:
+            print(f"⚠️ 資料只有 {n} 筆，IVF-PQ 參數調整為 nlist={nlist}, nbits={nbits}")
+        params["nlist"], params["nbits"] = nlist, nbits
+        params["nprobe"] = min(params["nprobe"], nlist)
+
+        quantizer = faiss.IndexFlatIP(dim)
+        index = faiss.IndexIVFPQ(quantizer, dim, nlist, params["m"], nbits, faiss.METRIC_INNER_PRODUCT)
+        print(f"🏋️ 訓練 IVF-PQ (nlist={nlist}, m={params['m']}, nbits={nbits}) ...")
+
+    else:
+        raise ValueError(f"不支援的索引類型: {index_type}")
+
+    return index
+
+
+def apply_search_params(index, spec: Dict[str, Any]) -> None:
+    """套用查詢參數 (efSearch / nprobe / 重排倍數)；這些參數不會存在 index.faiss 裡，載入後要重設"""
+    import faiss
+
+    space = faiss.ParameterSpace()
+    for key in SEARCH_PARAMS:
+        if key in spec.get("params", {}):
+            space.set_index_parameter(index, key, spec["params"][key])
+    rescore = (spec.get("compress") or {}).get("rescore")
+    if rescore:
+        space.set_index_parameter(index, "k_factor_rf", rescore)
+
+
+def compression_report(index, vectors: np.ndarray, k: int = REPORT_K, max_queries: int = REPORT_MAX_QUERIES) -> Dict[str, Any]:
+    """
+    壓縮索引 vs 精確搜尋 (IndexFlatIP)：索引大小、每次查詢延遲與 recall@k。
+    查詢用語料裡抽樣的向量 (和實際 query 一樣是 normalize 過的 BGE-M3 向量)。
+    """
+    import faiss
+
+    vectors = np.ascontiguousarray(vectors, dtype="float32")
+    n, dim = vectors.shape
+    k = min(k, n)
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(n, size=min(n, max_queries), replace=False)]
+
+    exact = faiss.IndexFlatIP(dim)
+    exact.add(vectors)
+
+    def timed(ix):
+        started = time.perf_counter()
+        for q in queries:  # 一次一筆，和線上查詢的情況相同
+            ix.search(q.reshape(1, -1), k)
+        ms = (time.perf_counter() - started) * 1000 / len(queries)
+        _scores, ids = ix.search(queries, k)
+        return ms, ids
+
+    exact_ms, exact_ids = timed(exact)
+    ms, ids = timed(index)
+    recall = np.mean([len(set(a) & set(b)) / k for a, b in zip(exact_ids, ids)])
+
+    size = len(faiss.serialize_index(index))
+    # 有 rescore 時另外存了一份 float32 (只有重排的 k*rescore 筆會被讀到)；每次查詢整份掃過的是粗排索引
+    scan_index = faiss.downcast_index(index.base_index) if isinstance(index, faiss.IndexRefine) else index
+    scan_size = len(faiss.serialize_index(scan_index))
+    flat_size = n * dim * 4
+    return {
+        "vectors": n,
+        "index_bytes": size,
+        "scan_bytes": scan_size,
+        "float32_bytes": flat_size,
+        "size_ratio": round(scan_size / flat_size, 3),
+        "latency_ms": round(ms, 3),
+        "exact_latency_ms": round(exact_ms, 3),
+        f"recall@{k}": round(float(recall), 4),
+        "queries": len(queries),
+    }
+
+
+def format_report(report: Dict[str, Any]) -> str:
+    recall_key = next(key for key in report if key.startswith("recall@"))
+    return (
+        f"📉 壓縮索引每次掃描 {report['scan_bytes'] / 1e6:.2f}MB (float32 {report['float32_bytes'] / 1e6:.2f}MB 的 "
+        f"{report['size_ratio']:.0%}，檔案共 {report['index_bytes'] / 1e6:.2f}MB)，查詢 {report['latency_ms']:.3f}ms (精確 {report['exact_latency_ms']:.3f}ms)，"
+        f"{recall_key} {report[recall_key]:.3f}"
+    )
+
+
+def save_spec(folder_path: str, spec: Dict[str, Any]) -> None:
+    with open(os.path.join(folder_path, SPEC_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(spec, f, ensure_ascii=False, indent=2)
+
+
+def load_spec(folder_path: str) -> Dict[str, Any] | None:
+    """讀取索引資料夾內的 spec；舊版索引沒有這個檔案時回傳 None (代表 LangChain 預設的 flat L2)"""
+    path = os.path.join(folder_path, SPEC_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+# ==========================================
+# 依發卡銀行 (issuer) 分片 (Shard)
+# ==========================================
+# 分片後的索引資料夾結構：
+#   cards_rag_faiss_index/
+#     shards.json                 <- manifest：issuer -> 子資料夾、卡片清單、筆數
+#     shards/<issuer>/index.faiss <- 每個 issuer 一個獨立索引 (含自己的 index_spec.json)
+#     shards/<issuer>/index.pkl
+
+SHARDS_FILENAME = "shards.json"
+SHARDS_DIRNAME = "shards"
+
+
+def shard_dirname(issuer: str) -> str:
+    """issuer 名稱轉成安全的資料夾名稱 (保留中文，只換掉路徑不允許的字元)"""
+    return re.sub(r'[\\/:*?"<>|\s]+', "_", issuer.strip()) or "unknown"
+
+
+def load_shard_manifest(folder_path: str) -> Dict[str, Any] | None:
+    """讀取 shards.json；不是分片索引時回傳 None"""
+    path = os.path.join(folder_path, SHARDS_FILENAME)
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def save_shard_manifest(folder_path: str, manifest: Dict[str, Any]) -> None:
+    os.makedirs(folder_path, exist_ok=True)
+    with open(os.path.join(folder_path, SHARDS_FILENAME), "w", encoding="utf-8") as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
@@ -0,0 +1,92 @@
+# index_versions.py
+# 索引資料夾的版本管理：每次發佈一個新版本，用 CURRENT 檔案指向目前版本
+#
+#   cards_rag_faiss_index/
+#     CURRENT                 <- 內容是目前的版本名稱 (整個檔案以 os.replace 原子替換)
+#     versions/<version>/     <- 各版本完整的索引 (index.faiss / index.pkl / index_spec.json / shards.json ...)
+#
+# 發佈流程：新版本先完整寫到 versions/<version>.tmp，rename 成 versions/<version>，最後才切換 CURRENT；
+# 讀取端 (rag_search 的 watcher) 只要看到 CURRENT 改變，就在背景載入新版本再換上，不需要重啟 Agent。
+# 舊版本保留最近 KEEP_VERSIONS 個，方便回滾 (把 CURRENT 改回舊版本名稱即可)。
+#
+# 沒有 CURRENT 的資料夾 (舊版 transfer.py 直接寫出的索引) 視為版本 "legacy"，照舊讀取資料夾本身。
+
+import os
+import shutil
+import time
+from typing import List, Optional, Tuple
+
+CURRENT_FILENAME = "CURRENT"
+VERSIONS_DIRNAME = "versions"
+LEGACY_VERSION = "legacy"
+KEEP_VERSIONS = int(os.getenv("RAG_INDEX_KEEP_VERSIONS", "3"))
+
+
+def current_version(root: str) -> Optional[str]:
+    path = os.path.join(root, CURRENT_FILENAME)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return f.read().strip() or None
+    except FileNotFoundError:
+        return None
+
+
+def resolve_index_dir(root: str) -> Tuple[str, str]:
+    """回傳 (版本名稱, 實際要載入的資料夾)"""
+    version = current_version(root)
+    if version is None:
+        return LEGACY_VERSION, root
+    return version, os.path.join(root, VERSIONS_DIRNAME, version)
+
+
+def list_versions(root: str) -> List[str]:
+    """依建立時間排序 (舊 -> 新)"""
+    folder = os.path.join(root, VERSIONS_DIRNAME)
+    if not os.path.isdir(folder):
+        return []
+    names = [n for n in os.listdir(folder) if not n.endswith(".tmp") and os.path.isdir(os.path.join(folder, n))]
+    return sorted(names, key=lambda n: os.path.getmtime(os.path.join(folder, n)))
+
+
+def set_current(root: str, version: str) -> None:
+    """原子地切換 CURRENT (寫暫存檔、fsync、os.replace)"""
+    if not os.path.isdir(os.path.join(root, VERSIONS_DIRNAME, version)):
+        raise FileNotFoundError(f"版本不存在: {version}")
+    tmp_path = os.path.join(root, CURRENT_FILENAME + ".tmp")
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(version + "\n")
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_path, os.path.join(root, CURRENT_FILENAME))
+
+
+def publish_version(root: str, src_dir: str, version: Optional[str] = None, keep: int = KEEP_VERSIONS) -> str:
+    """
+    把 src_dir (建好的索引) 複製成 root/versions/<version>，切換 CURRENT，並清掉太舊的版本。
+    version 不給時用時間戳記。回傳版本名稱。
+    """
+    version = version or time.strftime("%Y%m%d-%H%M%S")
+    versions_dir = os.path.join(root, VERSIONS_DIRNAME)
+    os.makedirs(versions_dir, exist_ok=True)
+
+    target = os.path.join(versions_dir, version)
+    if not os.path.isdir(target):
+        tmp_dir = target + ".tmp"
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+        shutil.copytree(src_dir, tmp_dir)
+        os.utime(tmp_dir)  # copytree 會複製來源的 mtime；list_versions 依 mtime 排序，改成發佈時間
+        os.replace(tmp_dir, target)
+
+    set_current(root, version)
+    prune_versions(root, keep)
+    return version
+
+
+def prune_versions(root: str, keep: int = KEEP_VERSIONS) -> List[str]:
+    """只保留最近 keep 個版本 (目前版本一定保留)，回傳刪掉的版本"""
+    current = current_version(root)
+    old = [v for v in list_versions(root) if v != current]
+    removed = old[:max(0, len(old) - max(keep - 1, 0))]
+    for version in removed:
+        shutil.rmtree(os.path.join(root, VERSIONS_DIRNAME, version), ignore_errors=True)
+    return removed
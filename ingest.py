@@ -0,0 +1,573 @@
+# ingest.py
+# 一個指令跑完整條資料流程：creditcard_json/*.json -> 統一格式 JSONL -> FAISS 索引
+#
+# 以前要手動依序跑 (轉檔 ->) jsonl_to_csv.py -> transfer.py，每次都從頭算。這裡把流程拆成幾個 stage，
+# 每個 stage 的輸出以「輸入內容 + 參數 + 程式碼」的 sha256 命名 (content-addressed)，存在 .ingest_cache/：
+#
+#   convert (每張卡一個，並行)   creditcard_json/<card>.json            -> convert/<key>.jsonl
+#   merge                        所有卡的 chunk                         -> merge/<key>.jsonl
+#   diff                         merge 結果 vs 上次 publish 的 chunk      -> changes/<輸出>.json (新增 / 修改 / 刪除的 id)
+#   index                        merge 結果 + index spec + 去重複設定    -> index/<key>/
+#   publish                      index/<key>/ 複製成 --output/versions/<key>，再原子切換 --output/CURRENT
+#                                (rag_search 會在背景載入新版本，見 index_versions.py)
+#   pgload (選用，--pg-dsn)      index/<key>/ 的 chunk 與向量 COPY 進 pgvector 表 (connect_database.copy_upsert)
+#   csv (選用，--csv)            merge 結果                             -> 給 Excel 看的 CSV
+#
+# 輸入沒變的 stage 直接沿用快取 (例如只改了 shopee.json，只有 shopee 會重新轉檔；什麼都沒改就什麼都不做)。
+# 向量也有快取 (embeddings.npz，以 chunk 文字的 sha1 為 key)：索引要重建時，只有文字變了的 chunk 會重新 embedding，
+# 每天更新一個方案只會 encode 那一個 chunk。
+# 每次執行會寫 ingest_manifest.json，記錄各 stage 的 key、是否沿用快取與耗時。
+#
+# 用法：
+#   python ingest.py                                    # creditcard_json/ -> cards_rag_faiss_index/
+#   python ingest.py --jsonl cards_rag.jsonl            # 從現有 (人工整理過的) JSONL 開始，跳過 convert / merge
+#   python ingest.py --index-spec "hnsw:M=32,efSearch=64" --output cards_rag_faiss_index_hnsw
+#   python ingest.py --force                            # 忽略快取全部重跑
+#
+# 注意：convert 是依 JSON 結構的通用轉法 (每個 benefit_scheme / benefit_rule / profile ... 一個 chunk)，
+# 文字不會跟手工整理的 cards_rag.jsonl 一模一樣；要沿用手工版本請用 --jsonl。
+
+import argparse
+import asyncio
+import hashlib
+import json
+import os
+import shutil
+import time
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from index_versions import current_version, publish_version
+
+SOURCE_DIR = "creditcard_json"
+CACHE_DIR = os.getenv("INGEST_CACHE_DIR", ".ingest_cache")
+DEFAULT_OUTPUT = "cards_rag_faiss_index"
+MANIFEST_NAME = "ingest_manifest.json"
+EMBEDDING_CACHE_NAME = "embeddings.npz"
+
+# 這些程式碼改了，index stage 的快取就失效 (embedding / 去重複 / 預算 markdown / 索引參數都在裡面)
+INDEX_CODE_FILES = ("transfer.py", "corpus_dedupe.py", "context_packer.py", "faiss_index_spec.py")
+
+# JSON 裡各區塊 -> chunk 的 doc_type (依出現順序轉檔)
+SECTION_DOC_TYPES = (
+    ("credit_card_profile", "credit_card_profile"),
+    ("welcome_offer", "welcome_offer"),
+    ("welcome_offers", "welcome_offer"),
+    ("benefit_scheme", "benefit_scheme"),
+    ("benefit_rule", "benefit_rule"),
+    ("global_rule", "global_rule"),
+)
+DOC_TYPE_LABELS = {
+    "credit_card_profile": "基本資料",
+    "welcome_offer": "新戶優惠",
+    "benefit_scheme": "權益方案",
+    "benefit_rule": "權益規則",
+    "global_rule": "通用規則",
+}
+# 已經放在 chunk 外層欄位或標題裡的 key，本文不再重複
+_SKIP_TEXT_KEYS = {"doc_type", "card_name", "card_family", "family", "bank", "issuer", "source", "id", "scheme_id", "scheme_name"}
+_CHANNEL_KEYS = ("channel", "merchant")
+
+
+# ==========================================
+# 1. 雜湊工具
+# ==========================================
+def _sha256(*parts: Any) -> str:
+    h = hashlib.sha256()
+    for part in parts:
+        data = part if isinstance(part, bytes) else json.dumps(part, ensure_ascii=False, sort_keys=True).encode("utf-8")
+        h.update(len(data).to_bytes(8, "big"))
+        h.update(data)
+    return h.hexdigest()
+
+
+def file_digest(path: str) -> str:
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def _code_digest(paths) -> str:
+    base = os.path.dirname(os.path.abspath(__file__))
+    return _sha256(*[file_digest(os.path.join(base, p)) for p in paths])
+
+
+# ==========================================
+# 2. convert：單一卡片 JSON -> chunk 記錄
+# ==========================================
+def _slug(text: str) -> str:
+    return "".join(ch for ch in str(text).lower() if not ch.isspace())
+
+
+def _render_value(value: Any) -> str:
+    if isinstance(value, dict):
+        parts = [f"{k}：{_render_value(v)}" for k, v in value.items() if v not in (None, "", [], {})]
+        return "；".join(parts)
+    if isinstance(value, list):
+        return "、".join(_render_value(v) for v in value if v not in (None, "", [], {}))
+    return str(value)
+
+
+def _render_text(title: str, item: Dict[str, Any]) -> str:
+    lines = [
+        f"{key}：{_render_value(value)}".rstrip("。")
+        for key, value in item.items()
+        if key not in _SKIP_TEXT_KEYS and value not in (None, "", [], {})
+    ]
+    return f"{title}：" + "。".join(lines) + ("。" if lines else "")
+
+
+def _collect_channels(value: Any, under_channel_key: bool = False) -> List[str]:
+    """從 channel_groups / channel / accelerator_merchants 這類欄位收集通路名稱 (給 channels_flat)"""
+    found: List[str] = []
+    if isinstance(value, dict):
+        for key, sub in value.items():
+            is_channel = under_channel_key or any(k in key.lower() for k in _CHANNEL_KEYS)
+            if is_channel and under_channel_key and isinstance(sub, list):
+                found.append(str(key))  # channel_groups 的群組名稱本身也是關鍵字
+            found.extend(_collect_channels(sub, is_channel))
+    elif isinstance(value, list):
+        for sub in value:
+            found.extend(_collect_channels(sub, under_channel_key))
+    elif under_channel_key and isinstance(value, str) and value.strip():
+        found.append(value.strip())
+    return list(dict.fromkeys(found))
+
+
+def _first_field(data: Dict[str, Any], key: str) -> Optional[str]:
+    for section, _ in SECTION_DOC_TYPES:
+        items = data.get(section)
+        for item in (items if isinstance(items, list) else [items]):
+            if isinstance(item, dict) and item.get(key):
+                return item[key]
+    return None
+
+
+def convert_card_file(path: str) -> List[Dict[str, Any]]:
+    """
+    一個 creditcard_json 檔案 -> chunk 記錄 (格式同 cards_rag.jsonl)。
+    各家檔案結構不同 (區塊可能是 dict 或 list、卡名放在外層或每筆裡)，這裡只依共通的區塊名稱轉。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        data = json.load(f)
+
+    source_file = os.path.basename(path)
+    top = {k: v for k, v in data.items() if not isinstance(v, (dict, list))}
+    records: List[Dict[str, Any]] = []
+    seen_ids = set()
+    # global_rule 這類區塊的每筆資料沒有卡名 / 銀行，沿用檔案裡第一個出現的值
+    default_card = top.get("card_name") or top.get("card_family") or _first_field(data, "card_name") or source_file
+    default_issuer = top.get("issuer") or top.get("bank") or _first_field(data, "issuer") or _first_field(data, "bank")
+
+    for section, doc_type in SECTION_DOC_TYPES:
+        items = data.get(section)
+        if items is None:
+            continue
+        if isinstance(items, dict):
+            items = [items]
+
+        for idx, item in enumerate(items):
+            if not isinstance(item, dict):
+                continue
+            card_family = item.get("card_family") or top.get("card_family")
+            card_name = item.get("card_name") or card_family or default_card
+            issuer = item.get("issuer") or item.get("bank") or default_issuer
+            scheme_name = item.get("scheme_name") or item.get("offer_name")
+            rule_type = item.get("rule_type")
+
+            title = f"{card_name}{DOC_TYPE_LABELS[doc_type]}"
+            if scheme_name:
+                title = f"{card_name}「{scheme_name}」{DOC_TYPE_LABELS[doc_type]}"
+
+            chunk_id = f"{_slug(card_name)}_{doc_type}_{_slug(item.get('id') or item.get('scheme_id') or scheme_name or '')}_idx{idx}"
+            while chunk_id in seen_ids:
+                chunk_id += "_"
+            seen_ids.add(chunk_id)
+
+            valid_period = item.get("valid_period")
+            if isinstance(valid_period, (dict, list)):
+                valid_period = _render_value(valid_period)
+
+            metadata = {
+                "card_family": card_family or card_name,
+                "tier": item.get("tier"),
+                "valid_period": valid_period,
+                "source": item.get("source") or top.get("source"),
+                "source_file": source_file,
+                "source_path": [section, idx],
+                "raw": item,
+            }
+            channels = _collect_channels(item)
+            if channels:
+                metadata["channels_flat"] = channels
+
+            records.append({
+                "id": chunk_id,
+                "text": _render_text(title, item),
+                "card_name": card_name,
+                "issuer": issuer,
+                "doc_type": doc_type,
+                "scheme_name": scheme_name,
+                "rule_type": rule_type,
+                "metadata": metadata,
+            })
+    return records
+
+
+def _write_jsonl(path: str, records) -> int:
+    tmp_path = path + ".tmp"
+    count = 0
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        for record in records:
+            f.write(json.dumps(record, ensure_ascii=False) + "\n")
+            count += 1
+    os.replace(tmp_path, path)  # 寫完才出現，中斷時不會留下半份快取
+    return count
+
+
+def _write_json_atomic(path: str, data: Any) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False)
+    os.replace(tmp_path, path)
+
+
+def _iter_jsonl_lines(paths: List[str]) -> Iterator[Dict[str, Any]]:
+    for path in paths:
+        with open(path, "r", encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    yield json.loads(line)
+
+
+# ==========================================
+# 3. Pipeline
+# ==========================================
+class IngestPipeline:
+    """依序執行各 stage，輸入沒變就沿用 .ingest_cache/ 裡的輸出，並記錄 manifest"""
+
+    def __init__(self, cache_dir: str = CACHE_DIR, force: bool = False, workers: Optional[int] = None):
+        self.cache_dir = cache_dir
+        self.force = force
+        self.workers = workers
+        self.stages: List[Dict[str, Any]] = []
+        self._pending_records: Optional[Tuple[str, Dict[str, str]]] = None
+
+    def _path(self, stage: str, name: str) -> str:
+        folder = os.path.join(self.cache_dir, stage)
+        os.makedirs(folder, exist_ok=True)
+        return os.path.join(folder, name)
+
+    def _record(self, name: str, key: str, cached: bool, started: float, **extra: Any) -> None:
+        entry = {"stage": name, "key": key, "cached": cached, "seconds": round(time.perf_counter() - started, 3), **extra}
+        self.stages.append(entry)
+        status = "沿用快取" if cached else "已執行"
+        print(f"   {'⏭️' if cached else '✅'} {name}: {status} ({entry['seconds']}s) key={key[:12]}")
+
+    # ---------- convert ----------
+    def convert(self, source_dir: str) -> List[Tuple[str, str]]:
+        """每個卡片檔各自一個 convert stage；需要重跑的檔案用 process pool 並行轉檔。回傳 [(key, 輸出路徑)]"""
+        files = sorted(
+            os.path.join(source_dir, name) for name in os.listdir(source_dir) if name.lower().endswith(".json")
+        )
+        if not files:
+            raise FileNotFoundError(f"{source_dir}/ 裡沒有任何 .json 檔")
+
+        converter = _code_digest(("ingest.py",))
+        planned = []
+        for path in files:
+            key = _sha256("convert", converter, file_digest(path))
+            planned.append((path, key, self._path("convert", f"{key}.jsonl")))
+
+        todo = [(path, key, out) for path, key, out in planned if self.force or not os.path.exists(out)]
+        started = time.perf_counter()
+        results: Dict[str, Tuple[int, float]] = {}
+        if todo:
+            with ProcessPoolExecutor(max_workers=self.workers) as pool:
+                futures = {path: pool.submit(_timed_convert, path) for path, _, _ in todo}
+                for path, key, out in todo:
+                    records, seconds = futures[path].result()
+                    results[path] = (_write_jsonl(out, records), seconds)
+
+        outputs = []
+        for path, key, out in planned:
+            if path in results:
+                count, seconds = results[path]
+                self.stages.append({
+                    "stage": f"convert:{os.path.basename(path)}", "key": key, "cached": False,
+                    "seconds": seconds, "records": count, "input": path, "output": out,
+                })
+            else:
+                self.stages.append({
+                    "stage": f"convert:{os.path.basename(path)}", "key": key, "cached": True,
+                    "seconds": 0.0, "input": path, "output": out,
+                })
+            outputs.append((key, out))
+
+        print(f"   {'✅' if todo else '⏭️'} convert: {len(todo)}/{len(planned)} 個卡片檔重新轉檔 "
+              f"(並行，牆鐘 {time.perf_counter() - started:.3f}s)")
+        return outputs
+
+    # ---------- merge ----------
+    def merge(self, converted: List[Tuple[str, str]]) -> Tuple[str, str]:
+        started = time.perf_counter()
+        key = _sha256("merge", [k for k, _ in converted])
+        out = self._path("merge", f"{key}.jsonl")
+        cached = os.path.exists(out) and not self.force
+        extra = {}
+        if not cached:
+            extra["records"] = _write_jsonl(out, _iter_jsonl_lines([p for _, p in converted]))
+        self._record("merge", key, cached, started, output=out, **extra)
+        return key, out
+
+    def use_jsonl(self, path: str) -> Tuple[str, str]:
+        """--jsonl：直接以現有 JSONL 當 merge 的輸出 (key 用檔案內容算)"""
+        started = time.perf_counter()
+        key = _sha256("jsonl", file_digest(path))
+        self._record("jsonl", key, True, started, input=path)
+        return key, path
+
+    # ---------- diff ----------
+    def _records_path(self, output: str) -> str:
+        return self._path("records", f"{_sha256(os.path.abspath(output))[:16]}.json")
+
+    def diff(self, jsonl_key: str, jsonl_path: str, output: str) -> Dict[str, Any]:
+        """和上一次 publish 到 output 的 chunk 比對 (id -> 文字 hash)，寫出變更清單；publish 成功後才更新基準"""
+        started = time.perf_counter()
+        current = {str(r["id"]): _sha256(r.get("text", "")) for r in _iter_jsonl_lines([jsonl_path])}
+        previous_path = self._records_path(output)
+        previous = None
+        if os.path.exists(previous_path):
+            with open(previous_path, "r", encoding="utf-8") as f:
+                previous = json.load(f)
+
+        changes = {
+            "added": sorted(k for k in current if previous is not None and k not in previous),
+            "changed": sorted(k for k in current if previous is not None and k in previous and previous[k] != current[k]),
+            "removed": sorted(k for k in (previous or {}) if k not in current),
+        }
+        out = self._path("changes", f"{_sha256(os.path.abspath(output))[:16]}.json")
+        with open(out, "w", encoding="utf-8") as f:
+            json.dump({"output": output, "first_run": previous is None, **changes}, f, ensure_ascii=False, indent=2)
+
+        self._pending_records = (previous_path, current)
+        counts = {k: len(v) for k, v in changes.items()}
+        self._record("diff", jsonl_key, False, started, output=out, first_run=previous is None, **counts)
+        if previous is not None:
+            print(f"      新增 {counts['added']}、修改 {counts['changed']}、刪除 {counts['removed']} 個 chunk "
+                  f"(共 {len(current)} 個)")
+        return changes
+
+    def _commit_records(self) -> None:
+        if self._pending_records:
+            path, records = self._pending_records
+            _write_json_atomic(path, records)
+
+    # ---------- index ----------
+    def index(self, jsonl_key: str, jsonl_path: str, spec: Dict[str, Any], dedupe: bool, threshold: float) -> Tuple[str, str]:
+        started = time.perf_counter()
+        params = {"spec": spec, "dedupe": dedupe, "threshold": threshold}
+        key = _sha256("index", jsonl_key, params, _code_digest(INDEX_CODE_FILES))
+        out = self._path("index", key)
+        cached = os.path.exists(os.path.join(out, "index.faiss")) and not self.force
+        extra: Dict[str, Any] = {}
+        if not cached:
+            extra = _build_index(
+                jsonl_path, out, spec, dedupe, threshold, os.path.join(self.cache_dir, EMBEDDING_CACHE_NAME)
+            )
+        self._record("index", key, cached, started, output=out, params=params, **extra)
+        return key, out
+
+    # ---------- publish ----------
+    def publish(self, index_key: str, index_dir: str, output: str) -> str:
+        """
+        把快取裡的索引發佈成 output/versions/<index_key 前 12 碼>，再原子切換 output/CURRENT
+        (index_versions.py)；執行中的 Agent 會在背景載入新版本，不用重啟。目前版本已經是這份索引就跳過。
+        """
+        started = time.perf_counter()
+        version = index_key[:12]
+        cached = current_version(output) == version and not self.force
+        if not cached:
+            os.makedirs(output, exist_ok=True)
+            publish_version(output, index_dir, version)
+        self._commit_records()  # 這一版的 chunk 成為下一次 diff 的基準
+        self._record("publish", index_key, cached, started, output=output, version=version)
+        return version
+
+    # ---------- pgload ----------
+    def pg_load(self, index_key: str, index_dir: str, dsn: str) -> None:
+        """把索引的 chunk 與向量批次寫進 pgvector 表 (RAG_BACKEND=pgvector 的 Agent 讀這裡)"""
+        started = time.perf_counter()
+        key = _sha256("pgload", index_key, dsn)
+        marker = self._path("pgload", f"{key}.json")
+        cached = os.path.exists(marker) and not self.force
+        if cached:
+            with open(marker, "r", encoding="utf-8") as f:
+                stats = json.load(f)
+        else:
+            stats = asyncio.run(_pg_load(index_dir, dsn))
+            _write_json_atomic(marker, stats)
+            print(f"      📥 {stats['rows']} 筆 ({stats['rows_per_second']} rows/s)，"
+                  f"更新 {stats['upserted']}、刪除 {stats['deleted']}")
+        self._record("pgload", key, cached, started, **stats)
+
+    # ---------- csv ----------
+    def csv(self, jsonl_key: str, jsonl_path: str, output: str) -> None:
+        started = time.perf_counter()
+        key = _sha256("csv", jsonl_key, _code_digest(("jsonl_to_csv.py",)))
+        out = self._path("csv", f"{key}.csv")
+        cached = os.path.exists(out) and not self.force
+        if not cached:
+            import jsonl_to_csv
+
+            jsonl_to_csv.INPUT_FILE, jsonl_to_csv.OUTPUT_FILE = jsonl_path, out
+            jsonl_to_csv.convert_jsonl_to_csv()
+        shutil.copyfile(out, output)
+        self._record("csv", key, cached, started, output=output)
+
+    def write_manifest(self, paths: List[str], total_seconds: float, index_key: Optional[str]) -> Dict[str, Any]:
+        manifest = {
+            "created_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "index_key": index_key,
+            "total_seconds": round(total_seconds, 3),
+            "stages": self.stages,
+        }
+        for path in paths:
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            with open(path, "w", encoding="utf-8") as f:
+                json.dump(manifest, f, ensure_ascii=False, indent=2)
+        return manifest
+
+
+async def _pg_load(index_dir: str, dsn: str) -> Dict[str, Any]:
+    from connect_database import AsyncChunkStore
+    from pgvector_store import load_faiss_folder
+
+    documents, vectors = load_faiss_folder(index_dir)
+    store = await AsyncChunkStore.create(dsn, min_size=1, max_size=2)
+    try:
+        await store.ensure_schema(vectors.shape[1])
+        return await store.copy_upsert(documents, vectors, replace=True)
+    finally:
+        await store.close()
+
+
+def _timed_convert(path: str) -> Tuple[List[Dict[str, Any]], float]:
+    started = time.perf_counter()
+    records = convert_card_file(path)
+    return records, round(time.perf_counter() - started, 3)
+
+
+def _load_embedding_cache(path: str) -> Dict[bytes, Any]:
+    import numpy as np
+
+    if not os.path.exists(path):
+        return {}
+    with np.load(path) as data:
+        return {bytes(d): v for d, v in zip(data["digests"], data["vectors"])}
+
+
+def _save_embedding_cache(path: str, documents, vectors) -> None:
+    """只存這次索引用到的向量 (舊文字的向量不留，檔案大小跟著語料走)"""
+    import numpy as np
+    from transfer import text_digest
+
+    rows = {}
+    for row, doc in enumerate(documents):
+        rows.setdefault(text_digest(doc.page_content), row)
+    tmp_path = path + ".tmp.npz"
+    np.savez(tmp_path, digests=np.array(list(rows), dtype="S20"), vectors=vectors[list(rows.values())])
+    os.replace(tmp_path, path)
+
+
+def _build_index(
+    jsonl_path: str, output: str, spec: Dict[str, Any], dedupe: bool, threshold: float, embedding_cache: str
+) -> Dict[str, Any]:
+    """index stage 本體：沿用 transfer.py 的串流建索引流程 (只有真的要建時才載入 embedding 模型)"""
+    from corpus_dedupe import Deduper
+    from corpus_dedupe import print_report as print_dedupe_report
+    from transfer import BGE_M3_DIM, _with_precompute, build_vectorstore, iter_jsonl_documents, load_embeddings, text_digest
+
+    known_vectors = _load_embedding_cache(embedding_cache)
+    embeddings = load_embeddings()
+    documents = iter_jsonl_documents(jsonl_path)
+    deduper = Deduper(threshold=threshold) if dedupe else None
+    if deduper is not None:
+        documents = deduper.filter(documents)
+
+    tmp_dir = output + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    built_spec = {**spec, "params": dict(spec["params"])}  # build_vectorstore 會寫回實際參數與壓縮報告
+    documents, vectors = build_vectorstore(
+        _with_precompute(documents), embeddings, built_spec, tmp_dir, known_vectors=known_vectors,
+    )
+    if not os.path.exists(os.path.join(tmp_dir, "index.faiss")):
+        raise RuntimeError("index stage 沒有產生任何索引 (JSONL 是空的？)")
+    os.replace(tmp_dir, output)
+    _save_embedding_cache(embedding_cache, documents, vectors)
+
+    unique = {text_digest(doc.page_content) for doc in documents}
+    reused = sum(1 for d in unique if d in known_vectors)
+    result: Dict[str, Any] = {"embedded": len(unique) - reused, "reused_vectors": reused}
+    if built_spec.get("report"):
+        result["compression"] = built_spec["report"]
+    if deduper is not None:
+        report = deduper.report()
+        print_dedupe_report(report, dim=BGE_M3_DIM)
+        result["dedupe"] = {k: v for k, v in report.items() if k != "merged"}
+    return result
+
+
+def main():
+    from corpus_dedupe import DEFAULT_THRESHOLD
+    from faiss_index_spec import parse_index_spec
+
+    parser = argparse.ArgumentParser(description="creditcard_json -> JSONL -> FAISS 索引 (有快取的一鍵流程)")
+    parser.add_argument("--source", default=SOURCE_DIR, help="卡片 JSON 資料夾")
+    parser.add_argument("--jsonl", help="改從現有的 JSONL 開始 (例如手工整理的 cards_rag.jsonl)，跳過 convert / merge")
+    parser.add_argument("--index-spec", default="flat", help="同 transfer.py --index-spec")
+    parser.add_argument("--output", default=DEFAULT_OUTPUT, help="輸出索引資料夾 (rag_search 讀取的位置)")
+    parser.add_argument("--no-dedupe", action="store_true", help="不做去樣板 / 重複 chunk 合併")
+    parser.add_argument("--near-dup-threshold", type=float, default=DEFAULT_THRESHOLD, help="近似重複的 Jaccard 門檻")
+    parser.add_argument("--csv", help="另外輸出給 Excel 檢視的 CSV 到這個路徑")
+    parser.add_argument("--pg-dsn", help="另外把索引寫進這個 PostgreSQL 的 pgvector 表 (COPY 批次 upsert)")
+    parser.add_argument("--workers", type=int, help="convert 並行的 process 數 (預設 CPU 數)")
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="stage 輸出的快取資料夾")
+    parser.add_argument("--force", action="store_true", help="忽略快取，所有 stage 重跑")
+    args = parser.parse_args()
+
+    pipeline = IngestPipeline(cache_dir=args.cache_dir, force=args.force, workers=args.workers)
+    started = time.perf_counter()
+    index_key = published_key = None
+    print("🚚 開始 ingestion ...")
+    try:
+        if args.jsonl:
+            jsonl_key, jsonl_path = pipeline.use_jsonl(args.jsonl)
+        else:
+            jsonl_key, jsonl_path = pipeline.merge(pipeline.convert(args.source))
+        if args.csv:
+            pipeline.csv(jsonl_key, jsonl_path, args.csv)
+
+        pipeline.diff(jsonl_key, jsonl_path, args.output)
+
+        spec = parse_index_spec(args.index_spec)
+        index_key, index_dir = pipeline.index(jsonl_key, jsonl_path, spec, not args.no_dedupe, args.near_dup_threshold)
+        pipeline.publish(index_key, index_dir, args.output)
+        published_key = index_key
+        if args.pg_dsn:
+            pipeline.pg_load(index_key, index_dir, args.pg_dsn)
+    finally:
+        manifest_paths = [os.path.join(args.cache_dir, MANIFEST_NAME)]
+        if published_key:
+            manifest_paths.append(os.path.join(args.output, MANIFEST_NAME))
+        manifest = pipeline.write_manifest(manifest_paths, time.perf_counter() - started, published_key)
+
+    ran = sum(1 for s in manifest["stages"] if not s["cached"])
+    print(f"📋 manifest: {', '.join(manifest_paths)} ({ran}/{len(manifest['stages'])} 個 stage 有執行，"
+          f"共 {manifest['total_seconds']}s)")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,3 +1,7 @@
+# jsonl_to_csv.py
+# 把 cards_rag.jsonl 轉成 CSV，方便用 Excel 檢視。
+# 建索引不需要這一步：transfer.py 會直接串流讀取 JSONL (保留 list 等型別)。
+
 import json
 import csv
 import os
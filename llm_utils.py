@@ -2,17 +2,22 @@
 LLM 相關工具函式
 
 包含：
-- 本地 BGE-M3 embedding
+- 本地 BGE-M3 embedding（第一次呼叫 query_ai_embedding 才載入模型）
 - Gemini（透過 OpenAI 相容 API）的聊天功能
+
+只用 chat_with_aoai_gpt 的 Agent (agent_demand) 不會 import sentence-transformers / torch。
 """
+import json
 import os
+import threading
 from dotenv import load_dotenv
-from sentence_transformers import SentenceTransformer
 from openai import OpenAI  # 改成使用 OpenAI client（指向 Gemini 相容端點）
 
 # 載入環境變數
 from pathlib import Path
 
+from single_flight import group as single_flight_group
+
 # 在這個檔案所在的資料夾，往上找 .env
 env_path = Path(__file__).parent / ".env"
 load_dotenv(dotenv_path=env_path)
@@ -37,7 +42,20 @@ else:
     print("警告：未設定 GEMINI_API_KEY，chat_with_aoai_gpt 將無法使用。")
 
 # ====== BGE-M3 Embedding（保留原本本地 embedding 設計） ======
-_bge_model = SentenceTransformer("BAAI/bge-m3")
+_bge_model = None
+_bge_lock = threading.Lock()
+
+
+def _get_bge_model():
+    """第一次用到時才 import sentence-transformers 並載入模型 (數秒)"""
+    global _bge_model
+    if _bge_model is None:
+        with _bge_lock:
+            if _bge_model is None:
+                from sentence_transformers import SentenceTransformer
+
+                _bge_model = SentenceTransformer("BAAI/bge-m3")
+    return _bge_model
 
 
 def query_ai_embedding(text: str):
@@ -49,7 +67,7 @@ def query_ai_embedding(text: str):
       這樣可以避免其他檔案大改動。
     """
     try:
-        emb = _bge_model.encode(text, normalize_embeddings=True)
+        emb = _get_bge_model().encode(text, normalize_embeddings=True)
         return emb.tolist()
     except Exception as e:
         print(f"local embedding error (bge-m3): {e}")
@@ -66,7 +84,14 @@ def chat_with_aoai_gpt(messages: list[dict], use_json_format: bool = False) -> s
 
     Returns:
         str: 模型的回應內容，失敗時回傳空字串 ""
+
+    同樣的 messages 同時有好幾個呼叫時只送出一次請求，大家共用回覆 (single_flight)。
     """
+    key = json.dumps([messages, use_json_format], ensure_ascii=False, sort_keys=True)
+    return single_flight_group("chat_with_aoai_gpt").do(key, _chat_once, messages, use_json_format)
+
+
+def _chat_once(messages: list[dict], use_json_format: bool) -> str:
     temperature = 0.7  # 控制回應的創造性/隨機性
 
     if _gemini_client is None:
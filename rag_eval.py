@@ -0,0 +1,195 @@
+# rag_eval.py
+# 檢索品質 vs. 延遲 評估工具
+# 用 golden query set (問題 -> 應該被找回的 chunk id) 比較不同檢索設定的
+# recall@k、MRR 與延遲，確保每一次 search_chunks 的加速都沒有把答案弄丟。
+#
+# 用法：
+#   python rag_eval.py                              # 預設：top_k 3/5/10 × 有無 filter
+#   python rag_eval.py --top-k 5 10                 # 只比較指定的 top_k
+#   python rag_eval.py --configs my_configs.json    # 自訂設定 (見 DEFAULT_CONFIGS 格式)
+#   python rag_eval.py --output eval_result.json    # 另外把結果存成 JSON
+#   python rag_eval.py --mmr                        # 每組設定加比一組 MMR 版本
+
+import argparse
+import json
+import os
+import statistics
+import time
+from typing import Any, Dict, List
+
+from rag_search import DEFAULT_MMR_LAMBDA, FAISS_INDEX_PATH, open_index, search_documents
+
+GOLDEN_PATH = "rag_eval_golden.jsonl"
+
+# 每個設定 (config) 欄位說明：
+#   name:       顯示名稱
+#   top_k:      取回筆數
+#   use_filter: 是否套用 golden set 裡的 filter (模擬 Agent 有帶 card_name 等條件)
+#   index_path: 要評估的 FAISS 索引資料夾，或 postgresql:// 連線字串 (pgvector 後端)
+#   mmr:        是否用 MMR 挑結果 (選填，預設 False)
+#   mmr_lambda: MMR 的相關度權重 (選填，預設 rag_search.DEFAULT_MMR_LAMBDA)
+DEFAULT_CONFIGS: List[Dict[str, Any]] = [
+    {"name": f"k={k}{' +filter' if use_filter else ''}", "top_k": k, "use_filter": use_filter}
+    for k in (3, 5, 10)
+    for use_filter in (False, True)
+]
+
+
+def load_golden(path: str = GOLDEN_PATH) -> List[Dict[str, Any]]:
+    """讀取 golden set，每行格式：{"query": ..., "expected_ids": [...], "filter": {...}(選填)}"""
+    golden = []
+    with open(path, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                golden.append(json.loads(line))
+            except json.JSONDecodeError:
+                print(f"⚠️ 跳過格式錯誤的第 {line_num} 行")
+    return golden
+
+
+def _percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    idx = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[idx]
+
+
+def evaluate_config(config: Dict[str, Any], golden: List[Dict[str, Any]], repeat: int = 1) -> Dict[str, Any]:
+    """對單一設定跑完整個 golden set，回傳 recall@k / MRR / 延遲統計"""
+    top_k = int(config.get("top_k", 5))
+    use_filter = bool(config.get("use_filter", False))
+    index_path = config.get("index_path", FAISS_INDEX_PATH)
+    mmr = bool(config.get("mmr", False))
+    mmr_lambda = float(config.get("mmr_lambda", DEFAULT_MMR_LAMBDA))
+
+    db = open_index(index_path)
+    if db is None:
+        return {"name": config["name"], "error": f"無法載入索引 {index_path}"}
+
+    # 先暖機一次，避免把模型第一次推論的時間算進延遲
+    search_documents(golden[0]["query"], top_k=top_k, db=db, mmr=mmr, mmr_lambda=mmr_lambda)
+
+    recalls, reciprocal_ranks, latencies_ms = [], [], []
+    misses = []
+
+    for item in golden:
+        expected = set(item["expected_ids"])
+        metadata_filter = item.get("filter") if use_filter else None
+
+        hits = []
+        for _ in range(max(1, repeat)):
+            start = time.perf_counter()
+            hits = search_documents(
+                item["query"], top_k=top_k, metadata_filter=metadata_filter, db=db, mmr=mmr, mmr_lambda=mmr_lambda
+            )
+            latencies_ms.append((time.perf_counter() - start) * 1000)
+
+        # 建索引時被合併掉的重複 chunk (merged_ids) 也算找到
+        retrieved_ids = []
+        for doc, _score in hits:
+            retrieved_ids.append(doc.metadata.get("id"))
+            retrieved_ids.extend(doc.metadata.get("merged_ids") or [])
+
+        found = expected.intersection(retrieved_ids)
+        recalls.append(len(found) / len(expected))
+
+        rr = 0.0
+        for rank, chunk_id in enumerate(retrieved_ids, 1):
+            if chunk_id in expected:
+                rr = 1.0 / rank
+                break
+        reciprocal_ranks.append(rr)
+
+        if not found:
+            misses.append(item["query"])
+
+    return {
+        "name": config["name"],
+        "top_k": top_k,
+        "use_filter": use_filter,
+        "index_path": index_path,
+        "index_version": getattr(db, "version", None),
+        "mmr": mmr,
+        "mmr_lambda": mmr_lambda if mmr else None,
+        "queries": len(golden),
+        "recall": statistics.mean(recalls),
+        "mrr": statistics.mean(reciprocal_ranks),
+        "latency_ms_mean": statistics.mean(latencies_ms),
+        "latency_ms_p50": _percentile(latencies_ms, 50),
+        "latency_ms_p95": _percentile(latencies_ms, 95),
+        "misses": misses,
+    }
+
+
+def print_report(results: List[Dict[str, Any]]) -> None:
+    """把各設定並排印成表格"""
+    header = f"{'config':<24}{'recall@k':>10}{'MRR':>8}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}{'miss':>6}"
+    print("\n" + header)
+    print("-" * len(header))
+    for r in results:
+        if "error" in r:
+            print(f"{r['name']:<24}❌ {r['error']}")
+            continue
+        print(
+            f"{r['name']:<24}{r['recall']:>10.3f}{r['mrr']:>8.3f}"
+            f"{r['latency_ms_mean']:>10.1f}{r['latency_ms_p50']:>10.1f}{r['latency_ms_p95']:>10.1f}"
+            f"{len(r['misses']):>6}"
+        )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RAG 檢索品質 / 延遲評估")
+    parser.add_argument("--golden", default=GOLDEN_PATH, help="golden query set (JSONL)")
+    parser.add_argument("--configs", help="自訂設定 JSON 檔 (list of config dict)")
+    parser.add_argument("--top-k", type=int, nargs="+", help="只比較這些 top_k (有無 filter 各一組)")
+    parser.add_argument("--mmr", action="store_true", help="每組設定再多比較一組 MMR 版本")
+    parser.add_argument("--repeat", type=int, default=1, help="每個問題重複幾次，讓延遲數字更穩定")
+    parser.add_argument("--output", help="把完整結果 (含 miss 清單) 存成 JSON")
+    args = parser.parse_args()
+
+    if not os.path.exists(args.golden):
+        print(f"❌ 找不到 golden set: {args.golden}")
+        return
+
+    golden = load_golden(args.golden)
+    if not golden:
+        print("❌ golden set 是空的")
+        return
+
+    if args.configs:
+        with open(args.configs, "r", encoding="utf-8") as f:
+            configs = json.load(f)
+    elif args.top_k:
+        configs = [
+            {"name": f"k={k}{' +filter' if use_filter else ''}", "top_k": k, "use_filter": use_filter}
+            for k in args.top_k
+            for use_filter in (False, True)
+        ]
+    else:
+        configs = DEFAULT_CONFIGS
+
+    if args.mmr:
+        configs = configs + [
+            {**c, "name": f"{c['name']} +mmr", "mmr": True} for c in configs if not c.get("mmr")
+        ]
+
+    print(f"🚀 評估 {len(configs)} 組設定 × {len(golden)} 個問題 ...")
+    results = []
+    for config in configs:
+        print(f"   ⚙️ {config['name']} ...")
+        results.append(evaluate_config(config, golden, repeat=args.repeat))
+
+    print_report(results)
+
+    if args.output:
+        with open(args.output, "w", encoding="utf-8") as f:
+            json.dump(results, f, ensure_ascii=False, indent=2)
+        print(f"\n💾 結果已存至: {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -1,65 +1,443 @@
+from __future__ import annotations
+
+import asyncio
 import json
-from typing import List, Dict, Any, Optional
+import os
+import re
+import sys
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, List, Dict, Any, Optional, Tuple
+
+import numpy as np
 
 # --- 1. LangChain / BGE 相關套件 ---
-from langchain_community.embeddings import HuggingFaceBgeEmbeddings
-from langchain_community.vectorstores import FAISS
+# langchain_community / sentence-transformers / torch / FAISS 要好幾秒才 import 完，
+# 延到第一次查詢 (或 warm_up) 才載入，Agent 才能先回應 MCP 的 initialize
+if TYPE_CHECKING:
+    from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+    from langchain_community.vectorstores import FAISS
+    from langchain_core.documents import Document
+
+from faiss_index_spec import apply_search_params, load_shard_manifest, load_spec
+from index_versions import LEGACY_VERSION, current_version, resolve_index_dir
+from search_results import SearchHit, SearchResults
+from single_flight import group as single_flight_group
 
 # --- 2. 設定與路徑 ---
 FAISS_INDEX_PATH = "cards_rag_faiss_index" # 假設 FAISS 索引已存在並預先建立
 BGE_MODEL_NAME = "BAAI/bge-m3"
+# 檢索後端：faiss (預設，各 process 載入本地索引) 或 pgvector (所有副本共用一張表，見 pgvector_store.py)
+RAG_BACKEND = os.getenv("RAG_BACKEND", "faiss").lower()
+PG_URL_PREFIXES = ("postgresql://", "postgres://")
+# 熱更新：每隔幾秒檢查 FAISS_INDEX_PATH/CURRENT，指向新版本時在背景載入並換上 (0 = 不檢查，只在啟動時載入)
+INDEX_POLL_SECONDS = float(os.getenv("RAG_INDEX_POLL_SECONDS", "5"))
 
 # --- 3. 全域變數 ---
-_faiss_db: Optional[FAISS] = None
+# 全域索引：FAISS 的 IndexSet 或 pgvector_store.PgVectorIndex (兩者有相同的 search / search_mmr 介面)
+# 換版本時只替換這個變數 (查詢開始時取一次參考，進行中的查詢會用舊版本做完)
+_faiss_db: Optional["IndexSet"] = None
+_reload_lock = threading.Lock()
+_watcher: Optional[threading.Thread] = None
+_failed_version: Optional[str] = None  # 載入失敗的版本，不要每次輪詢都重試
+# 多個分片並行查詢用的 thread pool
+_shard_executor = ThreadPoolExecutor(max_workers=os.cpu_count() or 4, thread_name_prefix="faiss-shard")
 # 固定 top_k = 5
 DEFAULT_TOP_K = 5 
 
-# --- 4. 初始化 Embedding 模型 ---
-_embeddings_model: HuggingFaceBgeEmbeddings = HuggingFaceBgeEmbeddings(
-    model_name=BGE_MODEL_NAME,
-    model_kwargs={"device": "cpu"},
-    encode_kwargs={"normalize_embeddings": True},
-)
+# MMR (Maximal Marginal Relevance)：在相關度與多樣性之間取捨，避免 top-k 全是幾乎一樣的 chunk
+# lambda 越接近 1 越重視相關度，越接近 0 越重視多樣性；候選數 = max(top_k * MMR_FETCH_FACTOR, MMR_MIN_FETCH)
+MMR_ENABLED = os.getenv("RAG_MMR", "0") == "1"
+DEFAULT_MMR_LAMBDA = float(os.getenv("RAG_MMR_LAMBDA", "0.7"))
+MMR_FETCH_FACTOR = 4
+MMR_MIN_FETCH = 20
+
+# 檢索結果快取 (所有對話共用，LRU 淘汰) 與各 session 已送出的 chunk 紀錄
+RESULT_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "512"))
+SESSION_LEDGER_MAX = int(os.getenv("RAG_CACHE_MAX_SESSIONS", "256"))
+_result_cache: "OrderedDict[Tuple[str, str, int, str], List[Tuple[Document, float]]]" = OrderedDict()
+_session_seen: "OrderedDict[str, set]" = OrderedDict()
+_cache_lock = threading.Lock()
+_cache_stats = {"hits": 0, "misses": 0, "deduped_chunks": 0}
+
+# --- 4. Embedding 模型 (第一次用到時才載入) ---
+_embeddings_model: Optional[HuggingFaceBgeEmbeddings] = None
+_embeddings_lock = threading.Lock()
+_warmup_stats: Dict[str, Any] = {"state": "idle"}
+
+
+def _get_embeddings() -> HuggingFaceBgeEmbeddings:
+    global _embeddings_model
+    if _embeddings_model is None:
+        with _embeddings_lock:
+            if _embeddings_model is None:
+                from langchain_community.embeddings import HuggingFaceBgeEmbeddings
+
+                _embeddings_model = HuggingFaceBgeEmbeddings(
+                    model_name=BGE_MODEL_NAME,
+                    model_kwargs={"device": "cpu"},
+                    encode_kwargs={"normalize_embeddings": True},
+                )
+    return _embeddings_model
+
+
+def _embed_query(query: str) -> List[float]:
+    """同一句 query 同時有好幾個請求在算 embedding 時只算一次 (回傳的 list 共用，不要就地修改)"""
+    return single_flight_group("embed_query").do(query, lambda: _get_embeddings().embed_query(query))
+
+
+def warm_up(background: bool = True) -> None:
+    """
+    預先載入 embedding 模型與索引 (RAG_BACKEND=pgvector 時是連線池)。
+    Agent 啟動時以 background=True 呼叫：MCP 握手不用等模型載入，第一次查詢也不用從頭等。
+    耗時記在 cache_stats()["warmup"]。
+    """
+    def run() -> None:
+        started = time.perf_counter()
+        _warmup_stats.update(state="running")
+        try:
+            _get_embeddings()
+            _warmup_stats["model_seconds"] = round(time.perf_counter() - started, 3)
+            load_index()
+            _warmup_stats.update(state="done" if _faiss_db is not None else "failed")
+        except Exception as e:
+            _warmup_stats.update(state="failed", error=str(e))
+        _warmup_stats["seconds"] = round(time.perf_counter() - started, 3)
+
+    if not background:
+        run()
+        return
+    if _warmup_stats["state"] == "idle":
+        _warmup_stats["state"] = "scheduled"
+        threading.Thread(target=run, name="rag-warmup", daemon=True).start()
+
+
+def _load_faiss(folder_path: str) -> FAISS:
+    """
+    依資料夾內的 index_spec.json 載入 FAISS 索引：
+    - 有 spec：用內積 (MAX_INNER_PRODUCT) 並重新套用 efSearch / nprobe
+    - 沒有 spec (舊版索引)：維持 LangChain 預設的 flat L2
+    """
+    from langchain_community.vectorstores import FAISS
+    from langchain_community.vectorstores.utils import DistanceStrategy
+
+    spec = load_spec(folder_path)
+    kwargs = {}
+    if spec and spec.get("metric") == "ip":
+        kwargs["distance_strategy"] = DistanceStrategy.MAX_INNER_PRODUCT
+
+    db = FAISS.load_local(
+        folder_path=folder_path,
+        embeddings=_get_embeddings(),
+        allow_dangerous_deserialization=True,
+        **kwargs,
+    )
+    if spec:
+        apply_search_params(db.index, spec)
+        if spec.get("type") == "ivfpq":
+            # MMR 需要用 reconstruct 取回已存的向量，IVF 類索引要先建 direct map (壓縮索引包在 IndexPreTransform 裡)
+            import faiss
+
+            faiss.extract_index_ivf(db.index).make_direct_map()
+    return db
+
+
+def _matches_filter(metadata: Dict[str, Any], metadata_filter: Dict[str, Any] | None) -> bool:
+    """
+    metadata 過濾，支援 list 欄位：
+    - 一般欄位：值相等；filter 值是 list 時代表「其中之一」(同 LangChain FAISS 的 dict filter)
+    - list 欄位 (例如 channels_flat)：filter 值在 list 裡；filter 值是 list 時只要有交集
+    """
+    if not metadata_filter:
+        return True
+    for key, expected in metadata_filter.items():
+        value = metadata.get(key)
+        if isinstance(value, (list, tuple)):
+            wanted = expected if isinstance(expected, list) else [expected]
+            if not any(item in value for item in wanted):
+                return False
+        elif isinstance(expected, list):
+            if value not in expected:
+                return False
+        elif value != expected:
+            return False
+    return True
+
+
+def _filter_func(metadata_filter: Dict[str, Any] | None):
+    """轉成 LangChain FAISS 接受的 callable filter (dict filter 不支援 list 欄位)"""
+    if not metadata_filter:
+        return None
+    return lambda metadata: _matches_filter(metadata, metadata_filter)
+
+
+def _search_with_vectors(
+    db: FAISS, query_vector: np.ndarray, fetch_k: int, metadata_filter: Dict[str, Any] | None
+) -> List[Tuple[Document, float, np.ndarray]]:
+    """
+    直接查 FAISS index，回傳 (Document, score, 已存的向量)。
+    向量用 index.reconstruct 從索引取回，不重新 embedding。
+    有 filter 時多抓一些候選再過濾 (與 LangChain 的 fetch_k 做法相同)。
+    """
+    from langchain_core.documents import Document
+
+    n_search = min(db.index.ntotal, fetch_k * (4 if metadata_filter else 1))
+    if n_search <= 0:
+        return []
+    scores, positions = db.index.search(query_vector.reshape(1, -1), n_search)
+
+    candidates = []
+    for score, pos in zip(scores[0], positions[0]):
+        if pos == -1:
+            continue
+        doc = db.docstore.search(db.index_to_docstore_id[int(pos)])
+        if not isinstance(doc, Document) or not _matches_filter(doc.metadata, metadata_filter):
+            continue
+        candidates.append((doc, float(score), db.index.reconstruct(int(pos))))
+        if len(candidates) >= fetch_k:
+            break
+    return candidates
+
+
+def _mmr_select(query_vector: np.ndarray, vectors: np.ndarray, k: int, lambda_mult: float) -> List[int]:
+    """
+    向量化的 MMR：每一步挑 lambda * sim(query) - (1 - lambda) * max sim(已選) 最大的候選。
+    向量都已 normalize，內積即 cosine；候選間的相似度矩陣只算一次。
+    """
+    if len(vectors) == 0:
+        return []
+    sim_query = vectors @ query_vector
+    sim_pairs = vectors @ vectors.T
+
+    selected = [int(np.argmax(sim_query))]
+    max_sim = sim_pairs[selected[0]].copy()
+    while len(selected) < min(k, len(vectors)):
+        scores = lambda_mult * sim_query - (1 - lambda_mult) * max_sim
+        scores[selected] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        np.maximum(max_sim, sim_pairs[best], out=max_sim)
+    return selected
+
+
+class IndexSet:
+    """
+    一組可一起查詢的 FAISS 索引 (分片)。
+    - 一般索引：只有一個分片 "*"
+    - 依 issuer 分片的索引：每個 issuer 一個分片，查詢時依 filter 決定要查哪些分片，
+      多個分片時用 thread pool 並行查詢 (FAISS 搜尋時會釋放 GIL)，再依分數合併。
+    version / path 是載入的索引版本與實際資料夾 (index_versions.resolve_index_dir)。
+    """
+
+    def __init__(
+        self,
+        shards: Dict[str, FAISS],
+        card_names: Dict[str, set] | None = None,
+        metric: str = "l2",
+        version: str = LEGACY_VERSION,
+        path: str = "",
+    ):
+        self.shards = shards
+        self.card_names = card_names or {}
+        self.metric = metric
+        self.version = version
+        self.path = path
+
+    def route(self, metadata_filter: Dict[str, Any] | None) -> List[str]:
+        """依 filter 挑出需要查詢的分片；無法判斷時回傳全部分片"""
+        if len(self.shards) == 1 or not metadata_filter:
+            return list(self.shards)
+
+        issuer = metadata_filter.get("issuer")
+        if isinstance(issuer, str) and issuer in self.shards:
+            return [issuer]
+
+        card_name = metadata_filter.get("card_name")
+        if isinstance(card_name, str):
+            matched = [name for name, cards in self.card_names.items() if card_name in cards]
+            if matched:
+                return matched
+
+        return list(self.shards)
+
+    def search(self, query: str, k: int, metadata_filter: Dict[str, Any] | None) -> List[Tuple[Document, float]]:
+        targets = self.route(metadata_filter)
+
+        filter_func = _filter_func(metadata_filter)
+        # query 一律經過 _embed_query (single-flight)，不讓 LangChain 自己再 embed 一次
+        query_vector = _embed_query(query)
+        if len(targets) == 1:
+            return self.shards[targets[0]].similarity_search_with_score_by_vector(query_vector, k=k, filter=filter_func)
+
+        # 多分片：各分片並行查詢
+        futures = [
+            _shard_executor.submit(
+                self.shards[name].similarity_search_with_score_by_vector,
+                query_vector, k=k, filter=filter_func,
+            )
+            for name in targets
+        ]
+        merged = [hit for future in futures for hit in future.result()]
+
+        # 內積越大越相似；L2 距離越小越相似
+        merged.sort(key=lambda hit: hit[1], reverse=(self.metric == "ip"))
+        return merged[:k]
+
+    def search_mmr(
+        self, query: str, k: int, metadata_filter: Dict[str, Any] | None, lambda_mult: float, fetch_k: int
+    ) -> List[Tuple[Document, float]]:
+        """
+        MMR 模式：先取 fetch_k 個候選 (各分片並行)，再用候選已存的向量做 MMR 挑出 k 筆。
+        回傳的 score 仍是原本的相似度分數，順序為 MMR 挑選順序。
+        """
+        query_vector = np.asarray(_embed_query(query), dtype="float32")
+        targets = self.route(metadata_filter)
+        futures = [
+            _shard_executor.submit(_search_with_vectors, self.shards[name], query_vector, fetch_k, metadata_filter)
+            for name in targets
+        ]
+        candidates = [c for future in futures for c in future.result()]
+        if not candidates:
+            return []
+
+        vectors = np.vstack([vec for _doc, _score, vec in candidates]).astype("float32", copy=False)
+        order = _mmr_select(query_vector, vectors, k, lambda_mult)
+        return [(candidates[i][0], candidates[i][1]) for i in order]
+
+
+def _open_index_set(folder_path: str) -> IndexSet:
+    """
+    載入資料夾：有 CURRENT 就載入它指向的版本 (ingest.py 發佈的索引)，否則載入資料夾本身；
+    有 shards.json 就載入所有分片，否則當成單一索引
+    """
+    version, folder_path = resolve_index_dir(folder_path)
+    manifest = load_shard_manifest(folder_path)
+    if manifest is None:
+        spec = load_spec(folder_path) or {}
+        return IndexSet({"*": _load_faiss(folder_path)}, metric=spec.get("metric", "l2"), version=version, path=folder_path)
+
+    shards, card_names = {}, {}
+    for issuer, info in manifest["shards"].items():
+        shards[issuer] = _load_faiss(os.path.join(folder_path, info["path"]))
+        card_names[issuer] = set(info.get("card_names", []))
+    metric = manifest.get("spec", {}).get("metric", "l2")
+    return IndexSet(shards, card_names, metric=metric, version=version, path=folder_path)
+
+
+def _describe(db: IndexSet) -> str:
+    if len(db.shards) > 1:
+        return f"{db.path} ({len(db.shards)} 個 issuer 分片, version={db.version})"
+    spec = load_spec(db.path) or {"type": "flat (L2)", "params": {}}
+    return f"{db.path} ({spec['type']} {spec['params']}, version={db.version})"
+
+
+def _open_pgvector(dsn: Optional[str]):
+    """pgvector 後端 (需要 psycopg / pgvector 套件，只有用到時才 import)"""
+    from pgvector_store import PG_DSN, PgVectorIndex
+
+    dsn = dsn or PG_DSN
+    if not dsn:
+        raise ValueError("RAG_BACKEND=pgvector 需要設定 RAG_PG_DSN (或 DB_CONNECTION_STRING)")
+    return PgVectorIndex(dsn, embed_query=_embed_query, mmr_select=_mmr_select)
 
 
 def load_index():
-    """載入 RAG index 到記憶體，只做一次 (使用 FAISS 向量庫)"""
+    """載入 RAG index 到記憶體，只做一次 (FAISS 向量庫；RAG_BACKEND=pgvector 時改為建立資料庫連線池)"""
     global _faiss_db
     if _faiss_db is not None:
         return
 
-    try:
-        # 載入預先建立好的 FAISS 索引和資料
-        _faiss_db = FAISS.load_local(
-            folder_path=FAISS_INDEX_PATH, 
-            embeddings=_embeddings_model, 
-            allow_dangerous_deserialization=True
-        )
-        print(f"✅ RAG FAISS index loaded from {FAISS_INDEX_PATH}")
+    if RAG_BACKEND == "pgvector":
+        try:
+            _faiss_db = _open_pgvector(None)
+            clear_result_cache()
+            print(f"✅ RAG pgvector backend ready (table={_faiss_db.table}, {_faiss_db.count()} chunks)", file=sys.stderr)
+        except Exception as e:
+            print(f"❌ 連接 pgvector 失敗: {e}", file=sys.stderr)
+            _faiss_db = None
+        return
 
-    except Exception as e:
-        print(f"❌ 載入 FAISS 索引失敗，請確保 '{FAISS_INDEX_PATH}' 存在並包含有效索引。錯誤: {e}")
-        _faiss_db = None
+    with _reload_lock:
+        if _faiss_db is None:
+            try:
+                # 載入預先建立好的 FAISS 索引和資料
+                _faiss_db = _open_index_set(FAISS_INDEX_PATH)
+                clear_result_cache()
+                print(f"✅ RAG FAISS index loaded from {_describe(_faiss_db)}", file=sys.stderr)
 
+            except Exception as e:
+                print(f"❌ 載入 FAISS 索引失敗，請確保 '{FAISS_INDEX_PATH}' 存在並包含有效索引。錯誤: {e}", file=sys.stderr)
+                _faiss_db = None
+    _start_watcher()
 
-def search_chunks(
-    query: str,
-    top_k: int = DEFAULT_TOP_K, 
-    metadata_filter: Dict[str, Any] | None = None, # ✅ 改成接收一個字典
-) -> List[Dict[str, Any]]:
+
+def reload_index() -> bool:
     """
-    Args:
-        query: 使用者問題
-        top_k: 回傳筆數
-        metadata_filter: 過濾條件字典，例如 {"card_name": "國泰CUBE卡", "doc_type": "benefit_scheme"}
-                         只要索引中有該欄位，就可以作為過濾條件。
+    CURRENT 指向的版本和目前載入的不同時，載入新版本並換上，回傳是否換了版本。
+    新版本在呼叫端的 thread 載入完成後才替換 _faiss_db，查詢不會看到載入到一半的索引；
+    進行中的查詢繼續用舊版本，之後的查詢用新版本。結果快取的 key 含版本，舊結果不會被新查詢拿到。
     """
-    load_index()
-    
-    if _faiss_db is None:
-        return []
+    global _faiss_db, _failed_version
+    if RAG_BACKEND == "pgvector":
+        return False
 
-    # 1. 處理過濾條件
+    with _reload_lock:
+        version = current_version(FAISS_INDEX_PATH) or LEGACY_VERSION
+        loaded = _faiss_db.version if _faiss_db is not None else None
+        if version == loaded or version == _failed_version:
+            return False
+        started = time.perf_counter()
+        try:
+            new_db = _open_index_set(FAISS_INDEX_PATH)
+        except Exception as e:
+            _failed_version = version
+            print(f"❌ 載入索引版本 {version} 失敗，繼續使用 {loaded}: {e}", file=sys.stderr)
+            return False
+        _failed_version = None
+        _faiss_db = new_db
+    clear_result_cache()
+    print(f"🔄 RAG index 換成 {_describe(new_db)}，載入 {time.perf_counter() - started:.1f}s (原本 {loaded})", file=sys.stderr)
+    return True
+
+
+def _watch_index() -> None:
+    while True:
+        time.sleep(INDEX_POLL_SECONDS)
+        try:
+            reload_index()
+        except Exception as e:
+            print(f"⚠️ 檢查索引版本失敗: {e}", file=sys.stderr)
+
+
+def _start_watcher() -> None:
+    """啟動背景 thread 輪詢 CURRENT (每個 process 一個)"""
+    global _watcher
+    if INDEX_POLL_SECONDS <= 0 or _watcher is not None:
+        return
+    with _reload_lock:
+        if _watcher is None:
+            _watcher = threading.Thread(target=_watch_index, name="rag-index-watcher", daemon=True)
+            _watcher.start()
+
+
+def open_index(folder_path: str = FAISS_INDEX_PATH):
+    """
+    載入指定資料夾的 FAISS 索引並回傳（不會動到 _faiss_db 全域變數）。
+    給評估腳本 (rag_eval.py) 比較不同索引時使用；傳入 postgresql:// 連線字串時開啟 pgvector 後端。
+    """
+    try:
+        if folder_path.startswith(PG_URL_PREFIXES):
+            return _open_pgvector(folder_path)
+        return _open_index_set(folder_path)
+    except Exception as e:
+        print(f"❌ 載入索引失敗 ({folder_path}): {e}")
+        return None
+
+
+def _normalize_filter(metadata_filter: Dict[str, Any] | None) -> Dict[str, Any] | None:
+    """去掉值為 None 的條件、字串去頭尾空白；沒有任何條件時回傳 None"""
     final_filter = {}
     if metadata_filter:
         for k, v in metadata_filter.items():
@@ -69,63 +447,275 @@ def search_chunks(
                 else:
                     final_filter[k] = v
 
-    faiss_filter = final_filter if final_filter else None
+    return final_filter if final_filter else None
+
+
+def _normalize_query(query: str) -> str:
+    """快取用的 query 正規化：小寫、合併空白、去掉結尾的問號/句號"""
+    return re.sub(r"\s+", " ", (query or "").strip().lower()).rstrip("?？。.!！ ")
+
+
+def _cache_key(query: str, faiss_filter: Dict[str, Any] | None, top_k: int, mode: str = "") -> Tuple[str, str, int, str]:
+    filter_key = json.dumps(faiss_filter or {}, ensure_ascii=False, sort_keys=True, default=str)
+    return (_normalize_query(query), filter_key, int(top_k), mode)
+
+
+def clear_result_cache() -> None:
+    """清空檢索結果快取 (索引重新載入後，舊的結果就不能再用)"""
+    with _cache_lock:
+        _result_cache.clear()
+
+
+def cache_stats() -> Dict[str, Any]:
+    with _cache_lock:
+        return {
+            **_cache_stats,
+            "entries": len(_result_cache),
+            "max_entries": RESULT_CACHE_MAX_ENTRIES,
+            "sessions": len(_session_seen),
+            "index_version": getattr(_faiss_db, "version", None),
+            "warmup": dict(_warmup_stats),
+        }
+
 
-    # 2. 執行 FAISS 檢索
+def end_session(session_id: str) -> None:
+    """Agent 的一次 ReAct loop 結束時呼叫，釋放這個 session 已送出 chunk 的紀錄"""
+    with _cache_lock:
+        _session_seen.pop(session_id, None)
+
+
+def search_documents(
+    query: str,
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: Dict[str, Any] | None = None,
+    db: Optional[IndexSet] = None,
+    mmr: bool | None = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+) -> List[Tuple[Document, float]]:
+    """
+    回傳原始檢索結果 [(Document, score), ...]，不做任何格式化。
+    search_chunks 與評估腳本共用這一層。
+
+    查全域索引時會先查結果快取 (key = 正規化 query + filter + top_k + 檢索模式)，
+    同樣的問題在同一個 ReAct loop 或不同輪對話裡重問，不會再做 embedding 與 FAISS 搜尋。
+
+    Args:
+        db: 指定要查的索引；不給就用 load_index() 載入的全域索引 (指定索引時不走快取)
+        mmr: 是否用 MMR 挑結果 (兼顧多樣性)；None 代表依 RAG_MMR 環境變數
+        mmr_lambda: MMR 的相關度權重 (0~1)，越小越重視多樣性
+    """
+    return _search_documents(query, top_k, metadata_filter, db, mmr, mmr_lambda)[0]
+
+
+def _search_documents(
+    query: str,
+    top_k: int,
+    metadata_filter: Dict[str, Any] | None,
+    db: Optional[IndexSet],
+    mmr: bool | None,
+    mmr_lambda: float,
+) -> Tuple[List[Tuple[Document, float]], Optional[str]]:
+    """search_documents 的實作，另外回傳回答這次查詢的索引版本"""
+    if mmr is None:
+        mmr = MMR_ENABLED
+    use_cache = db is None and RESULT_CACHE_MAX_ENTRIES > 0
+    if db is None:
+        load_index()
+        db = _faiss_db  # 只取一次：查詢途中換版本也不影響這次查詢
+
+    if db is None:
+        return [], None
+
+    # 1. 處理過濾條件
+    faiss_filter = _normalize_filter(metadata_filter)
+
+    fetch_k = max(top_k * MMR_FETCH_FACTOR, MMR_MIN_FETCH)
+    version = db.version  # pgvector 的版本會查資料庫，這次查詢只讀一次
+    mode = f"{version}|mmr:{mmr_lambda:.2f}:{fetch_k}" if mmr else f"{version}|"
+    key = _cache_key(query, faiss_filter, top_k, mode) if use_cache else None
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached, version
+
+    # 2. 執行 FAISS 檢索 (分片索引會自動挑分片 / 並行查詢)
     try:
-        results = _faiss_db.similarity_search(
-            query, 
-            k=top_k,
-            filter=faiss_filter # ✅ 直接傳入處理好的字典
-        )
+        if mmr:
+            hits = db.search_mmr(query, k=top_k, metadata_filter=faiss_filter, lambda_mult=mmr_lambda, fetch_k=fetch_k)
+        else:
+            hits = db.search(query, k=top_k, metadata_filter=faiss_filter)
     except Exception as e:
-        print(f"❌ FAISS 檢索失敗: {e}")
-        return []
+        print(f"❌ 向量檢索失敗: {e}", file=sys.stderr)
+        return [], version
+
+    _cache_put(key, hits)
+    return list(hits), version
 
-    formatted_chunks = []
-    print(results)
-    for i, doc in enumerate(results, 1):
-        meta = doc.metadata
-        content = doc.page_content
-
-        # 1. 提取關鍵欄位 (如果沒有則留空或顯示預設值)
-        card_name = meta.get("card_name", "未知卡片")
-        scheme_name = meta.get("scheme_name")
-        doc_type = meta.get("doc_type", "一般資訊")
-        valid_period = meta.get("valid_period", "未指定")
-        
-        # 2. 處理 title，讓 LLM 一眼知道這段是在講什麼
-        if scheme_name:
-            title = f"{card_name} - {scheme_name} ({doc_type})"
-        else:
-            title = f"{card_name} ({doc_type})"
 
-        # 3. 處理指定通路列表 (channels_flat)
-        # 這對回答「麥當勞有沒有回饋」這類問題至關重要
-        channels_flat = meta.get("channels_flat", [])
-        channels_str = ""
-        if channels_flat and isinstance(channels_flat, list):
-            # 將列表轉為逗號分隔字串，節省 token 但保持語意
-            channels_str = f"\n- **包含通路關鍵字**: {', '.join(channels_flat)}"
+def _cache_get(key) -> Optional[List[Tuple[Document, float]]]:
+    if key is None:
+        return None
+    with _cache_lock:
+        cached = _result_cache.get(key)
+        if cached is None:
+            _cache_stats["misses"] += 1
+            return None
+        _result_cache.move_to_end(key)
+        _cache_stats["hits"] += 1
+        return list(cached)
 
-        # 4. 組裝單個 Chunk 的文本
-        # 使用 Markdown 格式，讓 LLM 容易區分不同區塊
-        chunk_text = (
-            f"### 資料來源 {i}: {title}\n"
-            f"- **適用期間**: {valid_period}\n"
-            f"- **內容詳情**: {content}"
-            f"{channels_str}"
-        )
-        
-        formatted_chunks.append(chunk_text)
 
-    # 5. 將所有 chunks 用分隔線接起來
-    return "\n\n---\n\n".join(formatted_chunks)
+def _cache_put(key, hits: List[Tuple[Document, float]]) -> None:
+    if key is None:
+        return
+    with _cache_lock:
+        _result_cache[key] = hits
+        _result_cache.move_to_end(key)
+        while len(_result_cache) > RESULT_CACHE_MAX_ENTRIES:
+            _result_cache.popitem(last=False)
+
+
+async def search_documents_async(
+    query: str,
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: Dict[str, Any] | None = None,
+    mmr: bool | None = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+) -> List[Tuple[Document, float]]:
+    """
+    search_documents 的 async 版本 (給 Agent 的 async handler 用)：
+    - RAG_BACKEND=pgvector：query embedding 丟到 thread，資料庫查詢走 asyncpg (connect_database)，不佔用 thread
+    - FAISS：整個 search_documents 丟到 thread
+    結果快取與同步版共用。
+    """
+    return (await _search_documents_async(query, top_k, metadata_filter, mmr, mmr_lambda))[0]
+
+
+async def _search_documents_async(
+    query: str,
+    top_k: int,
+    metadata_filter: Dict[str, Any] | None,
+    mmr: bool | None,
+    mmr_lambda: float,
+) -> Tuple[List[Tuple[Document, float]], Optional[str]]:
+    if RAG_BACKEND != "pgvector":
+        return await asyncio.to_thread(_search_documents, query, top_k, metadata_filter, None, mmr, mmr_lambda)
+
+    from connect_database import get_store
+
+    if mmr is None:
+        mmr = MMR_ENABLED
+    faiss_filter = _normalize_filter(metadata_filter)
+    fetch_k = max(top_k * MMR_FETCH_FACTOR, MMR_MIN_FETCH)
+
+    try:
+        store = await get_store()
+        version = await store.version()
+    except Exception as e:
+        print(f"❌ 向量檢索失敗: {e}", file=sys.stderr)
+        return [], None
+    # 與 _search_documents 相同的 key (含資料版本)：兩條路徑共用快取，資料表更新後舊結果不再命中
+    mode = f"{version}|mmr:{mmr_lambda:.2f}:{fetch_k}" if mmr else f"{version}|"
+    key = _cache_key(query, faiss_filter, top_k, mode) if RESULT_CACHE_MAX_ENTRIES > 0 else None
+    cached = _cache_get(key)
+    if cached is not None:
+        return cached, version
+
+    try:
+        query_vector = np.asarray(await asyncio.to_thread(_embed_query, query), dtype="float32")
+        rows = await store.search(query_vector, fetch_k if mmr else top_k, faiss_filter, with_vectors=mmr)
+    except Exception as e:
+        print(f"❌ 向量檢索失敗: {e}", file=sys.stderr)
+        return [], version
+
+    order = range(len(rows))
+    if mmr and rows:
+        vectors = np.vstack([np.asarray(row["embedding"], dtype="float32") for row in rows])
+        order = _mmr_select(query_vector, vectors, top_k, mmr_lambda)
+    from langchain_core.documents import Document
+
+    hits = [(Document(page_content=rows[i]["content"], metadata=rows[i]["metadata"]), float(rows[i]["score"])) for i in order]
+    _cache_put(key, hits)
+    return list(hits), version
+
+
+class _SessionLedger:
+    """某個 session 已送出全文的 chunk 紀錄，交給 SearchResults 在渲染時使用"""
 
+    __slots__ = ("session_id",)
+
+    def __init__(self, session_id: str):
+        self.session_id = session_id
+
+    def sent_ids(self) -> set:
+        """這個 session 已經送出全文的 chunk id (複本)"""
+        with _cache_lock:
+            seen = _session_seen.get(self.session_id)
+            if seen is None:
+                seen = _session_seen[self.session_id] = set()
+            _session_seen.move_to_end(self.session_id)
+            while len(_session_seen) > SESSION_LEDGER_MAX:
+                _session_seen.popitem(last=False)
+            return set(seen)
+
+    def mark(self, chunk_ids: List[str], referenced: int) -> None:
+        """記下這次送出全文的 chunk id；referenced 為這次改成引用的筆數"""
+        with _cache_lock:
+            _session_seen.setdefault(self.session_id, set()).update(chunk_ids)
+            _cache_stats["deduped_chunks"] += referenced
+
+
+def search_chunks(
+    query: str,
+    top_k: int = DEFAULT_TOP_K, 
+    metadata_filter: Dict[str, Any] | None = None, # ✅ 改成接收一個字典
+    session_id: str | None = None,
+    mmr: bool | None = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+) -> SearchResults:
+    """
+    回傳結構化的檢索結果 (SearchResults，可迭代出 SearchHit)。
+    要放進 prompt 時再呼叫 results.to_markdown() / results.to_json()，
+    這時才會依 token 預算整理、去重複、截短通路清單。
+
+    Args:
+        query: 使用者問題
+        top_k: 回傳筆數
+        metadata_filter: 過濾條件字典，例如 {"card_name": "國泰CUBE卡", "doc_type": "benefit_scheme"}
+                         只要索引中有該欄位，就可以作為過濾條件。
+        session_id: Agent 一次 ReAct loop 的識別碼。有帶的話，同一個 session 已經送過的 chunk
+                    渲染時只會輸出標題與 chunk id 的引用，不再重複塞入全文。
+        mmr: 用 MMR 挑結果，讓較小的 top_k 涵蓋更多不同的資訊；None 代表依 RAG_MMR 環境變數
+        mmr_lambda: MMR 的相關度權重 (0~1)，越小越重視多樣性
+    """
+    hits, version = _search_documents(query, top_k, metadata_filter, None, mmr, mmr_lambda)
+    return SearchResults(
+        query,
+        [SearchHit.from_document(doc, score) for doc, score in hits],
+        ledger=_SessionLedger(session_id) if session_id else None,
+        index_version=version,
+    )
+
+
+async def search_chunks_async(
+    query: str,
+    top_k: int = DEFAULT_TOP_K,
+    metadata_filter: Dict[str, Any] | None = None,
+    session_id: str | None = None,
+    mmr: bool | None = None,
+    mmr_lambda: float = DEFAULT_MMR_LAMBDA,
+) -> SearchResults:
+    """search_chunks 的 async 版本，參數與回傳相同 (見 search_documents_async)"""
+    hits, version = await _search_documents_async(query, top_k, metadata_filter, mmr, mmr_lambda)
+    return SearchResults(
+        query,
+        [SearchHit.from_document(doc, score) for doc, score in hits],
+        ledger=_SessionLedger(session_id) if session_id else None,
+        index_version=version,
+    )
 
 
-def rag_search(query: str, top_k: int = DEFAULT_TOP_K) -> List[Dict[str, Any]]:
+def rag_search(query: str, top_k: int = DEFAULT_TOP_K) -> SearchResults:
     """
     簡單封裝：如果不需要卡片/文件類型過濾，就直接用這個。
     """
-    return search_chunks(query, top_k=top_k)
\ No newline at end of file
+    return search_chunks(query, top_k=top_k)
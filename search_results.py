@@ -0,0 +1,108 @@
+# search_results.py
+# 檢索結果的型別：SearchHit (單筆) / SearchResults (一次查詢的結果)
+#
+# search_chunks 以前直接回傳接好的 markdown 字串，呼叫端如果想拿欄位 (卡名、文件類型) 只能再拆字串，
+# 或是把字串再 json.dumps 一次。現在檢索 API 回傳結構化的結果，
+# 等到真的要放進 prompt 時才呼叫 to_markdown() / to_json() 產生文字，而且每種格式只產生一次。
+#
+# 用法：
+#   results = search_chunks("CUBE 卡年費", metadata_filter={"card_name": "國泰CUBE卡"})
+#   for hit in results:
+#       print(hit.card, hit.doc_type, hit.score)
+#   prompt_text = results.to_markdown()         # 依 token 預算整理成 markdown (context_packer.pack)
+#   tool_output = results.to_json()             # 精簡 JSON：[{"id","card","type","content"}, ...]
+
+import json
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+from context_packer import DEFAULT_TOKEN_BUDGET, pack
+
+
+class SearchHit:
+    """單筆檢索結果；metadata 直接引用 Document.metadata，不複製"""
+
+    __slots__ = ("id", "score", "card", "doc_type", "text", "metadata")
+
+    def __init__(self, id: Optional[str], score: float, card: str, doc_type: str, text: str, metadata: Dict[str, Any]):
+        self.id = id
+        self.score = score
+        self.card = card
+        self.doc_type = doc_type
+        self.text = text
+        self.metadata = metadata
+
+    @classmethod
+    def from_document(cls, doc: Any, score: float) -> "SearchHit":
+        meta = doc.metadata
+        return cls(
+            id=str(meta["id"]) if meta.get("id") else None,
+            score=float(score),
+            card=meta.get("card_name") or "未知卡片",
+            doc_type=meta.get("doc_type") or "一般資訊",
+            text=doc.page_content,
+            metadata=meta,
+        )
+
+    def __repr__(self) -> str:
+        return f"SearchHit(id={self.id!r}, card={self.card!r}, doc_type={self.doc_type!r}, score={self.score:.4f})"
+
+
+class SearchResults:
+    """
+    一次查詢的結果 (依相關度排序)。可以像 list 一樣迭代 / 取長度 / 判斷是否為空。
+
+    ledger 是 session 的 chunk 紀錄 (rag_search 提供，需有 sent_ids() / mark(ids, referenced))；
+    有 ledger 時，渲染會把同一個 session 已送過的 chunk 改成引用，並記下這次送出的 chunk。
+    index_version 是回答這次查詢的索引版本 (index_versions.py)，方便追查某個回答是用哪一版資料產生的。
+    """
+
+    __slots__ = ("query", "hits", "ledger", "index_version", "_rendered")
+
+    def __init__(self, query: str, hits: List[SearchHit], ledger: Any = None, index_version: Optional[str] = None):
+        self.query = query
+        self.hits = hits
+        self.ledger = ledger
+        self.index_version = index_version
+        self._rendered: Dict[Tuple[str, Optional[int]], str] = {}
+
+    def __len__(self) -> int:
+        return len(self.hits)
+
+    def __iter__(self) -> Iterator[SearchHit]:
+        return iter(self.hits)
+
+    def __getitem__(self, index):
+        return self.hits[index]
+
+    def __repr__(self) -> str:
+        return f"SearchResults(query={self.query!r}, hits={len(self.hits)}, index_version={self.index_version!r})"
+
+    def _render(self, fmt: str, token_budget: Optional[int]) -> List[Any]:
+        already_sent = self.ledger.sent_ids() if self.ledger is not None else None
+        packed, sent_ids = pack(
+            [(hit.metadata, hit.text) for hit in self.hits],
+            self.query,
+            token_budget=token_budget,
+            already_sent=already_sent,
+            fmt=fmt,
+        )
+        if self.ledger is not None:
+            referenced = sum(1 for hit in self.hits if hit.id in already_sent)
+            self.ledger.mark(sent_ids, referenced)
+        return packed
+
+    def to_markdown(self, token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET) -> str:
+        """依 token 預算整理成 markdown (各 chunk 用分隔線隔開)；同樣的參數只會產生一次"""
+        key = ("markdown", token_budget)
+        if key not in self._rendered:
+            self._rendered[key] = "\n\n---\n\n".join(self._render("markdown", token_budget))
+        return self._rendered[key]
+
+    def to_json(self, token_budget: Optional[int] = DEFAULT_TOKEN_BUDGET) -> str:
+        """精簡 JSON (無縮排)：[{"id","card","type","content","channels"?}, ...]；同樣的參數只會產生一次"""
+        key = ("json", token_budget)
+        if key not in self._rendered:
+            self._rendered[key] = json.dumps(
+                self._render("json", token_budget), ensure_ascii=False, separators=(",", ":")
+            )
+        return self._rendered[key]
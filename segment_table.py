@@ -0,0 +1,344 @@
+# segment_table.py
+# 預先算好的「客群 -> 推薦卡片」表：常見的推薦問題直接查表回答，不用跑 comparing_agent 的 ReAct loop
+#
+# agent_demand 已經把使用者分成 身分 × 年收入級距 × 消費習慣，但每次求推薦還是要讓 comparing_agent
+# 呼叫好幾次 LLM + RAG。客群組合其實是有限的 (6 種身分 × 5 個年收級距 × 3 類消費習慣的組合 = 240 個)，
+# 這裡離線把每個組合的推薦排名算好：
+#   - 申辦門檻 (card_catalog：年收入、現職年資) 決定能不能辦 / 需要確認
+#   - 消費習慣對應卡片的適合族群與權益方案 (關鍵字比對)，命中的 chunk id 當作佐證
+#   - 年收級距與卡片等級、年費是否相稱
+# 全部是規則計算，同一份語料每次產生的表都一樣；語料或這支程式改了，表的 version 就會變。
+#
+# 線上：agent_client 拿到 demand_agent 的 profile 後先查表 (SegmentTable.answer)，
+# 查得到就把表裡的推薦當作 comparing_agent 的結果交給 Router 整合；查不到 (身分不在表內、未成年、
+# 消費習慣對不到任何類別、表不存在) 才照舊呼叫 comparing_agent。
+#
+# 用法：
+#   python segment_table.py build                         # cards_rag.jsonl -> segment_table.json
+#   python segment_table.py lookup '{"identity_type": "學生", "annual_income": 240000, "spending_habits": ["蝦皮"]}'
+
+import argparse
+import hashlib
+import itertools
+import json
+import os
+import threading
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+from card_catalog import DEFAULT_JSONL, card_chunks, iter_records, load_catalog
+
+DEFAULT_TABLE_PATH = os.getenv("SEGMENT_TABLE_PATH", "segment_table.json")
+TOP_N = 3
+EVIDENCE_PER_HABIT = 2
+EVIDENCE_SNIPPET_CHARS = 120
+
+IDENTITIES = ("學生", "社會新鮮人", "上班族", "家管", "退休", "未知")
+# (名稱, 下限, 上限)；級距同 agent_demand 的規則 B
+INCOME_BANDS: Tuple[Tuple[str, Optional[int], Optional[int]], ...] = (
+    ("未知", None, None),
+    ("<20萬", 0, 200000),
+    ("20-60萬", 200000, 600000),
+    ("60-200萬", 600000, 2000000),
+    (">=200萬", 2000000, None),
+)
+# 消費習慣類別 -> 關鍵字 (同時用來對應使用者的 spending_habits 與卡片的適合族群 / 權益方案)
+HABIT_GROUPS: Dict[str, Tuple[str, ...]] = {
+    "網購": ("蝦皮", "網購", "電商"),
+    "旅遊": ("旅遊", "出國", "日本", "差旅", "哩程", "里程", "機場"),
+    "日常": ("全聯", "超商", "百貨", "加油", "日常", "餐廳", "美食", "生活"),
+}
+# 沒有工作收入證明的身分，遇到「現職滿一年」的卡直接不推薦
+NO_EMPLOYMENT = ("學生", "家管", "退休")
+HIGH_FEE = 5000
+
+
+# ==========================================
+# 客群
+# ==========================================
+def income_band(income: Any) -> str:
+    if not isinstance(income, (int, float)) or isinstance(income, bool):
+        return "未知"
+    for name, low, high in INCOME_BANDS[1:]:
+        if income >= low and (high is None or income < high):
+            return name
+    return "未知"
+
+
+def habit_groups(habits: Any) -> Optional[List[str]]:
+    """spending_habits -> 排序後的類別；有填習慣但一個都對不到時回傳 None (交給 LLM)"""
+    habits = [str(h) for h in habits or []]
+    groups = sorted({g for g, words in HABIT_GROUPS.items() for h in habits if any(w in h for w in words)})
+    if habits and not groups:
+        return None
+    return groups
+
+
+def make_key(identity: str, band: str, groups: List[str]) -> str:
+    return f"{identity}|{band}|{'+'.join(groups) or '-'}"
+
+
+def segment_key(profile: Dict[str, Any]) -> Optional[str]:
+    """demand_agent 的 profile -> 表的 key；表沒有涵蓋的 profile 回傳 None"""
+    if not isinstance(profile, dict) or profile.get("error"):
+        return None
+    identity = profile.get("identity_type") or "未知"
+    if identity not in IDENTITIES:
+        return None
+    age = profile.get("age")
+    if isinstance(age, (int, float)) and age < 18:
+        return None  # 未成年要法定代理人同意 / 只能辦附卡，交給 LLM 說明
+    groups = habit_groups(profile.get("spending_habits"))
+    if groups is None:
+        return None
+    return make_key(identity, income_band(profile.get("annual_income")), groups)
+
+
+def all_segments() -> List[Tuple[str, str, List[str]]]:
+    habit_sets = [
+        list(combo) for r in range(len(HABIT_GROUPS) + 1) for combo in itertools.combinations(sorted(HABIT_GROUPS), r)
+    ]
+    return [(i, band[0], groups) for i in IDENTITIES for band in INCOME_BANDS for groups in habit_sets]
+
+
+# ==========================================
+# 離線計算
+# ==========================================
+def _eligibility(card: Dict[str, Any], identity: str, band: str) -> Tuple[str, List[str]]:
+    """回傳 (eligible / uncertain / ineligible, 原因)"""
+    reasons: List[str] = []
+    status = "eligible"
+    min_income = card.get("min_income")
+    low, high = next((lo, hi) for name, lo, hi in INCOME_BANDS if name == band)
+
+    if min_income:
+        if low is None and min_income > INCOME_BANDS[1][2]:
+            return "ineligible", [f"年收入未知，不推薦門檻 NT${min_income:,} 的卡"]
+        if low is None:
+            status = "uncertain"
+            reasons.append(f"需確認年收入是否達 NT${min_income:,}")
+        elif low >= min_income:
+            reasons.append(f"年收入 {band} 達門檻 NT${min_income:,}")
+        elif high is not None and high <= min_income:
+            return "ineligible", [f"年收入 {band} 未達門檻 NT${min_income:,}"]
+        else:
+            status = "uncertain"
+            reasons.append(f"年收入 {band} 可能未達門檻 NT${min_income:,}")
+
+    if card.get("needs_employment"):
+        if identity in NO_EMPLOYMENT:
+            return "ineligible", [f"需現職滿一年，{identity}不符合"]
+        if identity in ("社會新鮮人", "未知"):
+            status = "uncertain"
+            reasons.append("需確認現職是否滿一年")
+
+    for extra in card.get("extra_requirements") or []:
+        reasons.append(f"另需：{extra}")
+    return status, reasons
+
+
+def _habit_evidence(chunks: List[Dict[str, Any]], words: Tuple[str, ...]) -> List[Dict[str, Any]]:
+    """權益方案 / 首刷禮 chunk 中命中關鍵字最多的幾筆"""
+    scored = []
+    for chunk in chunks:
+        if chunk.get("doc_type") not in ("benefit_scheme", "welcome_offer"):
+            continue
+        hits = sum(chunk.get("text", "").count(w) for w in words)
+        if hits:
+            scored.append((hits, chunk))
+    scored.sort(key=lambda item: -item[0])
+    return [chunk for _hits, chunk in scored[:EVIDENCE_PER_HABIT]]
+
+
+def _snippet(chunk: Dict[str, Any]) -> Dict[str, str]:
+    text = chunk.get("text", "")
+    if len(text) > EVIDENCE_SNIPPET_CHARS:
+        text = text[:EVIDENCE_SNIPPET_CHARS] + "…"
+    return {"id": str(chunk["id"]), "text": text}
+
+
+def rank_cards(
+    catalog: Dict[str, Dict[str, Any]],
+    records: List[Dict[str, Any]],
+    identity: str,
+    band: str,
+    groups: List[str],
+) -> List[Dict[str, Any]]:
+    ranked = []
+    for name, card in catalog.items():
+        status, reasons = _eligibility(card, identity, band)
+        if status == "ineligible":
+            continue
+
+        score = -1.5 if status == "uncertain" else 0.0
+        chunks = card_chunks(records, name)
+        evidence = [r for r in chunks if str(r["id"]) == card["profile_id"]]
+        fit_text = card.get("fit_text", "")
+
+        if identity in fit_text:
+            score += 2
+            reasons.append(f"適合族群包含{identity}")
+        for group in groups:
+            words = HABIT_GROUPS[group]
+            matched = _habit_evidence(chunks, words)
+            in_profile = any(w in fit_text for w in words)
+            if in_profile or matched:
+                score += (2 if in_profile else 0) + len(matched)
+                reasons.append(f"符合{group}需求")
+                evidence.extend(c for c in matched if c not in evidence)
+
+        min_income = card.get("min_income") or 0
+        if band == ">=200萬" and min_income >= 2000000:
+            score += 2
+            reasons.append("高資產客群可享頂級卡禮遇")
+        elif band == "60-200萬" and min_income >= 600000:
+            score += 1
+            reasons.append("收入符合中高階卡等級")
+        if band in ("未知", "<20萬", "20-60萬") and (card.get("annual_fee_amount") or 0) > HIGH_FEE:
+            score -= 1
+            reasons.append(f"年費 {card['annual_fee']} 較高")
+
+        ranked.append({
+            "card_name": name,
+            "score": round(score, 2),
+            "eligibility": status,
+            "annual_fee": card.get("annual_fee"),
+            "reasons": reasons,
+            "evidence": [_snippet(c) for c in evidence],
+        })
+
+    ranked = [r for r in ranked if r["score"] > 0]
+    ranked.sort(key=lambda r: (-r["score"], r["annual_fee"] is None, catalog[r["card_name"]].get("annual_fee_amount") or 0))
+    for rank, item in enumerate(ranked[:TOP_N], 1):
+        item["rank"] = rank
+    return ranked[:TOP_N]
+
+
+def table_version(jsonl_path: str) -> str:
+    digest = hashlib.sha256()
+    for path in (jsonl_path, os.path.abspath(__file__), os.path.join(os.path.dirname(os.path.abspath(__file__)), "card_catalog.py")):
+        with open(path, "rb") as f:
+            digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def build_table(jsonl_path: str = DEFAULT_JSONL) -> Dict[str, Any]:
+    catalog = load_catalog(jsonl_path)
+    records = list(iter_records(jsonl_path))
+    segments = {
+        make_key(identity, band, groups): {
+            "identity": identity,
+            "income_band": band,
+            "habits": groups,
+            "recommendations": rank_cards(catalog, records, identity, band, groups),
+        }
+        for identity, band, groups in all_segments()
+    }
+    return {
+        "version": table_version(jsonl_path),
+        "source": jsonl_path,
+        "built_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "cards": list(catalog),
+        "segments": segments,
+    }
+
+
+def save_table(table: Dict[str, Any], path: str) -> None:
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(table, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+
+# ==========================================
+# 線上查表
+# ==========================================
+class SegmentTable:
+    """
+    推薦表的查詢介面 (dispatcher 用)。檔案不存在時所有查詢都回傳 None；
+    檔案更新 (mtime 改變) 時下一次查詢自動重新讀取。
+    """
+
+    def __init__(self, path: str = DEFAULT_TABLE_PATH):
+        self.path = path
+        self._table: Optional[Dict[str, Any]] = None
+        self._mtime: Optional[float] = None
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "misses": 0}
+
+    def _current(self) -> Optional[Dict[str, Any]]:
+        try:
+            mtime = os.path.getmtime(self.path)
+        except OSError:
+            return None
+        with self._lock:
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, "r", encoding="utf-8") as f:
+                        self._table = json.load(f)
+                    self._mtime = mtime
+                except (OSError, ValueError) as e:
+                    print(f"⚠️ 讀取推薦表失敗 ({self.path}): {e}")
+                    self._table = None
+            return self._table
+
+    def lookup(self, profile: Any) -> Optional[Dict[str, Any]]:
+        """profile (dict 或 demand_agent 回傳的 JSON 字串) -> 該客群的表格內容；不在表內回傳 None"""
+        if isinstance(profile, str):
+            try:
+                profile = json.loads(profile)
+            except ValueError:
+                profile = None
+        table = self._current()
+        key = segment_key(profile) if table and isinstance(profile, dict) else None
+        entry = table["segments"].get(key) if key else None
+        if not entry or not entry["recommendations"]:
+            self.stats["misses"] += 1
+            return None
+        self.stats["hits"] += 1
+        return {"segment": key, "version": table["version"], **entry}
+
+    def answer(self, profile: Any) -> Optional[str]:
+        """查表結果轉成給 Router 的 tool 結果 (JSON 字串)；不在表內回傳 None"""
+        entry = self.lookup(profile)
+        if entry is None:
+            return None
+        return json.dumps({
+            "source": "segment_table",
+            "note": "依客群預先計算的推薦 (年收入與現職條件已比對申辦門檻)，evidence 為資料庫原文摘錄",
+            **entry,
+        }, ensure_ascii=False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="客群推薦表：離線建表 / 查表")
+    sub = parser.add_subparsers(dest="command", required=True)
+    p_build = sub.add_parser("build", help="由 RAG 語料計算所有客群的推薦排名")
+    p_build.add_argument("--jsonl", default=DEFAULT_JSONL)
+    p_build.add_argument("--output", default=DEFAULT_TABLE_PATH)
+    p_lookup = sub.add_parser("lookup", help="用 demand_agent 格式的 profile JSON 查表")
+    p_lookup.add_argument("profile")
+    p_lookup.add_argument("--table", default=DEFAULT_TABLE_PATH)
+    args = parser.parse_args()
+
+    if args.command == "build":
+        started = time.perf_counter()
+        table = build_table(args.jsonl)
+        save_table(table, args.output)
+        empty = sum(1 for s in table["segments"].values() if not s["recommendations"])
+        print(f"✅ 推薦表已寫入 {args.output} (version={table['version']}，{len(table['segments'])} 個客群，"
+              f"{empty} 個沒有可推薦的卡，{time.perf_counter() - started:.2f}s)")
+        return
+
+    entry = SegmentTable(args.table).lookup(args.profile)
+    if entry is None:
+        print("🤷 不在推薦表內 (會改由 comparing_agent 回答)")
+        return
+    print(f"📋 客群 {entry['segment']} (version={entry['version']})")
+    for item in entry["recommendations"]:
+        print(f"  {item['rank']}. {item['card_name']} (score={item['score']}, {item['eligibility']})：{'；'.join(item['reasons'])}")
+        print(f"     佐證: {', '.join(e['id'] for e in item['evidence'])}")
+
+
+if __name__ == "__main__":
+    main()
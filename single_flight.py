@@ -0,0 +1,125 @@
+# single_flight.py
+# 相同的請求正在執行時，後到的呼叫不再重跑，直接等第一個的結果 (single-flight / request coalescing)
+#
+# 多個使用者同時問「CUBE卡年費」時，每個 session 的第一輪 ReAct 都送出一模一樣的 Gemini 請求；
+# 同一句 query 也會被好幾個請求同時拿去算 BGE-M3 embedding。這些工作同時在跑、輸入完全相同，
+# 只需要執行一次、大家共用結果 (包含例外)。已經完成的結果不會保留，這裡不是快取，只合併「同時進行中」的呼叫。
+#
+# LLM 與 embedding 都是同步 API (Agent 用 asyncio.to_thread 丟到 thread 執行)，所以用 threading 實作：
+#
+#   flight = group("embed_query")
+#   vector = flight.do(query, model.embed_query, query)
+#
+#   response = coalesced_completion(llm_client, model=..., messages=..., tools=...)   # 取代 client.chat.completions.create
+#
+# 各群組的計數 (calls / executions / coalesced / in_flight) 用 stats() 取得，放在各 Agent 的 *_agent_stats。
+# 設定 SINGLE_FLIGHT=0 可關閉 (每個呼叫都各自執行)。
+
+import hashlib
+import json
+import os
+import threading
+from typing import Any, Callable, Dict, Hashable, Optional
+
+SINGLE_FLIGHT_ENABLED = os.getenv("SINGLE_FLIGHT", "1") != "0"
+
+
+class _Call:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result: Any = None
+        self.error: Optional[BaseException] = None
+
+
+class SingleFlight:
+    """同一個 key 同時只執行一次 fn，其他呼叫等它完成後拿同一個結果"""
+
+    def __init__(self, name: str, enabled: bool = SINGLE_FLIGHT_ENABLED):
+        self.name = name
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._calls: Dict[Hashable, _Call] = {}
+        self._stats = {"calls": 0, "executions": 0, "coalesced": 0, "errors": 0}
+
+    def do(self, key: Hashable, fn: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        with self._lock:
+            self._stats["calls"] += 1
+            call = self._calls.get(key) if self.enabled else None
+            if call is not None:
+                self._stats["coalesced"] += 1
+            else:
+                self._stats["executions"] += 1
+                leader = _Call()
+                if self.enabled:
+                    self._calls[key] = leader
+
+        if call is not None:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            leader.result = fn(*args, **kwargs)
+            return leader.result
+        except BaseException as e:
+            leader.error = e
+            with self._lock:
+                self._stats["errors"] += 1
+            raise
+        finally:
+            with self._lock:
+                if self._calls.get(key) is leader:
+                    del self._calls[key]
+            leader.done.set()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            calls = self._stats["calls"]
+            return {
+                **self._stats,
+                "in_flight": len(self._calls),
+                "coalesced_rate": round(self._stats["coalesced"] / calls, 4) if calls else 0.0,
+            }
+
+
+_groups: Dict[str, SingleFlight] = {}
+_groups_lock = threading.Lock()
+
+
+def group(name: str) -> SingleFlight:
+    """取得 (或建立) 這個 process 裡名為 name 的 single-flight 群組"""
+    with _groups_lock:
+        if name not in _groups:
+            _groups[name] = SingleFlight(name)
+        return _groups[name]
+
+
+def stats() -> Dict[str, Dict[str, Any]]:
+    """所有群組的計數"""
+    with _groups_lock:
+        flights = list(_groups.values())
+    return {flight.name: flight.stats() for flight in flights}
+
+
+def _plain(obj: Any) -> Any:
+    """ChatCompletionMessage 這類 pydantic 物件轉成 dict，才能序列化成 key"""
+    if hasattr(obj, "model_dump"):
+        return obj.model_dump(exclude_none=True)
+    return str(obj)
+
+
+def make_key(*parts: Any) -> str:
+    payload = json.dumps(parts, ensure_ascii=False, sort_keys=True, default=_plain)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+
+def coalesced_completion(client: Any, **kwargs: Any) -> Any:
+    """
+    client.chat.completions.create(**kwargs)，相同 endpoint + 參數的同時呼叫只送出一次。
+    回傳的 response 會被多個呼叫端共用，只能讀不能改。
+    """
+    key = make_key(str(getattr(client, "base_url", "")), kwargs)
+    return group("chat_completions").do(key, client.chat.completions.create, **kwargs)
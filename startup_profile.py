@@ -0,0 +1,162 @@
+# startup_profile.py
+# Agent 冷啟動分析：import 時間 (python -X importtime) 與 MCP initialize 握手時間
+#
+# Agent 是被 agent_client 用 stdio 拉起來的子程序，MCP 的 initialize 要等整個模組 import 完才會回應；
+# 以前 agent_product 在模組層級就 import torch / transformers / langchain_community / FAISS，握手要好幾秒。
+# 現在這些都延到第一次查詢 (或背景 warm_up) 才載入，這支工具用來確認沒有人又把它們拉回模組層級：
+#
+#   python startup_profile.py imports agent_product          # 各套件的累計 import 時間 (前 20 名)
+#   python startup_profile.py imports agent_demand --top 40
+#   python startup_profile.py handshake                       # 每個 Agent 從啟動到 initialize 回應的秒數
+#   python startup_profile.py handshake --budget 1.0 --record startup_history.jsonl
+#
+# handshake 超過 --budget 秒的 Agent 會讓指令以非 0 結束 (可以放進 CI)；--record 會把結果附加到 JSONL 方便追蹤。
+#
+# Agent 本身用 StartupClock 記錄各階段耗時，放在各自 *_agent_stats 工具的 "startup" 欄位。
+
+import argparse
+import asyncio
+import json
+import os
+import subprocess
+import sys
+import time
+from typing import Any, Dict, List, Optional, Tuple
+
+AGENT_SCRIPTS = {
+    "product": "agent_product.py",
+    "comparing": "agent_comparing.py",
+    "demand": "agent_demand.py",
+    "eligibility": "eligibility_agent.py",
+}
+DEFAULT_BUDGET_SECONDS = 1.0
+# 這些套件出現在 Agent 的模組層級 import 裡就是退步
+HEAVY_PACKAGES = ("torch", "transformers", "sentence_transformers", "langchain_community", "faiss")
+
+
+class StartupClock:
+    """Agent 啟動各階段的耗時 (相對於 StartupClock 建立的時間)，越早建立越準"""
+
+    def __init__(self, agent: str):
+        self.agent = agent
+        self.started = time.perf_counter()
+        self.marks: Dict[str, float] = {}
+
+    def mark(self, stage: str) -> float:
+        self.marks[stage] = round(time.perf_counter() - self.started, 3)
+        return self.marks[stage]
+
+    def snapshot(self) -> Dict[str, Any]:
+        return {"agent": self.agent, **self.marks}
+
+
+# ---------- import 時間 ----------
+def profile_imports(module: str) -> Tuple[List[Dict[str, Any]], float]:
+    """
+    在子程序跑 python -X importtime -c "import <module>"，回傳 (各 import 的耗時, 整體秒數)。
+    每筆：{"module", "self_ms", "cumulative_ms", "depth"}
+    """
+    started = time.perf_counter()
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", f"import {module}"],
+        capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)),
+    )
+    wall = time.perf_counter() - started
+    if proc.returncode != 0:
+        tail = proc.stderr.strip().splitlines()[-1:] or ["(沒有輸出)"]
+        raise RuntimeError(f"import {module} 失敗: {tail[0]}")
+
+    rows = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith("import time:") or "self [us]" in line:
+            continue
+        self_us, cumulative_us, name = line[len("import time:"):].split("|", 2)
+        rows.append({
+            "module": name.strip(),
+            "self_ms": int(self_us) / 1000,
+            "cumulative_ms": int(cumulative_us) / 1000,
+            "depth": (len(name) - len(name.lstrip())) // 2,
+        })
+    return rows, wall
+
+
+def top_level_breakdown(rows: List[Dict[str, Any]]) -> List[Dict[str, Any]]:
+    """依頂層套件彙總 self 時間 (torch 底下幾百個子模組算成一筆 torch)"""
+    totals: Dict[str, float] = {}
+    for row in rows:
+        package = row["module"].split(".")[0]
+        totals[package] = totals.get(package, 0.0) + row["self_ms"]
+    return [{"package": p, "ms": round(ms, 1)} for p, ms in sorted(totals.items(), key=lambda kv: -kv[1])]
+
+
+def print_imports(module: str, top: int) -> int:
+    rows, wall = profile_imports(module)
+    breakdown = top_level_breakdown(rows)
+    total_ms = sum(item["ms"] for item in breakdown)
+    print(f"📦 import {module}: {total_ms / 1000:.2f}s (含直譯器啟動 {wall:.2f}s)，共 {len(rows)} 個模組")
+    print(f"{'package':<32}{'ms':>10}{'%':>8}")
+    for item in breakdown[:top]:
+        print(f"{item['package']:<32}{item['ms']:>10.1f}{item['ms'] / total_ms * 100 if total_ms else 0:>7.1f}%")
+
+    heavy = [item["package"] for item in breakdown if item["package"] in HEAVY_PACKAGES]
+    if heavy:
+        print(f"⚠️ 模組層級載入了重量級套件：{', '.join(heavy)}")
+        return 1
+    return 0
+
+
+# ---------- MCP 握手時間 ----------
+async def measure_handshake(script: str, timeout: float = 120.0) -> float:
+    """以 stdio 啟動 Agent，回傳從啟動到 initialize 回應的秒數"""
+    from mcp import ClientSession
+    from mcp.client.stdio import StdioServerParameters, stdio_client
+
+    params = StdioServerParameters(command=sys.executable, args=[script], env=os.environ.copy())
+    started = time.perf_counter()
+    async with stdio_client(params) as (read, write):
+        async with ClientSession(read, write) as session:
+            await asyncio.wait_for(session.initialize(), timeout)
+            return time.perf_counter() - started
+
+
+def run_handshakes(agents: List[str], budget: float, record: Optional[str]) -> int:
+    results: Dict[str, Any] = {}
+    for name in agents:
+        try:
+            results[name] = round(asyncio.run(measure_handshake(AGENT_SCRIPTS[name])), 3)
+        except Exception as e:
+            results[name] = None
+            print(f"❌ {name}: 啟動失敗 ({e})")
+            continue
+        icon = "✅" if results[name] <= budget else "🐢"
+        print(f"{icon} {name:<12} initialize 回應 {results[name]:.2f}s (預算 {budget:.2f}s)")
+
+    if record:
+        with open(record, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"ts": time.strftime("%Y-%m-%dT%H:%M:%S"), "budget": budget, "handshake": results},
+                               ensure_ascii=False) + "\n")
+    over = [name for name, seconds in results.items() if seconds is None or seconds > budget]
+    return 1 if over else 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Agent 冷啟動分析 (import 時間 / MCP 握手時間)")
+    sub = parser.add_subparsers(dest="command", required=True)
+
+    p_imports = sub.add_parser("imports", help="python -X importtime 的套件別彙總")
+    p_imports.add_argument("module", help="要分析的模組 (例如 agent_product、rag_search)")
+    p_imports.add_argument("--top", type=int, default=20)
+
+    p_handshake = sub.add_parser("handshake", help="每個 Agent 從啟動到回應 MCP initialize 的時間")
+    p_handshake.add_argument("--agents", nargs="+", choices=sorted(AGENT_SCRIPTS), default=list(AGENT_SCRIPTS))
+    p_handshake.add_argument("--budget", type=float, default=DEFAULT_BUDGET_SECONDS, help="每個 Agent 的秒數上限")
+    p_handshake.add_argument("--record", help="把結果附加到這個 JSONL")
+
+    args = parser.parse_args()
+    if args.command == "imports":
+        sys.exit(print_imports(args.module, args.top))
+    sys.exit(run_handshakes(args.agents, args.budget, args.record))
+
+
+if __name__ == "__main__":
+    main()
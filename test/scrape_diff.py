@@ -0,0 +1,131 @@
+# scrape_diff.py
+# 爬蟲輸出的變更偵測：以「權益區塊 / 彈窗」為單位算 hash，和上一次的 snapshot 比對，只輸出有變的段落
+#
+# scrape_engine.py 每次都會產生整份 markdown，看不出哪個權益方案真的改了。這裡把 markdown 拆成段落：
+#   - 每個「## 權益區塊」的表層文字一段，id 用區塊第一行 (通常是方案名稱)，區塊順序調動不會被當成變更
+#   - 區塊裡每個「**項目 i 詳情**」彈窗一段，id 為 "<區塊 id>/項目i"
+# 內容正規化 (合併空白) 後算 sha256，和 <snapshot_dir>/<name>.json 比對，
+# 寫出 <snapshot_dir>/<name>.changes.json (新增 / 修改 / 刪除的段落與全文)，再更新 snapshot。
+#
+# 有變的段落對應到 creditcard_json 裡的卡片 / 方案，更新 JSON 後跑 ingest.py：
+# 只有該卡會重新 convert，而且只有內容變了的 chunk 會重新 embedding。
+#
+# 用法：
+#   python test/scrape_engine.py --snapshot-dir scrape_snapshots    # 爬完自動比對
+#   python test/scrape_diff.py cube_card_benefits_div_structure.md --name cube --snapshot-dir scrape_snapshots
+
+import argparse
+import hashlib
+import json
+import os
+import re
+from typing import Any, Dict, List, Optional
+
+_BLOCK_RE = re.compile(r"^## 權益區塊 \d+\s*$", re.M)
+_SURFACE_RE = re.compile(r"```text\n(.*?)\n```", re.S)
+_POPUP_RE = re.compile(r"^\*\*項目 (\d+) 詳情\*\*:\n((?:>.*\n?)+)", re.M)
+
+
+def _normalize(text: str) -> str:
+    return re.sub(r"\s+", " ", text).strip()
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(_normalize(text).encode("utf-8")).hexdigest()
+
+
+def parse_sections(markdown: str) -> Dict[str, str]:
+    """scrape_engine 輸出的 markdown -> {段落 id: 文字}"""
+    sections: Dict[str, str] = {}
+    chunks = _BLOCK_RE.split(markdown)[1:]  # 第一段是檔頭
+    for chunk in chunks:
+        surface_match = _SURFACE_RE.search(chunk)
+        if not surface_match:
+            continue
+        surface = surface_match.group(1).strip()
+        title = _normalize(surface.splitlines()[0])[:60] if surface else "(空白區塊)"
+
+        block_id, n = title, 2
+        while block_id in sections:
+            block_id = f"{title}#{n}"
+            n += 1
+        sections[block_id] = surface
+
+        for popup in _POPUP_RE.finditer(chunk):
+            lines = [line[1:].strip() for line in popup.group(2).splitlines()]
+            sections[f"{block_id}/項目{popup.group(1)}"] = "\n".join(lines)
+    return sections
+
+
+def build_snapshot(markdown: str) -> Dict[str, Dict[str, str]]:
+    return {sid: {"hash": content_hash(text), "text": text} for sid, text in parse_sections(markdown).items()}
+
+
+def diff_snapshots(old: Dict[str, Dict[str, str]], new: Dict[str, Dict[str, str]]) -> Dict[str, Any]:
+    added = [sid for sid in new if sid not in old]
+    removed = [sid for sid in old if sid not in new]
+    changed = [sid for sid in new if sid in old and old[sid]["hash"] != new[sid]["hash"]]
+    return {
+        "added": added,
+        "changed": changed,
+        "removed": removed,
+        "unchanged": len(new) - len(added) - len(changed),
+    }
+
+
+def load_snapshot(path: str) -> Optional[Dict[str, Dict[str, str]]]:
+    if not os.path.exists(path):
+        return None
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+
+def record_changes(name: str, markdown: str, snapshot_dir: str) -> Dict[str, Any]:
+    """
+    和上一次的 snapshot 比對，寫出 <name>.changes.json 並更新 <name>.json。
+    第一次 (沒有舊 snapshot) 所有段落都算新增。回傳 diff 摘要 (含 first_run)。
+    """
+    os.makedirs(snapshot_dir, exist_ok=True)
+    snapshot_path = os.path.join(snapshot_dir, f"{name}.json")
+    old = load_snapshot(snapshot_path)
+    new = build_snapshot(markdown)
+    diff = diff_snapshots(old or {}, new)
+
+    changes: List[Dict[str, Any]] = []
+    for kind in ("added", "changed"):
+        changes.extend({"section": sid, "kind": kind, "text": new[sid]["text"]} for sid in diff[kind])
+    changes.extend({"section": sid, "kind": "removed", "text": old[sid]["text"]} for sid in diff["removed"])
+
+    with open(os.path.join(snapshot_dir, f"{name}.changes.json"), "w", encoding="utf-8") as f:
+        json.dump({"target": name, "first_run": old is None, "changes": changes}, f, ensure_ascii=False, indent=2)
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(new, f, ensure_ascii=False, indent=2)
+    os.replace(tmp_path, snapshot_path)
+
+    return {**diff, "first_run": old is None, "sections": len(new)}
+
+
+def format_diff(name: str, diff: Dict[str, Any]) -> str:
+    if diff.get("first_run"):
+        return f"🆕 [{name}] 第一次建立 snapshot ({diff['sections']} 個段落)"
+    if not (diff["added"] or diff["changed"] or diff["removed"]):
+        return f"💤 [{name}] 沒有變更 ({diff['unchanged']} 個段落)"
+    return (f"🔁 [{name}] 新增 {len(diff['added'])}、修改 {len(diff['changed'])}、刪除 {len(diff['removed'])} 個段落"
+            f" (未變 {diff['unchanged']})：{', '.join(diff['added'] + diff['changed'] + diff['removed'])}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="比對爬蟲輸出與上一次的 snapshot")
+    parser.add_argument("markdown", help="scrape_engine 產生的 markdown")
+    parser.add_argument("--name", required=True, help="target 名稱 (snapshot 檔名)")
+    parser.add_argument("--snapshot-dir", default="scrape_snapshots")
+    args = parser.parse_args()
+
+    with open(args.markdown, "r", encoding="utf-8") as f:
+        markdown = f.read()
+    print(format_diff(args.name, record_changes(args.name, markdown, args.snapshot_dir)))
+
+
+if __name__ == "__main__":
+    main()
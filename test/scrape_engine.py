@@ -0,0 +1,340 @@
+# scrape_engine.py
+# 信用卡權益頁面的並行爬蟲引擎 (scrape_cube.py 的通用版)
+#
+# scrape_cube.py 原本開一個看得到的 Chrome，一頁一頁爬，每個區塊固定 sleep (載入 8 秒、每個彈窗再 3 秒)。這裡改成：
+#   - BrowserPool：最多 N 個 headless Chrome (用到才開)，多個頁面用 thread pool 同時爬，用完放回 pool 重複使用
+#   - 明確等待 (WebDriverWait)：等 document.readyState、父容器出現、彈窗出現 / 消失，條件成立就往下走，不再固定 sleep
+#   - fixture 模式：對存下來的 HTML (--save-fixtures 產生) 跑同一套解析，不連網站，改 selector 時可以快速驗證
+#   - 結束時印出成功 / 失敗頁數與 pages/min
+#
+# 用法 (在專案根目錄執行)：
+#   python test/scrape_engine.py                                   # 爬 TARGETS 裡所有頁面
+#   python test/scrape_engine.py --targets my_targets.json --workers 4
+#   python test/scrape_engine.py --save-fixtures test/fixtures     # 爬完順便存 HTML
+#   python test/scrape_engine.py --fixtures test/fixtures          # 用存下來的 HTML 跑
+#   python test/scrape_engine.py --snapshot-dir scrape_snapshots    # 和上次的結果比對，只列出有變的段落 (scrape_diff.py)
+#
+# targets JSON 是 list，每筆：{"name", "url", "parent_selector", "child_xpath"?, "output"}
+
+import argparse
+import json
+import os
+import queue
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, List, Optional
+
+from scrape_diff import format_diff, record_changes
+from selenium import webdriver
+from selenium.common.exceptions import TimeoutException, WebDriverException
+from selenium.webdriver.chrome.options import Options
+from selenium.webdriver.chrome.service import Service
+from selenium.webdriver.common.action_chains import ActionChains
+from selenium.webdriver.common.by import By
+from selenium.webdriver.common.keys import Keys
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.webdriver.support.ui import WebDriverWait
+
+PAGE_TIMEOUT = 20      # 等頁面 / 父容器的上限秒數 (條件成立就立刻往下，不會每次都等滿)
+POPUP_TIMEOUT = 5      # 等彈窗出現 / 關閉的上限秒數
+FIXTURE_POPUP_TIMEOUT = 0.5  # 存下來的 HTML 沒有 JS，彈窗不會出現，不要久等
+DEFAULT_CHILD_XPATH = "./div[contains(@class, 'aem-GridColumn') and contains(@class, 'aem-GridColumn--default--12')]"
+USER_AGENT = "Mozilla/5.0 (Macintosh; Intel Mac OS X 10_15_7) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
+
+TARGETS: List[Dict[str, Any]] = [
+    {
+        "name": "cube",
+        "url": "https://www.cathay-cube.com.tw/cathaybk/personal/product/credit-card/cards/cube-list",
+        "parent_selector": "div.aem-container.aem-Grid.aem-Grid--12.aem-Grid--default--12.overflow-clip.mb-20",
+        "output": "cube_card_benefits_div_structure.md",
+    },
+]
+
+# 頁面上最新出現、看得到的 fixed 彈窗內容
+_FIND_POPUP_JS = """
+    let popups = document.querySelectorAll('div[class*="fixed"]');
+    for (let i = popups.length - 1; i >= 0; i--) {
+        let p = popups[i];
+        if (p.offsetWidth > 0 && p.offsetHeight > 0 && p.innerText.length > 5) {
+            return p.innerText;
+        }
+    }
+    return null;
+"""
+_CLOSE_POPUP_JS = """
+    let popups = document.querySelectorAll('div[class*="fixed"]');
+    for (let i = popups.length - 1; i >= 0; i--) {
+        let p = popups[i];
+        if (p.offsetWidth > 0 && p.offsetHeight > 0) {
+            for (let btn of p.querySelectorAll('button')) { btn.click(); }
+        }
+    }
+"""
+
+
+# ==========================================
+# 1. 瀏覽器池
+# ==========================================
+def setup_driver(headless: bool = True) -> webdriver.Chrome:
+    from webdriver_manager.chrome import ChromeDriverManager
+
+    options = Options()
+    if headless:
+        options.add_argument("--headless=new")
+    options.add_argument("--disable-gpu")
+    options.add_argument("--window-size=1440,900")
+    options.add_argument("--no-sandbox")
+    options.add_argument("--disable-dev-shm-usage")
+    options.add_argument(f"user-agent={USER_AGENT}")
+    # 不等圖片等資源載完，DOM 好了就交給明確等待
+    options.page_load_strategy = "eager"
+    service = Service(ChromeDriverManager().install())
+    return webdriver.Chrome(service=service, options=options)
+
+
+class BrowserPool:
+    """最多 size 個 Chrome，用到才開；acquire() 借出、用完自動放回。壞掉的 driver 直接丟掉，下次再開新的"""
+
+    def __init__(self, size: int, headless: bool = True):
+        self.size = max(1, size)
+        self.headless = headless
+        self._idle: "queue.Queue[webdriver.Chrome]" = queue.Queue()
+        self._created = 0
+        self._lock = threading.Lock()
+        self._all: List[webdriver.Chrome] = []
+
+    def _get(self) -> webdriver.Chrome:
+        try:
+            return self._idle.get_nowait()
+        except queue.Empty:
+            pass
+        with self._lock:
+            if self._created < self.size:
+                self._created += 1
+                create = True
+            else:
+                create = False
+        if not create:
+            return self._idle.get()
+        try:
+            driver = setup_driver(self.headless)
+        except Exception:
+            with self._lock:
+                self._created -= 1
+            raise
+        with self._lock:
+            self._all.append(driver)
+        return driver
+
+    @contextmanager
+    def acquire(self):
+        driver = self._get()
+        broken = False
+        try:
+            yield driver
+        except TimeoutException:
+            raise  # 只是等不到元素，driver 本身沒壞
+        except WebDriverException:
+            broken = True
+            raise
+        finally:
+            if broken:
+                self._discard(driver)
+            else:
+                self._idle.put(driver)
+
+    def _discard(self, driver: webdriver.Chrome) -> None:
+        with self._lock:
+            self._created -= 1
+            if driver in self._all:
+                self._all.remove(driver)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+
+    def close(self) -> None:
+        with self._lock:
+            drivers, self._all = self._all, []
+        for driver in drivers:
+            try:
+                driver.quit()
+            except Exception:
+                pass
+
+
+# ==========================================
+# 2. 單一頁面
+# ==========================================
+def wait_dom_ready(driver: webdriver.Chrome, timeout: float = PAGE_TIMEOUT) -> None:
+    WebDriverWait(driver, timeout).until(lambda d: d.execute_script("return document.readyState") != "loading")
+
+
+def _read_popup(driver: webdriver.Chrome, icon, timeout: float) -> Optional[str]:
+    """點開 info icon，等彈窗出現就讀內容，再關閉並等它消失"""
+    driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", icon)
+    driver.execute_script("arguments[0].click();", icon)
+    try:
+        content = WebDriverWait(driver, timeout, poll_frequency=0.1).until(lambda d: d.execute_script(_FIND_POPUP_JS))
+    except TimeoutException:
+        return None
+    finally:
+        driver.execute_script(_CLOSE_POPUP_JS)
+        ActionChains(driver).send_keys(Keys.ESCAPE).perform()
+
+    try:
+        WebDriverWait(driver, timeout, poll_frequency=0.1).until(lambda d: not d.execute_script(_FIND_POPUP_JS))
+    except TimeoutException:
+        pass  # 關不掉也不影響讀下一個，下一個彈窗會是最新出現的那個
+    return content
+
+
+def scrape_page(driver: webdriver.Chrome, target: Dict[str, Any], url: str, popup_timeout: float = POPUP_TIMEOUT) -> str:
+    """爬一個頁面，回傳 markdown (格式同 scrape_cube.py 的輸出)"""
+    driver.get(url)
+    wait_dom_ready(driver)
+    parent_div = WebDriverWait(driver, PAGE_TIMEOUT).until(
+        EC.presence_of_element_located((By.CSS_SELECTOR, target["parent_selector"]))
+    )
+    children_divs = parent_div.find_elements(By.XPATH, target.get("child_xpath") or DEFAULT_CHILD_XPATH)
+    print(f"📦 [{target['name']}] 找到 {len(children_divs)} 個權益區塊")
+
+    md_output = f"# {target['name']} 結構化權益資料\n\n來源: {target['url']}\n---\n"
+    for idx, div in enumerate(children_divs):
+        # 捲到區塊並等它渲染出文字 (lazy render 的區塊捲到才有內容)
+        driver.execute_script("arguments[0].scrollIntoView({block: 'center'});", div)
+        try:
+            WebDriverWait(driver, popup_timeout, poll_frequency=0.1).until(lambda d: div.text.strip())
+        except TimeoutException:
+            continue  # 完全空白的區塊
+        surface_text = div.text.strip()
+
+        md_output += f"\n## 權益區塊 {idx+1}\n"
+        md_output += "### 📄 表層資訊\n"
+        md_output += f"```text\n{surface_text}\n```\n\n"
+
+        icons = [icon for icon in div.find_elements(By.CSS_SELECTOR, ".icon-line-info") if icon.is_displayed()]
+        if not icons:
+            md_output += "(此區塊無詳細資訊按鈕)\n\n---\n"
+            continue
+
+        md_output += f"### ℹ️ 內層注意事項 (共 {len(icons)} 則)\n"
+        for i, icon in enumerate(icons):
+            try:
+                popup_content = _read_popup(driver, icon, popup_timeout)
+            except WebDriverException as e:
+                print(f"      ⚠️ [{target['name']}] 區塊 {idx+1} icon {i+1} 失敗: {e.__class__.__name__}")
+                ActionChains(driver).send_keys(Keys.ESCAPE).perform()
+                continue
+            if popup_content:
+                clean_text = popup_content.replace("關閉", "").strip()
+                formatted_text = "\n".join(f"> {line}" for line in clean_text.splitlines() if line.strip())
+                md_output += f"**項目 {i+1} 詳情**:\n{formatted_text}\n\n"
+        md_output += "---\n"
+    return md_output
+
+
+# ==========================================
+# 3. 並行爬多個頁面
+# ==========================================
+def scrape_all(
+    targets: List[Dict[str, Any]],
+    workers: int = 4,
+    headless: bool = True,
+    fixtures_dir: Optional[str] = None,
+    save_fixtures: Optional[str] = None,
+    output_dir: str = ".",
+    snapshot_dir: Optional[str] = None,
+) -> Dict[str, Any]:
+    """
+    並行爬 targets，每頁的 markdown 寫到 output_dir/<output>。
+    fixtures_dir 有給時改讀 <fixtures_dir>/<name>.html (file:// 網址，同一套解析)。
+    snapshot_dir 有給時，每頁和上一次的 snapshot 比對段落 hash (scrape_diff.record_changes)。
+    回傳統計：pages / ok / failed / seconds / pages_per_minute / 每頁耗時
+    """
+    popup_timeout = FIXTURE_POPUP_TIMEOUT if fixtures_dir else POPUP_TIMEOUT
+    pool = BrowserPool(min(workers, len(targets)) or 1, headless=headless)
+    os.makedirs(output_dir, exist_ok=True)
+    if save_fixtures:
+        os.makedirs(save_fixtures, exist_ok=True)
+
+    def run(target: Dict[str, Any]) -> Dict[str, Any]:
+        url = target["url"]
+        if fixtures_dir:
+            url = Path(fixtures_dir, f"{target['name']}.html").resolve().as_uri()
+        started = time.perf_counter()
+        try:
+            with pool.acquire() as driver:
+                md_output = scrape_page(driver, target, url, popup_timeout)
+                if save_fixtures:
+                    Path(save_fixtures, f"{target['name']}.html").write_text(driver.page_source, encoding="utf-8")
+            output = os.path.join(output_dir, target.get("output") or f"{target['name']}.md")
+            with open(output, "w", encoding="utf-8") as f:
+                f.write(md_output)
+            result = {"name": target["name"], "ok": True, "output": output}
+            if snapshot_dir:
+                result["diff"] = record_changes(target["name"], md_output, snapshot_dir)
+            seconds = time.perf_counter() - started
+            print(f"✅ [{target['name']}] 完成 ({seconds:.1f}s) -> {output}")
+            if snapshot_dir:
+                print(format_diff(target["name"], result["diff"]))
+            return {**result, "seconds": round(seconds, 2)}
+        except Exception as e:
+            seconds = time.perf_counter() - started
+            print(f"❌ [{target['name']}] 失敗 ({seconds:.1f}s): {e.__class__.__name__}: {e}")
+            return {"name": target["name"], "ok": False, "seconds": round(seconds, 2), "error": str(e)}
+
+    started = time.perf_counter()
+    try:
+        with ThreadPoolExecutor(max_workers=pool.size) as executor:
+            pages = list(executor.map(run, targets))
+    finally:
+        pool.close()
+
+    seconds = time.perf_counter() - started
+    ok = sum(1 for p in pages if p["ok"])
+    return {
+        "pages": len(pages),
+        "ok": ok,
+        "failed": len(pages) - ok,
+        "seconds": round(seconds, 2),
+        "pages_per_minute": round(ok / seconds * 60, 2) if seconds > 0 else 0.0,
+        "per_page": pages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="並行爬取信用卡權益頁面")
+    parser.add_argument("--targets", help="targets JSON 檔 (預設用 TARGETS)")
+    parser.add_argument("--workers", type=int, default=4, help="同時開幾個瀏覽器")
+    parser.add_argument("--show-browser", action="store_true", help="顯示瀏覽器視窗 (除錯 selector 用)")
+    parser.add_argument("--fixtures", help="改用存下來的 HTML (<name>.html) 跑，不連網站")
+    parser.add_argument("--save-fixtures", help="把爬到的頁面 HTML 存到這個資料夾")
+    parser.add_argument("--output-dir", default=".", help="markdown 輸出資料夾")
+    parser.add_argument("--snapshot-dir", help="和這個資料夾裡上一次的 snapshot 比對，輸出有變的段落")
+    args = parser.parse_args()
+
+    targets = TARGETS
+    if args.targets:
+        with open(args.targets, "r", encoding="utf-8") as f:
+            targets = json.load(f)
+
+    print(f"🚀 開始爬取 {len(targets)} 個頁面 (workers={args.workers}{', fixture 模式' if args.fixtures else ''})...")
+    stats = scrape_all(
+        targets,
+        workers=args.workers,
+        headless=not args.show_browser,
+        fixtures_dir=args.fixtures,
+        save_fixtures=args.save_fixtures,
+        output_dir=args.output_dir,
+        snapshot_dir=args.snapshot_dir,
+    )
+    print(f"📊 {stats['ok']}/{stats['pages']} 頁成功，耗時 {stats['seconds']}s，"
+          f"{stats['pages_per_minute']} pages/min")
+
+
+if __name__ == "__main__":
+    main()
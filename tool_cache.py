@@ -0,0 +1,103 @@
+# tool_cache.py
+# Dispatcher 端的工具結果快取 (Tool-Result Memoization)
+#
+# Router 有時會在同一輪、甚至同一個對話裡重複呼叫同一個 Agent (例如 demand_agent 跑兩次)，
+# 每一次都是完整的子 Agent ReAct loop。這裡以 (router 工具名稱, 正規化後的參數) 為 key
+# 記住每個對話已經拿到的結果，重複的呼叫直接回傳快取，不再派單。
+#
+# 參數正規化：
+#   - dict 依 key 排序；值為 None 或空字串的參數視同沒帶 (comparing_agent 的 user_profile="" 等)
+#   - 字串去頭尾空白、連續空白合併；內容是 JSON 物件/陣列的字串 (例如 user_profile) 會解析後再正規化
+#
+# 只快取成功的結果；Agent 回傳 {"error": ...} (包含 agent_busy)、或 MCP 結果標記 isError 時不快取，
+# 下一次仍會重新呼叫 (一次暫時性的失敗不會變成整個對話的答案)。
+#
+# 用法 (agent_client.run_dispatch_turn 內部使用)：
+#   cache = ToolResultCache()
+#   key = cache.make_key("product_agent", args)
+#   cached = cache.get(key)
+#   ...
+#   cache.put(key, content_str)
+
+import json
+import re
+import sys
+from collections import OrderedDict
+from typing import Any, Dict, Optional
+
+DEFAULT_MAX_ENTRIES = 64  # 每個對話最多記住幾筆工具結果
+
+
+def _normalize(value: Any) -> Any:
+    if isinstance(value, dict):
+        return {
+            k: _normalize(v)
+            for k, v in sorted(value.items())
+            if v is not None and not (isinstance(v, str) and not v.strip())
+        }
+    if isinstance(value, (list, tuple)):
+        return [_normalize(v) for v in value]
+    if isinstance(value, str):
+        text = value.strip()
+        if text[:1] in ("{", "["):
+            try:
+                return _normalize(json.loads(text))
+            except json.JSONDecodeError:
+                pass
+        return re.sub(r"\s+", " ", text)
+    return value
+
+
+def _is_error_result(content: str) -> bool:
+    """Agent 回傳的是錯誤 JSON ({"error": ...}) 就不快取"""
+    text = content.lstrip()
+    if not text.startswith("{"):
+        return False
+    try:
+        data = json.loads(text)
+    except json.JSONDecodeError:
+        return False
+    return isinstance(data, dict) and "error" in data
+
+
+class ToolResultCache:
+    """單一對話的工具結果快取 (LRU)，附帶命中 / 抑制次數統計"""
+
+    def __init__(self, max_entries: int = DEFAULT_MAX_ENTRIES):
+        self.max_entries = max(1, max_entries)
+        self._entries: "OrderedDict[str, str]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(tool_name: str, arguments: Optional[Dict[str, Any]]) -> str:
+        normalized = _normalize(arguments or {})
+        return f"{tool_name}:{json.dumps(normalized, ensure_ascii=False, sort_keys=True)}"
+
+    def get(self, key: str) -> Optional[str]:
+        content = self._entries.get(key)
+        if content is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return content
+
+    def put(self, key: str, content: str, is_error: bool = False) -> bool:
+        """存入成功的結果；錯誤結果 (is_error 或錯誤 JSON) 不存，回傳是否有存"""
+        if is_error or _is_error_result(content):
+            return False
+        self._entries[key] = content
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        return True
+
+    def log_suppressed(self, tool_name: str, reason: str) -> None:
+        print(f"♻️ [Dispatcher] 略過重複呼叫 {tool_name} ({reason})，直接使用先前的結果", file=sys.stderr)
+
+    def clear(self) -> None:
+        self._entries.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -1,75 +1,284 @@
+import argparse
+import hashlib
+import json
 import os
-import pandas as pd
+from typing import Iterable, Iterator
+
+import numpy as np
+from langchain_community.docstore.in_memory import InMemoryDocstore
 from langchain_community.embeddings import HuggingFaceBgeEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_core.documents import Document
 
-def main():
-    # ==========================================
-    # 1. 設定檔案路徑
-    # ==========================================
-    csv_file_path = "cards_rag.csv"  # 您的 CSV 檔案名稱
-    output_faiss_folder = "cards_rag_faiss_index" # 輸出向量資料庫的資料夾名稱
+from context_packer import precompute
+from corpus_dedupe import DEFAULT_THRESHOLD, Deduper
+from corpus_dedupe import print_report as print_dedupe_report
+from faiss_index_spec import (
+    SHARDS_DIRNAME,
+    build_faiss_index,
+    compression_report,
+    format_report,
+    load_shard_manifest,
+    parse_index_spec,
+    save_shard_manifest,
+    save_spec,
+    shard_dirname,
+)
 
-    # 檢查 CSV 是否存在
-    if not os.path.exists(csv_file_path):
-        print(f"❌ 找不到檔案: {csv_file_path}")
-        return
+BGE_M3_DIM = 1024
+EMBED_BATCH_SIZE = 64
+DEFAULT_INPUT = "cards_rag.jsonl"
+# 不放進 metadata 的欄位 (raw 是整份原始 JSON，只會讓 docstore 變大)
+DROP_METADATA_KEYS = ("raw",)
 
-    # ==========================================
-    # 2. 讀取 CSV 並轉換為 LangChain Documents
-    # ==========================================
-    print(f"🚀 開始讀取 CSV: {csv_file_path} ...")
-    
-    # 讀取 CSV，並將 NaN (空值) 填補為空字串，避免 Metadata 報錯
-    df = pd.read_csv(csv_file_path)
-    df = df.fillna("") 
-
-    documents = []
-    print("🔄 正在轉換為 LangChain Documents...")
-
-    for index, row in df.iterrows():
-        # 1. 取出主要文本 (Text) 用於向量化
-        page_content = row.get("text", "")
-        
-        # 確保文本不是空的
+
+def iter_jsonl_documents(path: str) -> Iterator[Document]:
+    """
+    逐行讀 JSONL 產生 Documents (記憶體用量固定)。
+    外層欄位與 "metadata" 攤平成同一層 (同 jsonl_to_csv.py)，但保留原本的型別：
+    list 仍是 list (例如 channels_flat)、null 仍是 None，metadata filter 才能正確比對。
+    """
+    with open(path, "r", encoding="utf-8") as f:
+        for line_num, line in enumerate(f, 1):
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                data = json.loads(line)
+            except json.JSONDecodeError:
+                print(f"⚠️ 跳過格式錯誤的第 {line_num} 行")
+                continue
+
+            page_content = data.pop("text", "")
+            if not page_content:
+                continue
+            nested = data.pop("metadata", None) or {}
+            metadata = {**data, **nested}
+            for key in DROP_METADATA_KEYS:
+                metadata.pop(key, None)
+            yield Document(page_content=page_content, metadata=metadata)
+
+
+def iter_csv_documents(path: str) -> Iterator[Document]:
+    """舊流程：讀 jsonl_to_csv.py 產生的 CSV (list 欄位是 JSON 字串，這裡還原成 list)"""
+    import pandas as pd
+
+    df = pd.read_csv(path).fillna("")
+    for row in df.to_dict(orient="records"):
+        page_content = row.pop("text", "")
         if not page_content:
             continue
+        for key, value in row.items():
+            if isinstance(value, str) and value.startswith("["):
+                try:
+                    row[key] = json.loads(value)
+                except json.JSONDecodeError:
+                    pass
+        yield Document(page_content=page_content, metadata=row)
 
-        # 2. 將其餘欄位設為 Metadata
-        # 將該列轉換為字典
-        metadata = row.to_dict()
-        
-        # 從 metadata 中移除 'text'，因為它已經是 page_content 了，不需要重複存
-        if "text" in metadata:
-            del metadata["text"]
-            
-        # 3. 建立 Document 物件
-        doc = Document(page_content=page_content, metadata=metadata)
-        documents.append(doc)
-
-    print(f"📊 總共建立 {len(documents)} 個文件 (Documents)")
 
-    # ==========================================
-    # 3. 初始化 Embedding 模型與建立索引
-    # ==========================================
+def load_embeddings():
     print("🧠 初始化 Embedding 模型 (BAAI/bge-m3)...")
-    # 使用與您原本相同的模型設定
-    embeddings = HuggingFaceBgeEmbeddings(
+    return HuggingFaceBgeEmbeddings(
         model_name="BAAI/bge-m3",
         model_kwargs={"device": "cpu"},
         encode_kwargs={"normalize_embeddings": True},
     )
 
-    print("⚡️ 開始建立 FAISS 索引 (這可能需要一點時間)...")
-    vectorstore = FAISS.from_documents(documents, embeddings)
+
+def _with_precompute(documents: Iterable[Document]) -> Iterator[Document]:
+    """預先算好 prompt 用的 markdown 本文與 token 數 (查詢時 context_packer 直接取用)"""
+    for doc in documents:
+        precompute(doc.metadata, doc.page_content)
+        yield doc
+
+
+def text_digest(text: str) -> bytes:
+    return hashlib.sha1(text.encode("utf-8")).digest()
+
+
+def embed_in_batches(documents: Iterable[Document], embeddings, batch_size: int = EMBED_BATCH_SIZE, known_vectors=None):
+    """
+    邊讀邊 embed：每 batch_size 筆送一次模型，向量直接存成 float32 區塊 (不留 Python list of float)。
+    文字完全相同的 chunk (例如不同子卡的同一段說明) 只 embed 一次；
+    known_vectors ({text_digest: 向量}，例如上一次建索引的結果) 裡已有的文字直接沿用，不送模型。
+    回傳 (Documents, vectors)。
+    """
+    known_vectors = known_vectors or {}
+    docs, rows, blocks = [], [], []
+    row_of_text = {}  # 文字的 hash -> 向量所在列
+    n_vectors = n_encoded = 0
+    batch = []
+
+    def append_block(digests, block):
+        nonlocal n_vectors
+        blocks.append(block)
+        for offset, digest in enumerate(digests):
+            row_of_text[digest] = n_vectors + offset
+        n_vectors += len(digests)
+
+    def flush():
+        nonlocal n_encoded
+        pending, reused = {}, {}
+        for doc in batch:
+            digest = text_digest(doc.page_content)
+            if digest in row_of_text or digest in pending or digest in reused:
+                continue
+            if digest in known_vectors:
+                reused[digest] = known_vectors[digest]
+            else:
+                pending[digest] = doc.page_content
+        if reused:
+            append_block(list(reused), np.asarray(list(reused.values()), dtype="float32"))
+        if pending:
+            append_block(list(pending), np.asarray(embeddings.embed_documents(list(pending.values())), dtype="float32"))
+        n_encoded += len(pending)
+        for doc in batch:
+            rows.append(row_of_text[text_digest(doc.page_content)])
+            docs.append(doc)
+        print(f"   ⚡️ 已處理 {len(docs)} 筆 (embed {n_encoded} 次，沿用 {n_vectors - n_encoded} 個既有向量)", end="\r")
+        batch.clear()
+
+    for doc in documents:
+        batch.append(doc)
+        if len(batch) >= batch_size:
+            flush()
+    if batch:
+        flush()
+    print()
+
+    if not docs:
+        return [], np.zeros((0, BGE_M3_DIM), dtype="float32")
+    return docs, np.vstack(blocks)[rows]
+
+
+def build_vectorstore(documents, embeddings, spec, output_folder, known_vectors=None):
+    """
+    把 Documents (可為串流) 分批 embedding、依 spec 建索引，存到 output_folder (含 index_spec.json)。
+    回傳 (Documents, vectors)，呼叫端可以存下向量給下一次當 known_vectors。
+    """
+    print("⚡️ 開始計算 Embedding (分批處理，這可能需要一點時間)...")
+    documents, vectors = embed_in_batches(documents, embeddings, known_vectors=known_vectors)
+    if not documents:
+        print("❌ 沒有任何文件可以建索引")
+        return documents, vectors
+
+    print(f"🏗️ 建立 FAISS 索引: {spec['type']} {spec['params']} {spec.get('compress') or ''} ({len(documents)} 筆)")
+    index = build_faiss_index(spec, vectors)
+    if spec.get("compress"):
+        spec["report"] = compression_report(index, vectors)
+        print(format_report(spec["report"]))
+
+    ids = [str(i) for i in range(len(documents))]
+    vectorstore = FAISS(
+        embedding_function=embeddings,
+        index=index,
+        docstore=InMemoryDocstore(dict(zip(ids, documents))),
+        index_to_docstore_id=dict(enumerate(ids)),
+        distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+    )
+
+    print(f"💾 儲存索引至: {output_folder}/")
+    vectorstore.save_local(output_folder)
+    save_spec(output_folder, spec)
+    return documents, vectors
+
+
+def build_issuer_shards(documents, embeddings, spec, output_folder, only_issuer=None):
+    """
+    依 issuer 把 Documents 分組，每組各建一個索引到 output_folder/shards/<issuer>/，
+    並更新 shards.json。指定 only_issuer 時只重建該銀行，其他分片維持不動。
+    """
+    groups = {}
+    for doc in documents:
+        issuer = str(doc.metadata.get("issuer") or "unknown").strip()
+        groups.setdefault(issuer, []).append(doc)
+
+    if only_issuer:
+        if only_issuer not in groups:
+            print(f"❌ 資料中沒有 issuer = {only_issuer} 的文件，可用: {list(groups)}")
+            return
+        groups = {only_issuer: groups[only_issuer]}
+
+    manifest = load_shard_manifest(output_folder) or {"shards": {}}
+    manifest["spec"] = spec
+
+    for issuer, docs in groups.items():
+        print(f"\n🏦 建立分片: {issuer} ({len(docs)} 筆)")
+        rel_path = os.path.join(SHARDS_DIRNAME, shard_dirname(issuer))
+        shard_spec = {**spec, "params": dict(spec["params"])}
+        build_vectorstore(docs, embeddings, shard_spec, os.path.join(output_folder, rel_path))
+        manifest["shards"][issuer] = {
+            "path": rel_path,
+            "count": len(docs),
+            "card_names": sorted({str(d.metadata.get("card_name", "")) for d in docs}),
+        }
+
+    save_shard_manifest(output_folder, manifest)
+    print(f"🗂️ 分片清單已更新: {output_folder}/shards.json (共 {len(manifest['shards'])} 個 issuer)")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL (或舊版 CSV) -> FAISS 向量索引")
+    parser.add_argument("--input", default=DEFAULT_INPUT, help="輸入檔 (.jsonl 串流讀取；.csv 走舊的 pandas 流程)")
+    parser.add_argument(
+        "--index-spec",
+        default="flat",
+        help="索引類型，例如 flat、hnsw:M=32,efSearch=64、ivfpq:nlist=256,m=16,nbits=8,nprobe=16；"
+             "可加壓縮參數 dim=256,reduce=pca,quant=sq8|binary,rescore=4",
+    )
+    parser.add_argument("--output", default="cards_rag_faiss_index", help="輸出索引資料夾")
+    parser.add_argument("--shard-by-issuer", action="store_true", help="每個發卡銀行 (issuer) 各建一個分片索引")
+    parser.add_argument("--issuer", help="搭配 --shard-by-issuer：只重建這個 issuer 的分片")
+    parser.add_argument("--no-dedupe", action="store_true", help="不做去樣板 / 重複 chunk 合併")
+    parser.add_argument("--near-dup-threshold", type=float, default=DEFAULT_THRESHOLD, help="近似重複的 Jaccard 門檻")
+    parser.add_argument("--dedupe-report", help="把去重複報告 (含合併清單) 存成 JSON")
+    args = parser.parse_args()
+    spec = parse_index_spec(args.index_spec)
+
+    input_path = args.input
+    output_faiss_folder = args.output # 輸出向量資料庫的資料夾名稱
+
+    if not os.path.exists(input_path):
+        print(f"❌ 找不到檔案: {input_path}")
+        return
+
+    # ==========================================
+    # 1. 初始化 Embedding 模型
+    # ==========================================
+    embeddings = load_embeddings()
+
+    # ==========================================
+    # 2. 串流讀取 -> 去樣板 / 去重複 -> 預算 markdown 與 token 數
+    #    (generator 串接，下一步 embedding 才真正逐批讀檔)
+    # ==========================================
+    print(f"🚀 開始讀取: {input_path} ...")
+    if input_path.lower().endswith(".csv"):
+        documents = iter_csv_documents(input_path)
+    else:
+        documents = iter_jsonl_documents(input_path)
+
+    deduper = None if args.no_dedupe else Deduper(threshold=args.near_dup_threshold)
+    if deduper is not None:
+        documents = deduper.filter(documents)
+    documents = _with_precompute(documents)
 
     # ==========================================
-    # 4. 儲存結果
+    # 3. 建立並儲存索引 (連同 index spec，讓 rag_search 用相同參數載入)
     # ==========================================
-    print(f"💾 儲存索引至: {output_faiss_folder}/")
-    vectorstore.save_local(output_faiss_folder)
+    if args.shard_by_issuer:
+        build_issuer_shards(list(documents), embeddings, spec, output_faiss_folder, only_issuer=args.issuer)
+    else:
+        build_vectorstore(documents, embeddings, spec, output_faiss_folder)
+
+    if deduper is not None:
+        dedupe_report = deduper.report()
+        print_dedupe_report(dedupe_report, dim=BGE_M3_DIM)
+        if args.dedupe_report:
+            with open(args.dedupe_report, "w", encoding="utf-8") as f:
+                json.dump(dedupe_report, f, ensure_ascii=False, indent=2)
     print("✅ 完成！向量資料庫已建立。")
 
 if __name__ == "__main__":
-    main()
\ No newline at end of file
+    main()